@@ -0,0 +1,108 @@
+"""Compares MetaPhlAn's merge() with yamas' streaming merge on synthetic profiles.
+
+    python benchmarks/merge_profiles.py --profiles 2000 --clades 3000
+
+Writes the profiles to a temporary directory (or --dir), merges them with both, each in its own process,
+checks that the two tables are byte for byte identical and prints the time and the peak memory (max RSS) of each.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# run from a checkout: the repository root is the parent of benchmarks/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yamas.profile_merge import merge_profiles_streaming, metaphlan_merge  # noqa: E402
+
+LEVELS = "kpcofgst"
+
+
+def clade_pool(size: int, rng: random.Random):
+    # a taxonomy of `size` clades, k__ down to t__, with the parents of every clade in it
+    pool, parents, seen = [], [""], set()
+    while len(pool) < size:
+        parent = rng.choice(parents)
+        depth = parent.count("|") + 1 if parent else 0
+        if depth == len(LEVELS):
+            continue
+        clade = f"{parent}|{LEVELS[depth]}__{rng.randrange(10 ** 6)}" if parent else f"k__{rng.randrange(10 ** 6)}"
+        if clade not in seen:
+            seen.add(clade)
+            pool.append(clade)
+            parents.append(clade)
+    return pool
+
+
+def write_profiles(directory: str, profiles: int, clades: int, per_sample: int, seed: int = 0):
+    rng = random.Random(seed)
+    pool = clade_pool(clades, rng)
+    paths = []
+    for i in range(profiles):
+        sample = rng.sample(pool, min(per_sample, len(pool)))
+        path = os.path.join(directory, f"SRR{i:07d}_profile.txt")
+        with open(path, 'w') as f:
+            f.write("#mpa_vJun23_CHOCOPhlAnSGB_202403\n#/usr/bin/metaphlan sample.fastq --input_type fastq\n"
+                    f"#{rng.randrange(10 ** 6)} reads processed\n"
+                    "#clade_name\tNCBI_tax_id\trelative_abundance\tadditional_species\n")
+            for clade in sorted(sample, key=lambda c: c.count("|")):
+                abundance = rng.choice([f"{rng.uniform(0, 100):.5f}", repr(rng.uniform(0, 1e-3)), "100.0"])
+                f.write(f"{clade}\t{rng.randrange(10 ** 5)}\t{abundance}\t\n")
+        paths.append(path)
+    return sorted(paths)
+
+
+MERGERS = {"metaphlan merge": metaphlan_merge, "streaming merge": merge_profiles_streaming}
+
+
+def measure(name: str, paths: list, output_path: str):
+    # runs in a process of its own, so the peak RSS is the merge's (on top of the imports)
+    started = time.perf_counter()
+    with open(output_path, 'w') as out:
+        MERGERS[name](paths, out)
+    elapsed = time.perf_counter() - started
+    # ru_maxrss is in KB on Linux
+    print(json.dumps({"seconds": elapsed, "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the streaming MetaPhlAn profile merge")
+    parser.add_argument("--profiles", type=int, default=1000, help="number of profiles (default 1000)")
+    parser.add_argument("--clades", type=int, default=3000, help="distinct clades over all profiles (default 3000)")
+    parser.add_argument("--per_sample", type=int, default=300, help="clades in each profile (default 300)")
+    parser.add_argument("--dir", help="where the profiles and merged tables are written (default: a temporary dir)")
+    parser.add_argument("--run", nargs=3, metavar=("MERGER", "PATHS", "OUTPUT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        with open(args.run[1]) as f:
+            measure(args.run[0], f.read().split("\n"), args.run[2])
+        return
+
+    directory = args.dir or tempfile.mkdtemp(prefix="yamas_merge_bench_")
+    os.makedirs(directory, exist_ok=True)
+    paths = write_profiles(directory, args.profiles, args.clades, args.per_sample)
+    print(f"{len(paths)} profiles in {directory}")
+    paths_file = os.path.join(directory, "profiles.txt")
+    with open(paths_file, 'w') as f:
+        f.write("\n".join(paths))
+
+    outputs = {}
+    for name in MERGERS:
+        outputs[name] = os.path.join(directory, f"merged_{name.split()[0]}.txt")
+        run = subprocess.run([sys.executable, __file__, "--run", name, paths_file, outputs[name]],
+                             capture_output=True, text=True, check=True)
+        result = json.loads(run.stdout.strip().splitlines()[-1])
+        print(f"{name:16} {result['seconds']:8.2f}s {result['peak_mb']:10.1f}MB peak RSS")
+    with open(outputs["metaphlan merge"], 'rb') as a, open(outputs["streaming merge"], 'rb') as b:
+        identical = a.read() == b.read()
+    print("outputs identical" if identical else "OUTPUTS DIFFER")
+    if not identical:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
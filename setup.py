@@ -23,6 +23,8 @@ setuptools.setup(
     },
     install_requires=[
         'tqdm',
-        'MetaPhlAn'
+        'MetaPhlAn',
+        'numpy',
+        'pandas'
     ]
 )
\ No newline at end of file
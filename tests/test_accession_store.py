@@ -0,0 +1,49 @@
+import os
+
+from yamas.accession_store import AccessionStore
+
+
+def project_with_sra(tmp_path, name, store, acc):
+    project = tmp_path / name
+    (project / "sra" / acc).mkdir(parents=True)
+    (project / "metadata.json").write_text("{}")
+    sra_path = project / "sra" / acc / f"{acc}.sra"
+    sra_path.write_bytes(b"\0" * 1024)
+    store.add(acc, "sra", [str(sra_path)])
+    return project, sra_path
+
+
+def test_linked_files_are_kept(tmp_path):
+    store = AccessionStore(str(tmp_path / "store"))
+    _, sra_path = project_with_sra(tmp_path, "p1", store, "SRR1")
+    assert store.gc() == 0
+    assert store.files("SRR1", "sra")
+    os.remove(sra_path)
+    # no link and no project recorded for it
+    assert store.gc() == 1024
+    assert not store.files("SRR1", "sra")
+
+
+def test_streamed_project_keeps_its_accessions(tmp_path):
+    store = AccessionStore(str(tmp_path / "store"))
+    project, sra_path = project_with_sra(tmp_path, "p1", store, "SRR1")
+    store.add_project(str(project), ["SRR1"])
+    # the stream deletes the .sra once converted
+    os.remove(sra_path)
+    assert store.gc() == 0
+    assert store.files("SRR1", "sra")
+    # once the project itself is deleted, its accessions go
+    os.remove(project / "metadata.json")
+    assert store.gc(dry_run=True) == 1024
+    assert store.files("SRR1", "sra")
+    assert store.gc() == 1024
+    assert not store.files("SRR1", "sra")
+
+
+def test_link_into_another_project(tmp_path):
+    store = AccessionStore(str(tmp_path / "store"))
+    _, sra_path = project_with_sra(tmp_path, "p1", store, "SRR1")
+    linked = store.link("SRR1", "sra", str(tmp_path / "p2" / "sra" / "SRR1"))
+    assert len(linked) == 1 and os.path.samefile(linked[0], sra_path)
+    os.remove(sra_path)
+    assert store.gc() == 0
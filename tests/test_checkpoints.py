@@ -0,0 +1,45 @@
+import os
+
+from yamas.checkpoints import Checkpoints
+
+
+def test_mark_and_done(tmp_path):
+    source, output = tmp_path / "in.txt", tmp_path / "out.txt"
+    source.write_text("a")
+    checkpoints = Checkpoints(tmp_path)
+    assert not checkpoints.done("step", [source], [output])
+    output.write_text("b")
+    checkpoints.mark("step", [source])
+    assert checkpoints.done("step", [source], [output])
+    # read back from checkpoints.json
+    assert Checkpoints(tmp_path).done("step", [source], [output])
+
+
+def test_changed_input_or_missing_output(tmp_path):
+    source, output = tmp_path / "in.txt", tmp_path / "out.txt"
+    source.write_text("a")
+    output.write_text("b")
+    checkpoints = Checkpoints(tmp_path)
+    checkpoints.mark("step", [source])
+    source.write_text("changed")
+    assert not checkpoints.done("step", [source], [output])
+    checkpoints.mark("step", [source])
+    os.remove(output)
+    assert not checkpoints.done("step", [source], [output])
+
+
+def test_deleted_inputs_are_ignored(tmp_path):
+    # fastq files are deleted once profiled, the step stays done
+    source = tmp_path / "sample.fastq"
+    source.write_text("@r\nACGT\n+\nIIII\n")
+    checkpoints = Checkpoints(tmp_path)
+    checkpoints.mark("metaphlan:sample", [source])
+    os.remove(source)
+    assert checkpoints.done("metaphlan:sample", [source])
+
+
+def test_forget(tmp_path):
+    checkpoints = Checkpoints(tmp_path)
+    checkpoints.mark("step")
+    checkpoints.forget("step")
+    assert not Checkpoints(tmp_path).done("step")
@@ -0,0 +1,95 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from yamas import classifier_service, resources
+from yamas.classifier_service import ClassifierServer, classify_with_service, send, service_dir, service_socket_path
+from yamas.resources import MemoryGate
+from yamas.utilities import CancelScope
+
+
+@pytest.fixture
+def runtime_dir(tmp_path, monkeypatch):
+    path = tmp_path / "run"
+    path.mkdir(mode=0o700)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(path))
+    return path
+
+
+def test_service_dir_is_private(runtime_dir):
+    path = service_dir()
+    assert path == str(runtime_dir / "yamas")
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    os.chmod(path, 0o755)
+    with pytest.raises(PermissionError):
+        service_dir()
+
+
+@pytest.fixture
+def silent_service(runtime_dir):
+    # accepts connections and never answers
+    path = os.path.join(service_dir(), "silent.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connections.append(server.accept())
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield path
+    server.close()
+
+
+def test_send_timeout(silent_service):
+    with pytest.raises(RuntimeError, match="did not answer"):
+        send(silent_service, {"op": "ping"}, timeout=0.2)
+
+
+def test_send_cancelled(silent_service):
+    scope = CancelScope()
+    threading.Timer(0.2, scope.cancel).start()
+    with pytest.raises(RuntimeError, match="cancelled"):
+        send(silent_service, {"op": "ping"}, scope=scope)
+    assert not scope.commands
+
+
+def test_service_memory_is_held_while_it_runs(runtime_dir, tmp_path, monkeypatch):
+    gate = MemoryGate(memory_gb=100)
+    monkeypatch.setattr(resources, "memory_gate", gate)
+    monkeypatch.setattr(classifier_service, "SERVICE_CHECK_INTERVAL", 0.1)
+    classifier = tmp_path / "classifier.qza"
+    classifier.write_text("classifier")
+    # a service that already loaded its classifier
+    socket_path = service_socket_path(str(classifier))
+    monkeypatch.setattr(ClassifierServer, "classify", lambda server, request: open(request["output"], "w").close())
+    server = ClassifierServer(socket_path, str(classifier))
+    server.loaded.set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(classifier_service, "start_service", lambda classifier_path, idle_timeout: socket_path)
+
+    for index in range(2):
+        classify_with_service(str(tmp_path / "reads.qza"), str(classifier), str(tmp_path / f"taxonomy_{index}.qza"))
+        assert (tmp_path / f"taxonomy_{index}.qza").exists()
+        # the classifier stays loaded after the request, and is reserved once
+        assert gate.reserved == 32
+    time.sleep(0.5)
+    assert gate.reserved == 32
+    # the pings checking on the service don't keep it from stopping once idle
+    assert server.idle_for() >= 0.5
+
+    server.shutdown()
+    server.server_close()
+    os.unlink(socket_path)
+    deadline = time.time() + 5
+    while gate.reserved and time.time() < deadline:
+        time.sleep(0.05)
+    assert gate.reserved == 0
@@ -0,0 +1,221 @@
+import os
+import stat
+
+import pytest
+
+from yamas import create_visualization
+from yamas.checkpoints import Checkpoints
+from yamas.create_visualization import accession_fastq_files, fastq_files_complete, fastq_is_complete, \
+    metaphlan_extraction, sra_to_fastq, visualization
+from yamas.utilities import ReadsData
+
+RECORD = b"@SRR1.1 1 length=4\nACGT\n+SRR1.1 1 length=4\nIIII\n"
+
+# fasterq-dump --split-files <sra> -O <dir> ...: writes both mates, refuses to overwrite like the real one
+FASTERQ_DUMP = """#!/bin/bash
+acc=$(basename "$2" .sra)
+echo "$acc" >> "$FAKE_CALLS"
+for mate in 1 2; do
+  [[ -e "$4/${acc}_$mate.fastq" ]] && exit 3
+  printf '@r1\\nACGT\\n+\\nIIII\\n' > "$4/${acc}_$mate.fastq"
+done
+"""
+
+# metaphlan <fastq>[,<mate 2>] --input_type fastq [--bowtie2out <file>] ...: the profile goes to stdout.
+# Samples with BAD in their name fail.
+METAPHLAN = """#!/bin/bash
+echo "$1" | sed 's#[^,]*/##g' >> "$FAKE_CALLS"
+[[ "$1" == *BAD* ]] && exit 1
+args=("$@")
+for ((i=0;i<${#args[@]};i++)); do [[ "${args[$i]}" == --bowtie2out ]] && out=${args[$((i+1))]}; done
+if [[ -n "$out" ]]; then echo "bowtie2" > "$out"; else printf '#mpa_vJan21\\nk__Bacteria\\t100.0\\n'; fi
+"""
+
+
+def write_tool(directory, name, script):
+    path = directory / name
+    path.write_text(script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+def test_complete_fastq(tmp_path):
+    path = tmp_path / "SRR1.fastq"
+    path.write_bytes(RECORD * 3)
+    assert fastq_is_complete(str(path))
+
+
+def test_cut_fastq(tmp_path):
+    path = tmp_path / "SRR1.fastq"
+    whole = RECORD * 3
+    # cut in the middle of every line of the last record
+    for end in range(len(whole) - len(RECORD) + 1, len(whole)):
+        path.write_bytes(whole[:end])
+        assert not fastq_is_complete(str(path)), whole[:end]
+
+
+def test_empty_fastq(tmp_path):
+    path = tmp_path / "SRR1.fastq"
+    path.write_bytes(b"")
+    assert not fastq_is_complete(str(path))
+
+
+def test_quality_shorter_than_sequence(tmp_path):
+    path = tmp_path / "SRR1.fastq"
+    path.write_bytes(RECORD + b"@SRR1.2\nACGT\n+\nII\n")
+    assert not fastq_is_complete(str(path))
+
+
+def test_large_fastq_only_reads_its_end(tmp_path):
+    path = tmp_path / "SRR1.fastq"
+    path.write_bytes(RECORD * 5000)
+    assert fastq_is_complete(str(path))
+
+
+def test_accession_fastq_files(tmp_path):
+    for name in ("SRR1_1.fastq", "SRR1_2.fastq", "SRR10.fastq", "SRR1.sra"):
+        (tmp_path / name).write_bytes(RECORD)
+    assert accession_fastq_files(str(tmp_path), "SRR1") == [str(tmp_path / "SRR1_1.fastq"),
+                                                            str(tmp_path / "SRR1_2.fastq")]
+    assert accession_fastq_files(str(tmp_path), "SRR10") == [str(tmp_path / "SRR10.fastq")]
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    write_tool(bin_dir, "fasterq-dump", FASTERQ_DUMP)
+    write_tool(bin_dir, "metaphlan", METAPHLAN)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_CALLS", str(tmp_path / "calls"))
+    project = tmp_path / "project"
+    (project / "sra" / "SRR1").mkdir(parents=True)
+    (project / "sra" / "SRR1" / "SRR1.sra").write_bytes(b"sra")
+    (project / "fastq").mkdir()
+    return project
+
+
+def conversions(project):
+    calls = project.parent / "calls"
+    return calls.read_text().split() if calls.exists() else []
+
+
+def test_missing_mate_is_converted_again(project):
+    # fasterq-dump was interrupted after writing the whole _1 mate
+    (project / "fastq" / "SRR1_1.fastq").write_bytes(RECORD)
+    reads_data = sra_to_fastq(str(project), as_single=False)
+    assert conversions(project) == ["SRR1"]
+    assert reads_data.fwd and reads_data.rev
+    assert fastq_is_complete(str(project / "fastq" / "SRR1_2.fastq"))
+    assert not (project / "failed_conversions.txt").exists()
+
+
+def test_converted_accessions_are_skipped(project):
+    for mate in ("SRR1_1.fastq", "SRR1_2.fastq"):
+        (project / "fastq" / mate).write_bytes(RECORD)
+    reads_data = sra_to_fastq(str(project), as_single=False)
+    assert conversions(project) == []
+    assert reads_data.rev
+
+
+def test_single_reads_keep_only_the_first_mate(project):
+    # as_single deleted the _2 mates of the earlier run
+    (project / "fastq" / "SRR1_1.fastq").write_bytes(RECORD)
+    sra_to_fastq(str(project), as_single=True)
+    assert conversions(project) == []
+
+
+def test_fastq_files_complete_layout(tmp_path):
+    mate_1, mate_2 = str(tmp_path / "SRR1_1.fastq"), str(tmp_path / "SRR1_2.fastq")
+    for path in (mate_1, mate_2):
+        with open(path, "wb") as f:
+            f.write(RECORD)
+    assert fastq_files_complete([mate_1, mate_2], as_single=False)
+    assert not fastq_files_complete([mate_1], as_single=False)
+    assert not fastq_files_complete([mate_1], as_single=False, layout="PAIRED")
+    assert fastq_files_complete([mate_1], as_single=False, layout="SINGLE")
+    assert fastq_files_complete([mate_1], as_single=True)
+    assert not fastq_files_complete([mate_2], as_single=True)
+    assert not fastq_files_complete([], as_single=False)
+
+
+def test_update_forgets_the_project_stages(tmp_path, monkeypatch):
+    # --update: the project wide stages run again over all the samples, the samples already profiled are skipped
+    project = tmp_path / "project"
+    project.mkdir()
+    (tmp_path / "acc_list.txt").write_text("SRR1\nSRR2\n")
+    checkpoints = Checkpoints(str(project))
+    for step in ("prefetch", "conversion", "metaphlan", "metaphlan_csv", "metaphlan:SRR1"):
+        checkpoints.mark(step)
+    stages, downloads = {}, []
+    monkeypatch.setattr(create_visualization, "check_conda_qiime2", lambda: None)
+    monkeypatch.setattr(create_visualization, "run_stages",
+                        lambda run, **kwargs: stages.update((stage.name, stage) for stage in run))
+    monkeypatch.setattr(create_visualization, "download_data_from_sra",
+                        lambda dir_path, acc_list, **kwargs: downloads.append(kwargs["accessions"]))
+    visualization(str(tmp_path / "acc_list.txt"), "ds", "Shotgun", lambda *a, **k: None, str(tmp_path), False,
+                  dir_path=str(project), new_accessions=["SRR2"])
+    assert set(Checkpoints(str(project)).steps) == {"metaphlan:SRR1"}
+    assert list(stages) == ["prefetch", "conversion", "metadata", "metaphlan", "metaphlan_csv"]
+    # only the new accessions are downloaded
+    stages["prefetch"].func()
+    assert downloads == [["SRR2"]]
+
+
+@pytest.fixture
+def merged(monkeypatch):
+    # merge_profiles records the profiles it would merge
+    merges = []
+    monkeypatch.setattr(create_visualization, "merge_profiles",
+                        lambda dir_path, dataset_id: merges.append(sorted(os.listdir(os.path.join(dir_path, "qza")))))
+    return merges
+
+
+def profile_project(project, names):
+    (project / "qza").mkdir()
+    for name in names:
+        (project / "fastq" / name).write_bytes(RECORD)
+
+
+def test_metaphlan_extraction(project, merged):
+    profile_project(project, ["SRR1.fastq", "BAD1.fastq", "SRR2.fastq"])
+    reads_data = ReadsData(str(project), fwd=True, rev=False)
+    metaphlan_extraction(reads_data, "ds", threads=2, workers=2, checkpoints=Checkpoints(str(project)))
+    assert sorted(conversions(project)) == ["BAD1.fastq", "SRR1.fastq", "SRR2.fastq"]
+    assert (project / "qza" / "SRR1_profile.txt").read_text() == "#mpa_vJan21\nk__Bacteria\t100.0\n"
+    # the failed sample is reported, and leaves no profile behind for the merge
+    report = project / "export" / "ds_failed_samples.txt"
+    assert report.read_text().startswith("BAD1\tmetaphlan failed on BAD1")
+    assert merged == [["SRR1_profile.txt", "SRR2_profile.txt"]]
+    # the fastq of the profiled samples are deleted, the failed sample's are kept for its retry
+    assert sorted(os.listdir(project / "fastq")) == ["BAD1.fastq"]
+
+    # a resume only runs the failed sample again, and removes the report once it is profiled
+    os.rename(project / "fastq" / "BAD1.fastq", project / "fastq" / "SRR3.fastq")
+    metaphlan_extraction(reads_data, "ds", checkpoints=Checkpoints(str(project)))
+    assert conversions(project)[3:] == ["SRR3.fastq"]
+    assert not report.exists()
+
+
+def test_profiled_samples_are_skipped(project, merged):
+    profile_project(project, ["SRR1.fastq"])
+    reads_data = ReadsData(str(project), fwd=True, rev=False)
+    checkpoints = Checkpoints(str(project))
+    metaphlan_extraction(reads_data, "ds", checkpoints=checkpoints, keep_fastq=True)
+    metaphlan_extraction(reads_data, "ds", checkpoints=Checkpoints(str(project)), keep_fastq=True)
+    assert conversions(project) == ["SRR1.fastq"]
+    assert "metaphlan:SRR1" in checkpoints.steps
+    assert os.listdir(project / "fastq") == ["SRR1.fastq"]
+
+    # a profile that went missing is made again
+    os.remove(project / "qza" / "SRR1_profile.txt")
+    metaphlan_extraction(reads_data, "ds", checkpoints=Checkpoints(str(project)), keep_fastq=True)
+    assert conversions(project) == ["SRR1.fastq"] * 2
+
+
+def test_paired_fastq_are_kept(project, merged):
+    # HUMAnN still needs the mates
+    profile_project(project, ["SRR1_1.fastq", "SRR1_2.fastq"])
+    metaphlan_extraction(ReadsData(str(project), fwd=True, rev=True), "ds")
+    assert conversions(project) == ["SRR1_1.fastq,SRR1_2.fastq", "SRR1.bowtie2.bz2"]
+    assert (project / "qza" / "SRR1_profile.txt").exists()
+    assert sorted(os.listdir(project / "fastq")) == ["SRR1.bowtie2.bz2", "SRR1_1.fastq", "SRR1_2.fastq"]
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+pytest.importorskip("qiime2")
+pytest.importorskip("skbio")
+
+from yamas import dataset_downloading
+from yamas.dataset_downloading import update
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    # a BioProject downloaded with SRR1 and SRR2, which since gained SRR3 and SRR4
+    monkeypatch.chdir(tmp_path)
+    project = tmp_path / "ds-project"
+    project.mkdir()
+    (tmp_path / "PRJ1_acc_info.txt").write_text("SRR1\nSRR2\n")
+    (project / "metadata.json").write_text(json.dumps({
+        "dir_path": str(project), "dataset_id": "PRJ1", "type": "Shotgun",
+        "acc_list": str(tmp_path / "PRJ1_acc_info.txt"),
+        "run_info": str(tmp_path / "PRJ1_run_info.csv"), "as_single": False, "stream": False, "pathways": "no"}))
+    calls = {}
+
+    def get_acc_list(bio_project_name, verbose_print, cache=None, client=None):
+        calls["cache_ttl"] = cache.ttl
+        with open(f"{bio_project_name}_acc_info.txt", "w") as f:
+            f.write("SRR1\nSRR3\nSRR2\nSRR4\nSRR3\n")
+        return f"{bio_project_name}_acc_info.txt"
+
+    def visualization(acc_list, dataset_id, data_type, verbose_print, specific_location, as_single, **kwargs):
+        calls["visualization"] = (acc_list, dataset_id, kwargs)
+        return kwargs["dir_path"]
+
+    monkeypatch.setattr(dataset_downloading, "get_acc_list", get_acc_list)
+    monkeypatch.setattr(dataset_downloading, "visualization", visualization)
+    monkeypatch.setattr(dataset_downloading, "export_automatically",
+                        lambda *args, **kwargs: calls.setdefault("export", kwargs))
+    return project, calls
+
+
+def test_update_downloads_the_new_accessions(project):
+    project, calls = project
+    assert update(str(project), False, str(project.parent)) == str(project)
+    acc_list, dataset_id, kwargs = calls["visualization"]
+    assert kwargs["new_accessions"] == ["SRR3", "SRR4"]
+    assert kwargs["dir_path"] == str(project) and kwargs["run_info"] == "PRJ1_run_info.csv"
+    # the project's list holds the earlier accessions, then the new ones
+    assert acc_list == str(project / "acc_list.txt")
+    assert (project / "acc_list.txt").read_text() == "SRR1\nSRR2\nSRR3\nSRR4\n"
+    # the BioProject's run info is fetched again, not taken from the cache
+    assert calls["cache_ttl"] == 0
+    assert calls["export"]["incremental"]
+
+
+def test_update_without_new_accessions(project, monkeypatch):
+    project, calls = project
+    monkeypatch.setattr(dataset_downloading, "get_acc_list", lambda *args, **kwargs: "PRJ1_acc_info.txt")
+    assert update(str(project), False, str(project.parent)) == str(project)
+    assert "visualization" not in calls and not (project / "acc_list.txt").exists()
+
+
+def test_update_from_an_accession_list(project, monkeypatch):
+    project, calls = project
+    metadata = json.loads((project / "metadata.json").read_text())
+    metadata["run_info"] = str(project.parent / "PRJ1.csv")
+    (project / "metadata.json").write_text(json.dumps(metadata))
+    # the BioProject's run info can't tell which runs the list had
+    with pytest.raises(ValueError):
+        update(str(project), False, str(project.parent))
+
+    (project.parent / "current.txt").write_text("SRR2\nSRR5\n")
+    monkeypatch.setattr(dataset_downloading, "get_project_list", lambda dataset_id, acc_list, *args, **kwargs: acc_list)
+    update(str(project), False, str(project.parent), acc_list=str(project.parent / "current.txt"))
+    assert calls["visualization"][2]["new_accessions"] == ["SRR5"]
+    assert (project / "acc_list.txt").read_text() == "SRR1\nSRR2\nSRR5\n"
+
+
+def test_update_needs_metadata(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        update(str(tmp_path), False, str(tmp_path))
@@ -0,0 +1,83 @@
+import os
+import stat
+
+import pytest
+
+from yamas.entrez import EntrezClient, fetch_run_info, parse_runinfo
+
+HEADER = "Run,ReleaseDate,spots,size_MB,BioProject\n"
+
+
+def runinfo(*runs):
+    return HEADER + "".join(f"{run},2020-01-01,100,1,PRJNA1\n" for run in runs)
+
+
+class FakeClient:
+    # answers like efetch: the runs of the query it knows, in its own order
+    def __init__(self, known, fail=()):
+        self.known = known
+        self.fail = set(fail)
+        self.queries = []
+
+    def fetch_runinfo(self, query):
+        self.queries.append(query)
+        runs = query.split(" OR ")
+        if self.fail & set(runs):
+            raise RuntimeError("efetch failed")
+        return runinfo(*sorted(run for run in runs if run in self.known))
+
+
+def test_parse_runinfo_repeated_headers_and_blank_lines():
+    text = runinfo("SRR1", "SRR2") + "\n\n" + runinfo("SRR3") + ",,,,\n"
+    header, rows = parse_runinfo(text)
+    assert header == HEADER.strip().split(",")
+    assert [row["Run"] for row in rows] == ["SRR1", "SRR2", "SRR3"]
+    assert rows[2]["BioProject"] == "PRJNA1"
+
+
+def test_parse_runinfo_empty():
+    assert parse_runinfo("\n") == (None, [])
+
+
+def test_batches_and_dedup():
+    accessions = ["SRR5", "SRR1", "SRR4", "SRR1", "SRR3", "SRR2"]
+    client = FakeClient(set(accessions))
+    header, rows = fetch_run_info(accessions, client=client, batch_size=2, workers=2)
+    assert header[0] == "Run"
+    # every accession once, in accession list order
+    assert [row["Run"] for row in rows] == ["SRR5", "SRR1", "SRR4", "SRR3", "SRR2"]
+    assert sorted(client.queries) == sorted(["SRR5 OR SRR1", "SRR4 OR SRR3", "SRR2"])
+
+
+def test_failed_batch_raises():
+    client = FakeClient({"SRR1", "SRR2", "SRR3"}, fail={"SRR3"})
+    with pytest.raises(RuntimeError):
+        fetch_run_info(["SRR1", "SRR2", "SRR3"], client=client, batch_size=2)
+
+
+def test_missing_accessions_raise(capsys):
+    with pytest.raises(RuntimeError):
+        fetch_run_info(["SRR1", "SRR9"], client=FakeClient({"SRR1"}))
+    assert "SRR9" in capsys.readouterr().out
+
+
+def write_tool(directory, name, script):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write("#!/bin/bash\n" + script)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def test_client_fails_when_esearch_fails(tmp_path):
+    esearch = write_tool(tmp_path, "esearch", "exit 3\n")
+    efetch = write_tool(tmp_path, "efetch", "cat > /dev/null\n")
+    with pytest.raises(RuntimeError):
+        EntrezClient(esearch=esearch, efetch=efetch).fetch_runinfo("PRJNA1")
+
+
+def test_client_output(tmp_path):
+    esearch = write_tool(tmp_path, "esearch", "echo \"$4\"\n")
+    efetch = write_tool(tmp_path, "efetch", "read query; echo 'Run,BioProject'; echo \"SRR1,$query\"\n")
+    header, rows = parse_runinfo(EntrezClient(esearch=esearch, efetch=efetch).fetch_runinfo("PRJNA 1"))
+    assert rows == [{"Run": "SRR1", "BioProject": "PRJNA 1"}]
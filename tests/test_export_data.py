@@ -0,0 +1,218 @@
+import csv
+import json
+import os
+import pickle
+import shutil
+import time
+
+import pytest
+
+pytest.importorskip("qiime2")
+pytest.importorskip("skbio")
+
+from yamas import export_data
+from yamas.export_data import dada2_increment, dada2_samples, export, record_dada2_samples
+from yamas.utilities import ReadsData
+
+
+class FakeQiime:
+    # run_cmd of export_data: records the qiime commands, every --o-*/--output-path gets a file naming the
+    # command's action and its inputs
+    def __init__(self):
+        self.commands = []
+
+    def __call__(self, command, check=False, **kwargs):
+        self.commands.append(command)
+        inputs = [os.path.basename(arg) for previous, arg in zip(command, command[1:]) if previous.startswith("--i-")]
+        for flag, path in zip(command, command[1:]):
+            if flag.startswith("--o-") or flag == "--output-path":
+                with open(path, "w") as f:
+                    f.write(f"{command[1]} {' '.join(inputs)}")
+        return 0
+
+    def actions(self):
+        return [command[1] for command in self.commands]
+
+
+@pytest.fixture
+def qiime(monkeypatch):
+    fake = FakeQiime()
+    monkeypatch.setattr(export_data, "run_cmd", fake)
+
+    def qiime_import(reads_data, manifest_path=None, qza_file_path=None):
+        fake.commands.append(["qiime", "tools", "import", "--input-path", manifest_path,
+                              "--output-path", qza_file_path])
+        with open(qza_file_path, "w") as f:
+            f.write(open(manifest_path).read())
+        return qza_file_path
+
+    monkeypatch.setattr(export_data, "qiime_import", qiime_import)
+    return fake
+
+
+def write_project(directory, samples, recorded=None, trim="10", trunc="150"):
+    (directory / "qza").mkdir(parents=True, exist_ok=True)
+    with open(directory / "manifest.tsv", "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["SampleID", "absolute-filepath"])
+        writer.writerows([sample, f"/fastq/{sample}.fastq"] for sample in samples)
+    reads_data = ReadsData(str(directory), fwd=True, rev=False)
+    if recorded is not None:
+        for name in ("dada2_table.qza", "dada2_rep-seqs.qza"):
+            (directory / "qza" / name).write_text("earlier")
+        record_dada2_samples(reads_data, trim, trunc, recorded)
+    return reads_data
+
+
+def test_dada2_increment(tmp_path, qiime):
+    reads_data = write_project(tmp_path, ["S1", "S2", "S3", "S4"], recorded=["S1", "S2"])
+    dada2_increment(reads_data, threads=2)
+    assert qiime.actions() == ["tools", "dada2", "feature-table", "feature-table"]
+    update_dir = os.path.dirname(qiime.commands[0][-1])
+    # only the new samples are denoised, with the trim/trunc of the table
+    with open(os.path.join(update_dir, "manifest.tsv")) as f:
+        assert [row.split("\t")[0] for row in f.read().splitlines()] == ["SampleID", "S3", "S4"]
+    dada2 = qiime.commands[1]
+    assert dada2[dada2.index("--p-trim-left") + 1] == "10" and dada2[dada2.index("--p-trunc-len") + 1] == "150"
+    # the new table and sequences are merged into the project's
+    assert [command[2] for command in qiime.commands[2:]] == ["merge", "merge-seqs"]
+    assert qiime.commands[2][4:6] == [str(tmp_path / "qza" / "dada2_table.qza"),
+                                      os.path.join(update_dir, "dada2_table.qza")]
+    assert (tmp_path / "qza" / "dada2_table.qza").read_text().startswith("feature-table")
+    assert (tmp_path / "qza" / "dada2_rep-seqs.qza").read_text().startswith("feature-table")
+    assert not os.path.exists(os.path.join(update_dir, "demux.qza"))
+    assert dada2_samples(reads_data) == {"trim": "10", "trunc": "150", "samples": ["S1", "S2", "S3", "S4"]}
+
+
+def test_dada2_increment_without_new_samples(tmp_path, qiime):
+    reads_data = write_project(tmp_path, ["S1", "S2"], recorded=["S1", "S2"])
+    dada2_increment(reads_data)
+    assert qiime.commands == []
+
+
+def test_dada2_samples_need_the_table(tmp_path):
+    reads_data = write_project(tmp_path, ["S1"], recorded=["S1"])
+    os.remove(tmp_path / "qza" / "dada2_table.qza")
+    assert dada2_samples(reads_data) is None
+
+
+@pytest.fixture
+def export_stages(tmp_path, qiime, monkeypatch):
+    # export() up to its stages: returns the dada2 stage's function
+    stages = {}
+    monkeypatch.setattr(export_data, "check_conda_qiime2", lambda: None)
+    monkeypatch.setattr(export_data, "run_stages",
+                        lambda run, **kwargs: stages.update((stage.name, stage) for stage in run))
+    (tmp_path / "classifier.qza").write_text("classifier")
+
+    def run(reads_data, trim, trunc, incremental):
+        with open(tmp_path / "reads_data.pkl", "wb") as f:
+            pickle.dump(reads_data, f)
+        export(str(tmp_path), "16S", trim, trunc, str(tmp_path / "classifier.qza"), threads=2,
+               incremental=incremental)
+        return stages["dada2"]
+
+    return run
+
+
+def test_incremental_export(tmp_path, qiime, export_stages):
+    reads_data = write_project(tmp_path, ["S1", "S2", "S3"], recorded=["S1", "S2"])
+    stage = export_stages(reads_data, "auto", "auto", incremental=True)
+    assert stage.label == "dada2 (new samples)"
+    stage.func()
+    assert qiime.actions() == ["tools", "dada2", "feature-table", "feature-table"]
+
+
+def test_incremental_export_with_other_parameters(tmp_path, qiime, export_stages):
+    # the table was denoised with trunc 150: every sample is denoised again with 140
+    reads_data = write_project(tmp_path, ["S1", "S2", "S3"], recorded=["S1", "S2"])
+    stage = export_stages(reads_data, "10", "140", incremental=True)
+    assert stage.label == "dada2"
+    stage.func()
+    assert qiime.actions() == ["dada2"]
+    assert qiime.commands[0][qiime.commands[0].index("--i-demultiplexed-seqs") + 1] == \
+        str(tmp_path / "qza" / "demux-single-end.qza")
+    assert dada2_samples(reads_data) == {"trim": "10", "trunc": "140", "samples": ["S1", "S2", "S3"]}
+
+
+def test_incremental_export_without_a_table(tmp_path, qiime, export_stages):
+    reads_data = write_project(tmp_path, ["S1", "S2"])
+    stage = export_stages(reads_data, "10", "150", incremental=True)
+    stage.func()
+    assert qiime.actions() == ["dada2"]
+    assert json.loads((tmp_path / "qza" / "dada2_samples.json").read_text())["samples"] == ["S1", "S2"]
+
+
+# 7 sequences: 3 chunks of 3, 3 and 1 with 3 workers
+FASTA = "".join(f">feature{i} description\nACGT{'A' * i}\nTTGG\n" for i in range(7))
+
+
+@pytest.fixture
+def classifier(tmp_path, monkeypatch):
+    # qiime tools import/export copy the files, classify-sklearn names the taxon after the sequence.
+    # The first chunk is classified last.
+    classified = []
+
+    def run_cmd(command, check=False, **kwargs):
+        source, target = command[command.index("--input-path") + 1], command[command.index("--output-path") + 1]
+        if command[2] == "export":
+            os.makedirs(target, exist_ok=True)
+            name = "dna-sequences.fasta" if source.endswith("rep-seqs-dn-99.qza") else "taxonomy.tsv"
+            target = os.path.join(target, name)
+            if name == "dna-sequences.fasta":
+                with open(target, "w") as f:
+                    f.write(FASTA)
+                return 0
+        shutil.copyfile(source, target)
+        return 0
+
+    def classify_sklearn(reads_path, classifier_path, output_path, jobs, reads_per_batch=None, service_idle=None):
+        if reads_path.endswith("chunk_0.qza"):
+            time.sleep(0.3)
+        records = export_data.read_fasta(reads_path)
+        classified.append(len(records))
+        with open(output_path, "w") as f:
+            f.write("Feature ID\tTaxon\tConfidence\n")
+            for header, sequence in records:
+                f.write(f"{export_data.feature_id(header)}\tk__{''.join(sequence).split()[0]}\t0.9\n")
+
+    monkeypatch.setattr(export_data, "run_cmd", run_cmd)
+    monkeypatch.setattr(export_data, "classify_sklearn", classify_sklearn)
+    monkeypatch.setattr(export_data.taxonomy_cache, "cache", None)
+    return classified
+
+
+def classified_records(tmp_path, workers):
+    work_dir = tmp_path / f"workers_{workers}"
+    work_dir.mkdir()
+    (work_dir / "dna-sequences.fasta").write_text(FASTA)
+    records = export_data.read_fasta(str(work_dir / "dna-sequences.fasta"))
+    return export_data.classify_records(records, str(work_dir), "classifier.qza", workers)
+
+
+def test_classify_records_chunks(tmp_path, classifier):
+    single = classified_records(tmp_path, 1)
+    assert classifier == [7]
+    chunked = classified_records(tmp_path, 3)
+    assert sorted(classifier[1:]) == [1, 3, 3]
+    # the same taxonomy, in the order of the sequences, whichever chunk ended first
+    assert list(chunked.items()) == list(single.items())
+    assert list(chunked) == [f"feature{i}" for i in range(7)]
+    assert chunked["feature6"] == ("k__ACGTAAAAAA", "0.9")
+
+
+def test_classify_records_more_workers_than_sequences(tmp_path, classifier):
+    assert list(classified_records(tmp_path, 10).items()) == list(classified_records(tmp_path, 1).items())
+    assert classifier[:7] == [1] * 7
+
+
+def test_assign_taxonomy_in_chunks(tmp_path, classifier):
+    reads_data = write_project(tmp_path, ["S1"])
+    (tmp_path / "qza" / "rep-seqs-dn-99.qza").write_text("rep-seqs")
+    export_data.assign_taxonomy(reads_data, "16S", "classifier.qza", workers=3)
+    taxonomy = (tmp_path / "qza" / "gg-13-8-99-nb-classified.qza").read_text().splitlines()
+    assert taxonomy == ["Feature ID\tTaxon\tConfidence"] + \
+        [f"feature{i}\tk__ACGT{'A' * i}\t0.9" for i in range(7)]
+    assert sorted(classifier) == [1, 3, 3]
+    # the chunks are removed
+    assert not (tmp_path / "qza" / "classify_chunks").exists()
@@ -0,0 +1,182 @@
+import bz2
+import os
+import stat
+from pathlib import Path
+
+import pytest
+
+from yamas.checkpoints import Checkpoints
+from yamas.create_visualization import run_pathways_pipeline
+from yamas.generate_pathways import HUMANN_TABLES, completed_alignments, humann_alignments, humann_sample, \
+    join_humann_tables
+
+RECORD = "@r1\nACGT\n+\nIIII\n"
+
+# humann --input <file> --input-format <fastq|sam> --output <dir> --output-basename <sample> ...
+# A fastq input is aligned into <dir>/<sample>_humann_temp/<sample>_bowtie2_aligned.sam.
+# $FAKE_HUMANN=interrupt stops in the middle of the alignments, =translated fails after them, =no_tables writes
+# no table. Samples with BAD in their name fail.
+HUMANN = """#!/bin/bash
+args=("$@")
+for ((i=0;i<${#args[@]};i++)); do case "${args[$i]}" in
+  --output) out=${args[$((i+1))]};; --output-basename) base=${args[$((i+1))]};;
+  --input) in=${args[$((i+1))]};; --input-format) format=${args[$((i+1))]};; esac; done
+echo "$base $format $(basename $in)" >> "$FAKE_CALLS"
+cp "$in" "$FAKE_CALLS.$base.$format"
+[[ "$base" == *BAD* ]] && exit 1
+if [[ "$format" == fastq ]]; then
+  mkdir -p "$out/${base}_humann_temp"
+  echo "@HD" > "$out/${base}_humann_temp/${base}_bowtie2_aligned.sam"
+  if [[ "$FAKE_HUMANN" == interrupt ]]; then exit 137; fi
+  echo "r1 gene1" >> "$out/${base}_humann_temp/${base}_bowtie2_aligned.sam"
+  echo "Unaligned reads after nucleotide alignment: 50.0 %"
+fi
+if [[ "$FAKE_HUMANN" == translated ]]; then exit 1; fi
+if [[ "$FAKE_HUMANN" == no_tables ]]; then exit 0; fi
+for t in genefamilies pathabundance pathcoverage; do printf "# Gene\\t$base\\n" > "$out/${base}_$t.tsv"; done
+"""
+
+# humann_join_tables --input <dir> --output <file> --file_name <table> --search-subdirectories
+JOIN_TABLES = """#!/bin/bash
+args=("$@")
+for ((i=0;i<${#args[@]};i++)); do case "${args[$i]}" in
+  --output) out=${args[$((i+1))]};; --input) in=${args[$((i+1))]};; --file_name) name=${args[$((i+1))]};; esac; done
+find "$in" -name "*_$name.tsv" | sort > "$out"
+"""
+
+
+def write_tool(directory, name, script):
+    path = directory / name
+    path.write_text(script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    write_tool(bin_dir, "humann", HUMANN)
+    write_tool(bin_dir, "humann_join_tables", JOIN_TABLES)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_CALLS", str(tmp_path / "calls"))
+    monkeypatch.delenv("FAKE_HUMANN", raising=False)
+    project = tmp_path / "project"
+    (project / "fastq").mkdir(parents=True)
+    (project / "qza").mkdir()
+    (project / "fastq" / "SRR1.fastq").write_text(RECORD)
+    return project
+
+
+def calls(project):
+    path = project.parent / "calls"
+    return path.read_text().splitlines() if path.exists() else []
+
+
+def test_truncated_alignments_are_not_reused(project, monkeypatch):
+    output_dir = project / "humann_results"
+    sam_file = humann_alignments(output_dir, "SRR1")
+    monkeypatch.setenv("FAKE_HUMANN", "interrupt")
+    run_pathways_pipeline(project, "ds", threads=1, reuse_alignments=True)
+    assert not sam_file.exists() and completed_alignments(output_dir, "SRR1") is None
+
+    monkeypatch.delenv("FAKE_HUMANN")
+    run_pathways_pipeline(project, "ds", threads=1, reuse_alignments=True)
+    # the sample was aligned again from its fastq, and its alignments kept compressed
+    assert calls(project) == ["SRR1 fastq SRR1.fastq", "SRR1 fastq SRR1.fastq"]
+    assert completed_alignments(output_dir, "SRR1") == Path(f"{sam_file}.bz2")
+    assert bz2.decompress(Path(f"{sam_file}.bz2").read_bytes()) == b"@HD\nr1 gene1\n"
+    assert not sam_file.exists()
+
+
+def test_complete_alignments_are_reused(project, monkeypatch):
+    output_dir = project / "humann_results"
+    scratch = project.parent / "scratch"
+    monkeypatch.setenv("FAKE_HUMANN", "translated")
+    run_pathways_pipeline(project, "ds", threads=1, reuse_alignments=True, temp_dir=str(scratch))
+    assert not (output_dir / "SRR1" / "SRR1_pathabundance.tsv").exists()
+    assert completed_alignments(output_dir, "SRR1")
+
+    # the translated search fails again: the decompressed alignments are removed all the same
+    run_pathways_pipeline(project, "ds", threads=1, reuse_alignments=True, temp_dir=str(scratch))
+    assert os.listdir(scratch) == []
+
+    monkeypatch.delenv("FAKE_HUMANN")
+    run_pathways_pipeline(project, "ds", threads=1, reuse_alignments=True, temp_dir=str(scratch))
+    assert calls(project) == ["SRR1 fastq SRR1.fastq"] + ["SRR1 sam SRR1_bowtie2_aligned.sam"] * 2
+    assert (project.parent / "calls.SRR1.sam").read_text() == "@HD\nr1 gene1\n"
+    assert os.listdir(scratch) == []
+    assert completed_alignments(output_dir, "SRR1")
+    assert (project / "export" / "ds_pathabundance.tsv").read_text().split() == \
+        [str(output_dir / "SRR1" / "SRR1_pathabundance.tsv")]
+
+
+def test_alignments_are_left_alone_without_reuse(project):
+    # --pathways yes: HUMAnN's temp directory is left as it is
+    output_dir = project / "humann_results"
+    run_pathways_pipeline(project, "ds", threads=1)
+    assert humann_alignments(output_dir, "SRR1").exists()
+    assert completed_alignments(output_dir, "SRR1") is None
+
+
+def test_mates_are_profiled_together(project):
+    fastq_dir = project / "fastq"
+    (fastq_dir / "SRR2_1.fastq").write_text(RECORD)
+    (fastq_dir / "SRR2_2.fastq").write_text(RECORD.replace("r1", "r2"))
+    output_dir = project / "humann_results"
+    outputs = humann_sample("SRR2", [fastq_dir / "SRR2_1.fastq", fastq_dir / "SRR2_2.fastq"], output_dir, None,
+                            threads=1)
+    assert outputs == [output_dir / "SRR2" / f"SRR2_{table}.tsv" for table in HUMANN_TABLES]
+    assert calls(project) == ["SRR2 fastq SRR2.fastq"]
+    assert (project.parent / "calls.SRR2.fastq").read_text() == RECORD + RECORD.replace("r1", "r2")
+    # the concatenated mates are removed, the mates are left alone
+    assert not (output_dir / "SRR2" / "SRR2.fastq").exists()
+    assert (fastq_dir / "SRR2_1.fastq").exists() and (fastq_dir / "SRR2_2.fastq").exists()
+
+
+def test_concatenated_mates_are_removed_on_failure(project):
+    fastq_dir = project / "fastq"
+    for mate in ("BAD1_1.fastq", "BAD1_2.fastq"):
+        (fastq_dir / mate).write_text(RECORD)
+    with pytest.raises(Exception):
+        humann_sample("BAD1", [fastq_dir / "BAD1_1.fastq", fastq_dir / "BAD1_2.fastq"], project / "humann_results",
+                      None, threads=1)
+    assert not (project / "humann_results" / "BAD1" / "BAD1.fastq").exists()
+
+
+def test_missing_tables(project, monkeypatch):
+    monkeypatch.setenv("FAKE_HUMANN", "no_tables")
+    with pytest.raises(RuntimeError, match="did not write SRR1_genefamilies.tsv, SRR1_pathabundance.tsv"):
+        humann_sample("SRR1", [project / "fastq" / "SRR1.fastq"], project / "humann_results", None, threads=1)
+
+
+def test_join_humann_tables(project):
+    output_dir = project / "humann_results"
+    for sample in ("SRR3", "SRR1", "SRR2"):
+        (output_dir / sample).mkdir(parents=True)
+        for table in ("genefamilies", "pathcoverage"):
+            (output_dir / sample / f"{sample}_{table}.tsv").write_text("")
+    joined = join_humann_tables(output_dir, project / "export", "ds")
+    # in the order of HUMANN_TABLES, without the tables no sample has
+    assert joined == [project / "export" / "ds_genefamilies.tsv", project / "export" / "ds_pathcoverage.tsv"]
+    assert (project / "export" / "ds_genefamilies.tsv").read_text().split() == \
+        [str(output_dir / sample / f"{sample}_genefamilies.tsv") for sample in ("SRR1", "SRR2", "SRR3")]
+
+
+def test_per_sample_pool(project):
+    fastq_dir = project / "fastq"
+    for name in ("BAD2.fastq", "SRR2_1.fastq", "SRR2_2.fastq"):
+        (fastq_dir / name).write_text(RECORD)
+    # every sample runs with its own MetaPhlAn profile, if it has one
+    (project / "qza" / "SRR2_profile.txt").write_text("profile")
+    output_dir = project / "humann_results"
+    checkpoints = Checkpoints(str(project))
+    run_pathways_pipeline(project, "ds", threads=2, workers=2, checkpoints=checkpoints)
+    assert sorted(calls(project)) == ["BAD2 fastq BAD2.fastq", "SRR1 fastq SRR1.fastq", "SRR2 fastq SRR2.fastq"]
+    assert (output_dir / "failed_samples.txt").read_text().startswith("BAD2\t")
+    assert (project / "export" / "ds_pathabundance.tsv").read_text().split() == \
+        [str(output_dir / sample / f"{sample}_pathabundance.tsv") for sample in ("SRR1", "SRR2")]
+    assert "humann:SRR1" in checkpoints.steps and "humann:BAD2" not in checkpoints.steps
+
+    # a rerun only runs the failed sample
+    run_pathways_pipeline(project, "ds", threads=2, workers=2, checkpoints=Checkpoints(str(project)))
+    assert calls(project)[3:] == ["BAD2 fastq BAD2.fastq"]
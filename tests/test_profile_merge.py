@@ -0,0 +1,68 @@
+import io
+
+import pytest
+
+from yamas.profile_merge import merge_profiles_streaming, metaphlan_merge
+
+HEADERS = ("#mpa_vJun23_CHOCOPhlAnSGB_202403\n#/usr/bin/metaphlan sample.fastq --input_type fastq\n"
+           "#1000 reads processed\n#clade_name\tNCBI_tax_id\trelative_abundance\tadditional_species\n")
+
+
+def write_profile(directory, name, rows):
+    path = directory / f"{name}_profile.txt"
+    path.write_text(HEADERS + "".join(f"{clade}\t{taxid}\t{abundance}\t\n" for clade, taxid, abundance in rows))
+    return str(path)
+
+
+def merged(merger, paths):
+    out = io.StringIO()
+    merger(paths, out)
+    return out.getvalue()
+
+
+def assert_same_table(paths):
+    expected = merged(metaphlan_merge, paths)
+    assert expected
+    assert merged(merge_profiles_streaming, paths) == expected
+
+
+def test_unclassified_rows(tmp_path):
+    paths = [
+        write_profile(tmp_path, "SRR1", [("UNCLASSIFIED", "-1", "12.5"), ("k__Bacteria", "2", "87.5"),
+                                         ("k__Bacteria|p__Firmicutes", "2|1239", "87.5")]),
+        write_profile(tmp_path, "SRR2", [("k__Bacteria", "2", "100.0"),
+                                         ("k__Bacteria|p__Bacteroidetes", "2|976", "100.0")]),
+    ]
+    assert_same_table(paths)
+
+
+def test_differing_clade_orders(tmp_path):
+    paths = [
+        write_profile(tmp_path, "SRR1", [("k__Bacteria", "2", "60.0"), ("k__Archaea", "2157", "40.0"),
+                                         ("k__Bacteria|p__Firmicutes", "2|1239", "60.0")]),
+        # deeper clades first and the kingdoms in the other order: merge() sorts the rows by level
+        write_profile(tmp_path, "SRR2", [("k__Archaea|p__Euryarchaeota", "2157|28890", "0.001"),
+                                         ("k__Archaea", "2157", "30.0"), ("k__Bacteria", "2", "70.0")]),
+        write_profile(tmp_path, "SRR3", [("k__Eukaryota", "2759", "1e-05")]),
+    ]
+    assert_same_table(paths)
+
+
+def test_small_chunks(tmp_path):
+    paths = [write_profile(tmp_path, f"SRR{i}", [("k__Bacteria", "2", str(10.0 * i)),
+                                                 (f"k__Bacteria|p__{i}", f"2|{i}", "3.25")]) for i in range(5)]
+    out = io.StringIO()
+    merge_profiles_streaming(paths, out, chunk_cells=3)
+    assert out.getvalue() == merged(metaphlan_merge, paths)
+
+
+def test_empty_profile_falls_back_to_merge(tmp_path, capsys):
+    paths = [write_profile(tmp_path, "SRR1", [("k__Bacteria", "2", "100.0")]),
+             write_profile(tmp_path, "SRR2", [])]
+    assert_same_table(paths)
+    assert "merging the profiles with MetaPhlAn's merge" in capsys.readouterr().out
+
+
+def test_no_profiles():
+    with pytest.raises(ValueError):
+        merge_profiles_streaming([], io.StringIO())
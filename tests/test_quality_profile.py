@@ -0,0 +1,129 @@
+import gzip
+import random
+
+import numpy as np
+import pytest
+
+from yamas.quality_profile import MAX_QUALITY, QUANTILES, QualityProfile, fit_overlap, profile_fastq, \
+    recommend_direction
+
+
+def random_reads(count=300, seed=1):
+    rng = random.Random(seed)
+    reads = []
+    for i in range(count):
+        length = rng.randint(1, 60)
+        reads.append((f"r{i}", "".join(rng.choice("ACGT") for _ in range(length)),
+                      "".join(chr(33 + rng.randint(0, 41)) for _ in range(length))))
+    return reads
+
+
+def write_fastq(path, reads, opener=open):
+    with opener(path, 'wt') as f:
+        for name, sequence, quality in reads:
+            f.write(f"@{name}\n{sequence}\n+\n{quality}\n")
+
+
+def naive_quantiles(reads, quantiles=QUANTILES):
+    # the ceil(n * q)-th smallest score of every position
+    longest = max(len(quality) for _, _, quality in reads)
+    rows = []
+    for position in range(longest):
+        scores = sorted(ord(quality[position]) - 33 for _, _, quality in reads if len(quality) > position)
+        rows.append([scores[max(int(np.ceil(len(scores) * q)), 1) - 1] for q in quantiles])
+    return np.array(rows)
+
+
+def test_quantiles_match_naive_computation():
+    reads = random_reads()
+    profile = QualityProfile()
+    profile.add_qualities([quality.encode() for _, _, quality in reads])
+    assert (profile.quantiles() == naive_quantiles(reads)).all()
+    assert profile.counts()[0] == len(reads)
+    means = [np.mean([ord(q[0]) - 33 for _, _, q in reads])]
+    assert np.isclose(profile.means()[0], means[0])
+
+
+def test_merged_profiles_give_the_same_quantiles():
+    reads = random_reads()
+    whole, first, second = QualityProfile(), QualityProfile(), QualityProfile()
+    whole.add_qualities([quality.encode() for _, _, quality in reads])
+    first.add_qualities([quality.encode() for _, _, quality in reads[:100]])
+    second.add_qualities([quality.encode() for _, _, quality in reads[100:]])
+    merged = first.merge(second)
+    assert (merged.quantiles() == whole.quantiles()).all()
+    assert (merged.lengths == whole.lengths).all()
+
+
+def test_profile_fastq_chunks_and_gzip(tmp_path):
+    reads = random_reads()
+    write_fastq(tmp_path / "reads.fastq", reads)
+    write_fastq(tmp_path / "reads.fastq.gz", reads, opener=gzip.open)
+    expected = naive_quantiles(reads)
+    for path in ("reads.fastq", "reads.fastq.gz"):
+        # small chunks cut records in the middle
+        profile = profile_fastq(str(tmp_path / path), chunk_bytes=97)
+        assert profile.reads == profile.profiled_reads == len(reads)
+        assert (profile.quantiles() == expected).all()
+
+
+def test_subsample_counts_every_read(tmp_path):
+    reads = random_reads()
+    write_fastq(tmp_path / "reads.fastq", reads)
+    profile = profile_fastq(str(tmp_path / "reads.fastq"), subsample=0.3)
+    assert profile.reads == len(reads)
+    assert 0 < profile.profiled_reads < len(reads)
+
+
+def test_scores_are_clipped():
+    profile = QualityProfile()
+    profile.add_qualities([b" " + bytes([33 + MAX_QUALITY + 5])])
+    assert profile.quantiles()[:, 3].tolist() == [0, MAX_QUALITY]
+
+
+def direction(medians, counts=None):
+    return {"quantiles": {"50%": medians}, "count": counts or [100] * len(medians)}
+
+
+def test_recommend_direction():
+    # low first bases, a short dip that isn't truncated at, and a low end from position 100
+    medians = [20, 20] + [35] * 50 + [20] * 3 + [35] * 45 + [20] * 10
+    assert recommend_direction(direction(medians)) == {"trim": 2, "trunc": 100, "max_trunc": 110}
+
+
+def test_recommend_direction_keeps_most_reads():
+    # only half of the reads reach past position 80
+    medians = [35] * 110
+    assert recommend_direction(direction(medians, [100] * 80 + [50] * 30)) == \
+        {"trim": 0, "trunc": 80, "max_trunc": 80}
+
+
+def test_recommend_direction_low_quality_reads():
+    recommendation = recommend_direction(direction([10] * 50))
+    assert recommendation["trim"] == 20 and recommendation["trunc"] == 21
+
+
+def test_recommend_direction_without_reads():
+    with pytest.raises(ValueError):
+        recommend_direction(direction([]))
+
+
+def test_fit_overlap_lengthens_both_mates():
+    forward = {"trim": 0, "trunc": 100, "max_trunc": 150}
+    reverse = {"trim": 0, "trunc": 100, "max_trunc": 150}
+    assert fit_overlap(forward, reverse, 250) == 20
+    assert forward["trunc"] == reverse["trunc"] == 135
+
+
+def test_fit_overlap_limited_by_read_length():
+    forward = {"trim": 0, "trunc": 100, "max_trunc": 110}
+    reverse = {"trim": 0, "trunc": 100, "max_trunc": 150}
+    assert fit_overlap(forward, reverse, 250) == 10
+    assert (forward["trunc"], reverse["trunc"]) == (110, 150)
+
+
+def test_fit_overlap_already_overlapping():
+    forward = {"trim": 0, "trunc": 200, "max_trunc": 250}
+    reverse = {"trim": 0, "trunc": 180, "max_trunc": 250}
+    assert fit_overlap(forward, reverse, 300) == 80
+    assert (forward["trunc"], reverse["trunc"]) == (200, 180)
@@ -0,0 +1,95 @@
+import json
+import threading
+import time
+
+from yamas.resources import MemoryGate, tool_name
+
+
+def test_tool_name():
+    assert tool_name("metaphlan a.fastq --nproc 4") == "metaphlan"
+    assert tool_name("/opt/bin/humann --input x") == "humann"
+    assert tool_name("qiime feature-classifier classify-sklearn --i-reads x") == "classify-sklearn"
+    assert tool_name("") == ""
+
+
+def test_expected_memory(tmp_path):
+    history = tmp_path / "tool_memory.json"
+    history.write_text(json.dumps({"metaphlan": [5.0, 10.0]}))
+    gate = MemoryGate(memory_gb=64, tool_memory={"humann": 8}, history_path=str(history))
+    assert gate.expected_gb("humann") == 8
+    # the largest measured peak + 20%
+    assert gate.expected_gb("metaphlan") == 12
+    assert gate.expected_gb("classify-sklearn") == 32
+    assert gate.expected_gb("fasterq-dump") == 0
+
+
+def test_admit_and_release():
+    gate = MemoryGate(memory_gb=40)
+    first = gate.admit("metaphlan")
+    second = gate.admit("metaphlan")
+    assert first == second == 16 and gate.reserved == 32
+    admitted = threading.Event()
+
+    def third():
+        gate.release(gate.admit("metaphlan"))
+        admitted.set()
+
+    threading.Thread(target=third, daemon=True).start()
+    time.sleep(0.2)
+    # 48 GB would not fit in 40
+    assert not admitted.is_set()
+    gate.release(first)
+    assert admitted.wait(5)
+    gate.release(second)
+    assert gate.reserved == 0
+
+
+def test_alone_is_always_admitted():
+    gate = MemoryGate(memory_gb=4)
+    reserved = gate.admit("humann")
+    assert reserved == 32
+    gate.release(reserved)
+
+
+def test_untracked_tools_pass():
+    gate = MemoryGate(memory_gb=1)
+    gate.admit("humann")
+    assert gate.admit("fasterq-dump") == 0
+
+
+def test_cancelled_wait():
+    gate = MemoryGate(memory_gb=20)
+    gate.admit("metaphlan")
+    cancelled = threading.Event()
+    cancelled.set()
+    assert gate.admit("metaphlan", cancelled) == 0
+    assert gate.reserved == 16
+
+
+def test_record(tmp_path):
+    history = tmp_path / "cache" / "tool_memory.json"
+    gate = MemoryGate(history_path=str(history))
+    for peak in range(25):
+        gate.record("metaphlan", peak)
+    assert json.loads(history.read_text())["metaphlan"] == list(range(5, 25))
+    assert MemoryGate(history_path=str(history)).expected_gb("metaphlan") == 28.8
+
+
+def test_record_only_tools_with_a_requirement(tmp_path):
+    history = tmp_path / "tool_memory.json"
+    gate = MemoryGate(tool_memory={"vsearch": 4}, history_path=str(history))
+    for tool in ("rm", "bash", "export", "vsearch", "humann"):
+        gate.record(tool, 1.5)
+    assert json.loads(history.read_text()) == {"vsearch": [1.5], "humann": [1.5]}
+
+
+def test_record_merges_concurrent_runs(tmp_path):
+    # two runs started with the same history, each records its own peaks
+    history = tmp_path / "tool_memory.json"
+    history.write_text(json.dumps({"humann": [10.0]}))
+    first, second = MemoryGate(history_path=str(history)), MemoryGate(history_path=str(history))
+    first.record("humann", 20)
+    second.record("metaphlan", 5)
+    second.record("humann", 30)
+    assert json.loads(history.read_text()) == {"humann": [10.0, 20, 30], "metaphlan": [5]}
+    assert second.expected_gb("humann") == 36
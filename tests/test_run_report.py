@@ -0,0 +1,78 @@
+import json
+import os
+import resource
+import threading
+
+from yamas.run_report import RunReport, current_stage, record_command, stage_log_path
+
+
+def runs(tmp_path):
+    return json.loads((tmp_path / "run_report.json").read_text())["runs"]
+
+
+def test_runs_are_appended(tmp_path):
+    first = RunReport(tmp_path, "download")
+    first.start_stage("prefetch", "prefetch")
+    first.finish_stage("prefetch", "done", 2.5)
+    first.write()
+    second = RunReport(tmp_path, "continue")
+    second.started = first.started + 1
+    second.write()
+    assert [run["flow"] for run in runs(tmp_path)] == ["download", "continue"]
+    assert runs(tmp_path)[0]["stages"][0]["status"] == "done"
+
+    # writing a run again, after its next stage, replaces it
+    second.start_stage("metaphlan", "metaphlan")
+    second.write()
+    assert [run["flow"] for run in runs(tmp_path)] == ["download", "continue"]
+    assert [stage["name"] for stage in runs(tmp_path)[1]["stages"]] == ["metaphlan"]
+
+
+def test_commands_add_up_in_their_stage(tmp_path):
+    report = RunReport(tmp_path, "download")
+    report.start_stage("conversion", "conversion")
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    report.add_command("conversion", "fasterq-dump SRR1", 0, 1.0, usage)
+    report.add_command("conversion", "fasterq-dump SRR2", 1, 2.0)
+    # a command of a stage that isn't in the report is only listed
+    report.add_command("other", "true", 0, 0.1)
+    stage = report.as_dict()["stages"][0]
+    assert stage["commands"] == 2
+    assert stage["user_s"] == round(usage.ru_utime, 3)
+    assert stage["peak_rss_mb"] == round(usage.ru_maxrss / 1024, 1)
+    assert [command["exit_code"] for command in report.as_dict()["commands"]] == [0, 1, 0]
+
+
+def test_summary(tmp_path):
+    report = RunReport(tmp_path, "download")
+    report.start_stage("prefetch", "download the sra files")
+    report.finish_stage("prefetch", "done", 3725)
+    report.start_stage("conversion", "")
+    lines = report.summary().splitlines()
+    assert lines[0].split() == ["stage", "status", "wall", "user", "sys", "peak", "RSS", "read", "written"]
+    assert set(lines[1]) == {"-", " "}
+    assert lines[2].startswith("download the sra files  done     1:02:05")
+    # a stage without a label is named after itself
+    assert lines[3].split()[:2] == ["conversion", "running"]
+    # the columns line up
+    assert lines[0].index("status") == lines[2].index("done") == lines[3].index("running")
+
+
+def test_commands_are_charged_to_the_current_stage(tmp_path):
+    report = RunReport(tmp_path, "download")
+    report.start_stage("prefetch", "prefetch")
+    record_command("outside", 0, 0.1)
+    assert stage_log_path() is None
+
+    def stage():
+        current_stage.set((report, "prefetch"))
+        record_command("prefetch SRR1", 0, 0.5)
+        assert stage_log_path() == os.path.join(str(tmp_path), "logs", "prefetch.log")
+
+    # the stage runs in its own thread, like in run_stages
+    thread = threading.Thread(target=stage)
+    thread.start()
+    thread.join()
+    assert [command["command"] for command in report.commands] == ["prefetch SRR1"]
+    assert report.stages["prefetch"]["commands"] == 1
+    assert current_stage.get() is None
@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+from yamas.runinfo_cache import RunInfoCache
+
+
+def row(run, project="PRJNA1"):
+    return {"Run": run, "spots": "100", "BioProject": project}
+
+
+def test_runs(tmp_path):
+    cache = RunInfoCache(str(tmp_path / "run_info.sqlite"))
+    cache.put_runs([row("SRR1"), row("SRR2")])
+    assert cache.get_runs(["SRR1", "SRR3"]) == {"SRR1": row("SRR1")}
+    # runs cached on their own aren't a whole project
+    assert cache.get_project("PRJNA1") is None
+
+
+def test_project_keeps_its_runs_and_order(tmp_path):
+    cache = RunInfoCache(str(tmp_path / "run_info.sqlite"))
+    # fetched with the user's id, the rows name the project by another one
+    cache.put_runs([row("SRR2"), row("SRR1")], bioproject="SRP1")
+    cache.put_runs([row("SRR1", project="PRJNA1")])
+    cache.put_runs([row("SRR1"), row("SRR3")], bioproject="PRJNA1")
+    assert [r["Run"] for r in cache.get_project("SRP1")] == ["SRR2", "SRR1"]
+    assert [r["Run"] for r in cache.get_project("PRJNA1")] == ["SRR1", "SRR3"]
+    # read back from disk
+    cache.close()
+    assert [r["Run"] for r in RunInfoCache(str(tmp_path / "run_info.sqlite")).get_project("SRP1")] == ["SRR2", "SRR1"]
+
+
+def test_empty_project_is_not_cached(tmp_path):
+    cache = RunInfoCache(str(tmp_path / "run_info.sqlite"))
+    with pytest.raises(ValueError):
+        cache.put_runs([], bioproject="PRJNA1")
+    assert cache.get_project("PRJNA1") is None
+
+
+def test_ttl_and_offline(tmp_path):
+    path = str(tmp_path / "run_info.sqlite")
+    cache = RunInfoCache(path, ttl_days=1)
+    cache.put_runs([row("SRR1")], bioproject="PRJNA1")
+    with cache._db:
+        cache._db.execute("UPDATE runs SET fetched_at = ?", (time.time() - 2 * 24 * 3600,))
+        cache._db.execute("UPDATE projects SET fetched_at = ?", (time.time() - 2 * 24 * 3600,))
+    assert cache.get_runs(["SRR1"]) == {}
+    assert cache.get_project("PRJNA1") is None
+    offline = RunInfoCache(path, ttl_days=1, offline=True)
+    assert offline.get_runs(["SRR1"]) == {"SRR1": row("SRR1")}
+    assert offline.get_project("PRJNA1") == [row("SRR1")]
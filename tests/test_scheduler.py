@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+from yamas import scheduler
+from yamas.checkpoints import Checkpoints
+from yamas.resources import granted_threads, tool_threads
+from yamas.scheduler import Stage, record_failures, run_stages
+from yamas.utilities import run_cmd
+
+
+def quiet(*args):
+    pass
+
+
+def test_stage_with_failures_is_not_checkpointed(tmp_path):
+    checkpoints = Checkpoints(tmp_path)
+    calls, attempts = [], []
+
+    def prefetch():
+        calls.append("prefetch")
+        attempts.append(1)
+        if len(attempts) == 1:
+            record_failures({"SRR2": RuntimeError("prefetch failed")})
+
+    stages = [Stage("prefetch", prefetch), Stage("conversion", lambda: calls.append("conversion"), after=("prefetch",)),
+              Stage("other", lambda: calls.append("other"))]
+    run_stages(stages, log=quiet, checkpoints=checkpoints)
+    assert sorted(calls) == ["conversion", "other", "prefetch"]
+    # the stage after the incomplete one only had part of its items, the independent one is done
+    assert not checkpoints.done("prefetch") and not checkpoints.done("conversion")
+    assert checkpoints.done("other")
+
+    calls.clear()
+    run_stages(stages, log=quiet, checkpoints=checkpoints)
+    assert sorted(calls) == ["conversion", "prefetch"]
+    assert checkpoints.done("prefetch") and checkpoints.done("conversion")
+
+
+@pytest.fixture
+def four_cpus(monkeypatch):
+    monkeypatch.setattr(scheduler, "thread_budget", lambda threads=None: min(int(threads), 4) if threads else 4)
+
+
+def test_dependency_order():
+    order = []
+    lock = threading.Lock()
+
+    def step(name):
+        def func():
+            time.sleep(0.01)
+            with lock:
+                order.append(name)
+        return func
+
+    stages = [Stage("d", step("d"), after=("b", "c")), Stage("b", step("b"), after=("a",)),
+              Stage("c", step("c"), after=("a",)), Stage("a", step("a"))]
+    run_stages(stages, log=quiet)
+    assert order[0] == "a" and order[-1] == "d" and sorted(order[1:3]) == ["b", "c"]
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        run_stages([Stage("a", lambda: None, after=("missing",))], log=quiet)
+
+
+def test_dependency_cycle():
+    with pytest.raises(ValueError):
+        run_stages([Stage("a", lambda: None, after=("b",)), Stage("b", lambda: None, after=("a",))], log=quiet)
+
+
+def test_thread_grants(four_cpus):
+    granted = {}
+
+    def record(name):
+        def func():
+            granted[name] = (granted_threads.get(), tool_threads(2))
+        return func
+
+    # more than the whole budget gets the whole budget
+    run_stages([Stage("big", record("big"), threads=16), Stage("small", record("small"), threads=2)],
+               log=quiet, threads=8)
+    assert granted == {"big": (4, 2), "small": (2, 1)}
+
+
+def test_stages_share_the_budget(four_cpus):
+    running, overlaps = [], []
+    lock = threading.Lock()
+
+    def step(name):
+        def func():
+            with lock:
+                running.append(name)
+                overlaps.append(set(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(name)
+        return func
+
+    # 2 + 2 threads fit together in 4, 3 + 3 don't
+    run_stages([Stage("a", step("a"), threads=2), Stage("b", step("b"), threads=2)], log=quiet, threads=4)
+    assert {"a", "b"} in overlaps
+    overlaps.clear()
+    run_stages([Stage("a", step("a"), threads=3), Stage("b", step("b"), threads=3)], log=quiet, threads=4)
+    assert all(len(names) == 1 for names in overlaps)
+
+
+def test_error_propagation(tmp_path, four_cpus):
+    checkpoints = Checkpoints(tmp_path)
+    calls = []
+
+    def fail():
+        raise RuntimeError("stage failed")
+
+    stages = [Stage("a", fail), Stage("b", lambda: calls.append("b"), after=("a",)),
+              Stage("c", lambda: (time.sleep(0.05), calls.append("c")))]
+    with pytest.raises(RuntimeError, match="stage failed"):
+        run_stages(stages, log=quiet, checkpoints=checkpoints)
+    # the stage after the failed one never starts, the running independent one finishes
+    assert calls == ["c"]
+    assert not checkpoints.done("a") and checkpoints.done("c")
+
+
+def test_failure_cancels_running_commands(four_cpus):
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        run_cmd(["sleep", "30"], check=True)
+
+    def fail():
+        started.wait(5)
+        time.sleep(0.1)
+        raise RuntimeError("stage failed")
+
+    begin = time.time()
+    with pytest.raises(RuntimeError, match="stage failed"):
+        run_stages([Stage("slow", slow), Stage("fail", fail)], log=quiet, threads=2)
+    assert time.time() - begin < 10
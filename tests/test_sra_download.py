@@ -0,0 +1,107 @@
+import os
+import stat
+
+import pytest
+
+from yamas.sra_download import DownloadLedger, download_accessions, fetch_accession, verify_sra
+
+# prefetch <acc> --output-directory <dir> --max-size 100G: writes <dir>/<acc>/<acc>.sra of $FAKE_SIZE_MB MB,
+# fails for accessions containing BAD, and for FLAKY ones on their first call
+PREFETCH = """#!/bin/bash
+echo "$1" >> "$FAKE_CALLS"
+case "$1" in *BAD*) exit 1;; esac
+if [[ "$1" == FLAKY* && ! -f "$FAKE_CALLS.$1" ]]; then touch "$FAKE_CALLS.$1"; exit 2; fi
+mkdir -p "$3/$1" && head -c $(( ${FAKE_SIZE_MB:-2} * 1048576 )) /dev/zero > "$3/$1/$1.sra"
+"""
+
+# fails for files containing CORRUPT
+VDB_VALIDATE = """#!/bin/bash
+case "$1" in *CORRUPT*) exit 3;; esac
+"""
+
+
+def write_tool(directory, name, script):
+    path = directory / name
+    path.write_text(script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+@pytest.fixture
+def fake_tools(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    write_tool(bin_dir, "prefetch", PREFETCH)
+    write_tool(bin_dir, "vdb-validate", VDB_VALIDATE)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_CALLS", str(tmp_path / "calls"))
+    project = tmp_path / "project"
+    project.mkdir()
+    return project, tmp_path / "calls"
+
+
+def calls(calls_path):
+    return calls_path.read_text().split() if calls_path.exists() else []
+
+
+def test_download_and_ledger(fake_tools):
+    project, calls_path = fake_tools
+    sra_path = fetch_accession(str(project), "SRR1", {"Run": "SRR1", "size_MB": "2"}, DownloadLedger(str(project)))
+    assert os.path.getsize(sra_path) == 2 * 2 ** 20
+    ledger = DownloadLedger(str(project))
+    assert ledger.is_done("SRR1") and ledger.entries["SRR1"]["attempts"] == 1
+    # done accessions aren't fetched again
+    assert fetch_accession(str(project), "SRR1", ledger=ledger) == sra_path
+    assert calls(calls_path) == ["SRR1"]
+
+
+def test_retry(fake_tools):
+    project, calls_path = fake_tools
+    ledger = DownloadLedger(str(project))
+    fetch_accession(str(project), "FLAKY1", ledger=ledger, backoff=0)
+    assert calls(calls_path) == ["FLAKY1", "FLAKY1"]
+    assert ledger.entries["FLAKY1"]["status"] == "done" and ledger.entries["FLAKY1"]["attempts"] == 2
+
+
+def test_failure_after_retries(fake_tools):
+    project, calls_path = fake_tools
+    ledger = DownloadLedger(str(project))
+    with pytest.raises(RuntimeError):
+        fetch_accession(str(project), "BAD1", ledger=ledger, retries=2, backoff=0)
+    assert calls(calls_path) == ["BAD1", "BAD1"]
+    assert ledger.entries["BAD1"]["status"] == "failed" and ledger.entries["BAD1"]["attempts"] == 2
+    assert not ledger.is_done("BAD1")
+
+
+def test_size_verification(fake_tools):
+    project, _ = fake_tools
+    ledger = DownloadLedger(str(project))
+    with pytest.raises(ValueError):
+        fetch_accession(str(project), "SRR1", {"Run": "SRR1", "size_MB": "10"}, ledger, retries=1, backoff=0)
+    assert "run info says 10MB" in ledger.entries["SRR1"]["error"]
+    # the failed download is removed
+    assert not os.path.exists(project / "sra" / "SRR1")
+
+
+def test_size_tolerance(tmp_path):
+    sra_path = tmp_path / "SRR1.sra"
+    sra_path.write_bytes(b"\0" * (2 ** 20 + 2 ** 19))
+    # 1.5MB, reported as 1 or 2 MB
+    verify_sra(str(sra_path), {"size_MB": "1"}, vdb_validate="no-such-tool")
+    verify_sra(str(sra_path), {"size_MB": "2"}, vdb_validate="no-such-tool")
+    with pytest.raises(ValueError):
+        verify_sra(str(sra_path), {"size_MB": "4"}, vdb_validate="no-such-tool")
+
+
+def test_vdb_validate(fake_tools):
+    project, _ = fake_tools
+    with pytest.raises(ValueError):
+        fetch_accession(str(project), "CORRUPT1", retries=1, backoff=0)
+
+
+def test_download_accessions_reports_failures(fake_tools):
+    project, calls_path = fake_tools
+    failures = download_accessions(str(project), ["SRR1", "BAD1", "SRR2"], workers=2, retries=1, backoff=0)
+    assert list(failures) == ["BAD1"]
+    # a rerun only fetches what failed
+    download_accessions(str(project), ["SRR1", "BAD1", "SRR2"], workers=2, retries=1, backoff=0)
+    assert sorted(calls(calls_path)) == ["BAD1", "BAD1", "SRR1", "SRR2"]
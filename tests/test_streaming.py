@@ -0,0 +1,117 @@
+import os
+import threading
+
+import pytest
+
+from yamas import streaming
+from yamas.streaming import stream_accessions
+
+# accessions containing DL fail to download, CONV to convert (leaving a partial fastq) and PROF to profile
+ACCESSIONS = ["SRR1", "DL1", "SRR2P", "CONV1", "PROF1", "SRR3", "DL2", "PROF2P", "CONV2P", "SRR4", "PROF3"]
+
+
+class TrackedSemaphore(threading.BoundedSemaphore):
+    instances = []
+
+    def __init__(self, value=1):
+        super().__init__(value)
+        self.initial = value
+        self.acquired = 0
+        TrackedSemaphore.instances.append(self)
+
+    def acquire(self, *args, **kwargs):
+        self.acquired += 1
+        return super().acquire(*args, **kwargs)
+
+
+@pytest.fixture
+def stubs(tmp_path, monkeypatch):
+    project = tmp_path / "project"
+    for name in ("sra", "fastq", "qza"):
+        (project / name).mkdir(parents=True)
+    profiled = []
+
+    def fetch_accession(dir_path, acc, run_info_row=None, ledger=None, store=None):
+        if "DL" in acc:
+            raise RuntimeError(f"prefetch failed on {acc}")
+        os.makedirs(os.path.join(dir_path, "sra", acc))
+        sra_path = os.path.join(dir_path, "sra", acc, f"{acc}.sra")
+        open(sra_path, "w").close()
+        return sra_path
+
+    def fastq_dump_accession(dir_path, sra_path, threads=None, temp_dir=None):
+        acc = os.path.basename(sra_path)[:-len(".sra")]
+        names = [f"{acc}_1.fastq", f"{acc}_2.fastq"] if acc.endswith("P") else [f"{acc}.fastq"]
+        fastq_files = [os.path.join(dir_path, "fastq", name) for name in names]
+        for fastq in fastq_files:
+            with open(fastq, "w") as f:
+                f.write("@r1\nACGT\n+\nIIII\n")
+        if "CONV" in acc:
+            raise RuntimeError(f"fasterq-dump failed on {acc}")
+        return fastq_files
+
+    def metaphlan_sample(fastq_files, sample_name, dir_path, nproc=None):
+        if "PROF" in sample_name:
+            raise RuntimeError(f"metaphlan failed on {sample_name}")
+        profiled.append(sample_name)
+        open(os.path.join(dir_path, "qza", f"{sample_name}_profile.txt"), "w").close()
+
+    TrackedSemaphore.instances = []
+    monkeypatch.setattr(streaming, "fetch_accession", fetch_accession)
+    monkeypatch.setattr(streaming, "fastq_dump_accession", fastq_dump_accession)
+    monkeypatch.setattr(streaming, "metaphlan_sample", metaphlan_sample)
+    monkeypatch.setattr(streaming, "merge_profiles", lambda dir_path, dataset_id: None)
+    monkeypatch.setattr(streaming.threading, "BoundedSemaphore", TrackedSemaphore)
+    return project, profiled
+
+
+def stream(project, data_type, **kwargs):
+    result = {}
+
+    def run():
+        result["reads_data"] = stream_accessions(str(project), ACCESSIONS, "ds", data_type, as_single=False,
+                                                 threads=2, max_in_flight=2, **kwargs)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "the stream hangs"
+    return result["reads_data"]
+
+
+def failed_samples(project):
+    with open(project / "export" / "ds_failed_samples.txt") as report:
+        return sorted(line.split("\t")[0] for line in report)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_shotgun_stream_with_failures(stubs, workers):
+    project, profiled = stubs
+    reads_data = stream(project, "Shotgun", workers=workers)
+    assert failed_samples(project) == ["CONV1", "CONV2P", "DL1", "DL2", "PROF1", "PROF2P", "PROF3"]
+    assert sorted(profiled) == ["SRR1", "SRR2P", "SRR3", "SRR4"]
+    # every accession released its in-flight slot
+    in_flight, = TrackedSemaphore.instances
+    assert in_flight.acquired == len(ACCESSIONS) and in_flight._value == in_flight.initial
+    # the intermediates are gone, of the failed accessions too
+    assert os.listdir(project / "fastq") == [] and os.listdir(project / "sra") == []
+    assert reads_data.rev
+
+
+def test_keep_fastq(stubs):
+    project, profiled = stubs
+    stream(project, "Shotgun", keep_fastq=True)
+    assert sorted(os.listdir(project / "fastq")) == ["SRR1.fastq", "SRR2P_1.fastq", "SRR2P_2.fastq", "SRR3.fastq",
+                                                     "SRR4.fastq"]
+
+
+def test_16s_stream_with_failures(stubs):
+    project, profiled = stubs
+    stream(project, "16S")
+    assert failed_samples(project) == ["CONV1", "CONV2P", "DL1", "DL2"]
+    assert profiled == []
+    in_flight, = TrackedSemaphore.instances
+    assert in_flight._value == in_flight.initial
+    # the fastq files go to the manifest, the partial ones of the failed conversions are gone
+    assert len(os.listdir(project / "fastq")) == 9
+    assert not [name for name in os.listdir(project / "fastq") if name.startswith("CONV")]
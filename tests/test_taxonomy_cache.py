@@ -0,0 +1,36 @@
+import hashlib
+import os
+
+from yamas.taxonomy_cache import TaxonomyCache, configure_taxonomy_cache, sequence_md5
+
+
+def test_sequence_md5_is_dada2_feature_id():
+    assert sequence_md5("ACGTTGCA") == hashlib.md5(b"ACGTTGCA").hexdigest()
+    # wrapped fasta lines, surrounding whitespace and lower case
+    assert sequence_md5("acgt\nTGCA\n") == sequence_md5(" ACGT\r\nTGCA") == sequence_md5("ACGTTGCA")
+
+
+def test_get_and_put(tmp_path):
+    cache = TaxonomyCache(str(tmp_path / "cache" / "taxonomy.sqlite"))
+    cache.put("classifier-a", {"md5-1": ("k__Bacteria", "0.99"), "md5-2": ("k__Archaea", "0.8")})
+    assert cache.get("classifier-a", ["md5-1", "md5-3", "md5-1"]) == {"md5-1": ("k__Bacteria", "0.99")}
+    # another classifier classifies them again
+    assert cache.get("classifier-b", ["md5-1"]) == {}
+    cache.close()
+    assert TaxonomyCache(str(tmp_path / "cache" / "taxonomy.sqlite")).get("classifier-a", ["md5-2"]) == \
+        {"md5-2": ("k__Archaea", "0.8")}
+
+
+def test_classifier_digest(tmp_path):
+    classifier = tmp_path / "classifier.qza"
+    classifier.write_bytes(b"one")
+    cache = TaxonomyCache(str(tmp_path / "taxonomy.sqlite"))
+    assert cache.classifier_digest(str(classifier)) == hashlib.sha256(b"one").hexdigest()
+    classifier.write_bytes(b"other")
+    os.utime(classifier, ns=(1, 1))
+    assert cache.classifier_digest(str(classifier)) == hashlib.sha256(b"other").hexdigest()
+
+
+def test_configure(tmp_path):
+    assert configure_taxonomy_cache(str(tmp_path)).path == str(tmp_path / "taxonomy.sqlite")
+    assert configure_taxonomy_cache(None) is None
@@ -0,0 +1,166 @@
+import contextvars
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from yamas import resources
+from yamas.resources import MemoryGate
+from yamas.run_report import RunReport, current_stage
+from yamas.utilities import CancelScope, CommandError, cancel_scope, cmd_output, fastq_sample_index, run_cmd, \
+    run_in_pool, start_cmd
+
+
+def touch(directory, *names):
+    for name in names:
+        (directory / name).write_text("")
+
+
+def test_mates_go_together(tmp_path):
+    touch(tmp_path, "SRR2_2.fastq", "SRR2_1.fastq", "SRR1.fastq", "SRR10_1.fastq", "SRR10_2.fastq")
+    index = fastq_sample_index(str(tmp_path))
+    assert list(index) == ["SRR1", "SRR10", "SRR2"]
+    assert index["SRR2"] == [str(tmp_path / "SRR2_1.fastq"), str(tmp_path / "SRR2_2.fastq")]
+    assert index["SRR1"] == [str(tmp_path / "SRR1.fastq")]
+
+
+def test_unpaired_reads_next_to_mates_are_left_out(tmp_path):
+    # fasterq-dump --split-3 writes the reads without a mate to <acc>.fastq
+    touch(tmp_path, "SRR1.fastq", "SRR1_1.fastq", "SRR1_2.fastq")
+    assert fastq_sample_index(str(tmp_path)) == {"SRR1": [str(tmp_path / "SRR1_1.fastq"),
+                                                          str(tmp_path / "SRR1_2.fastq")]}
+
+
+def test_names_with_underscores(tmp_path):
+    touch(tmp_path, "sample_A_1.fastq", "sample_A_2.fastq", "sample_B.fastq", "sample_3.fastq")
+    index = fastq_sample_index(str(tmp_path))
+    assert index["sample_A"] == [str(tmp_path / "sample_A_1.fastq"), str(tmp_path / "sample_A_2.fastq")]
+    assert index["sample_B"] == [str(tmp_path / "sample_B.fastq")]
+    # only _1/_2 are mates
+    assert index["sample_3"] == [str(tmp_path / "sample_3.fastq")]
+
+
+def test_other_files_are_ignored(tmp_path):
+    touch(tmp_path, "SRR1.fastq", "SRR1.bowtie2.bz2", "SRR1.fastq.gz", "notes.txt")
+    os.mkdir(tmp_path / "SRR2.fastq")
+    assert fastq_sample_index(str(tmp_path)) == {"SRR1": [str(tmp_path / "SRR1.fastq")]}
+    assert fastq_sample_index(str(tmp_path / "missing")) == {}
+
+
+def test_run_in_pool_reports_failures():
+    done = []
+
+    def work(item):
+        if item % 3 == 0:
+            raise ValueError(item)
+        done.append(item)
+
+    failures = run_in_pool(work, list(range(7)), workers=3)
+    assert sorted(failures) == [0, 3, 6] and sorted(done) == [1, 2, 4, 5]
+
+
+@pytest.fixture(autouse=True)
+def memory_gate(monkeypatch):
+    # no history file: the commands of these tests aren't recorded
+    monkeypatch.setattr(resources, "memory_gate", MemoryGate())
+
+
+def running(pid):
+    # the process exists and isn't a zombie
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def wait_stopped(pid, timeout=5):
+    deadline = time.time() + timeout
+    while running(pid) and time.time() < deadline:
+        time.sleep(0.05)
+    return not running(pid)
+
+
+def background_sleep(pid_file):
+    # a shell that waits on a sleep it started, so killing only the shell would leave the sleep behind
+    return [f"sleep 30 & echo $! > {pid_file}; wait"]
+
+
+def test_exit_code_and_check():
+    assert run_cmd(["true"]) == 0
+    assert run_cmd(["exit 3"]) == 3
+    with pytest.raises(CommandError, match="exit code 3"):
+        run_cmd(["exit 3"], check=True)
+
+
+def test_timeout_kills_the_process_group(tmp_path):
+    start = time.time()
+    assert run_cmd(background_sleep(tmp_path / "pid"), timeout=0.5) == -signal.SIGKILL
+    assert time.time() - start < 10
+    assert wait_stopped(int((tmp_path / "pid").read_text()))
+    with pytest.raises(CommandError, match="timed out after 0.5s"):
+        run_cmd(["sleep 30"], timeout=0.5, check=True)
+
+
+def test_cancel_scope(tmp_path):
+    scope = CancelScope()
+
+    def run():
+        cancel_scope.set(scope)
+        command = start_cmd(background_sleep(tmp_path / "pid"))
+        threading.Timer(0.5, scope.cancel).start()
+        result = command.wait()
+        # a command started once the scope was cancelled is killed at once
+        with pytest.raises(CommandError, match="was cancelled"):
+            run_cmd(["sleep 30"], check=True)
+        return result
+
+    result = contextvars.copy_context().run(run)
+    assert result.cancelled and result.exit_code == -signal.SIGKILL
+    assert wait_stopped(int((tmp_path / "pid").read_text()))
+
+
+def test_scope_timeout():
+    scope = CancelScope(timeout=0.5)
+
+    def run():
+        cancel_scope.set(scope)
+        return start_cmd(["sleep 30"]).wait()
+
+    result = contextvars.copy_context().run(run)
+    assert result.timed_out and result.timeout == 0.5
+
+
+def test_keyboard_interrupt_stops_the_command(tmp_path):
+    # commands run in their own session, Ctrl+C only reaches YaMAS
+    pid_file = tmp_path / "pid"
+    threading.Timer(0.5, signal.pthread_kill, (threading.main_thread().ident, signal.SIGINT)).start()
+    with pytest.raises(KeyboardInterrupt):
+        run_cmd(background_sleep(pid_file))
+    assert wait_stopped(int(pid_file.read_text()))
+
+
+def test_large_output():
+    # more than a pipe holds, read while the command runs
+    assert cmd_output(["yes | head -c 5000000"]) == "y\n" * 2500000
+
+
+def test_stage_log_and_report(tmp_path):
+    report = RunReport(tmp_path, "download")
+    report.start_stage("conversion", "conversion")
+
+    def run():
+        current_stage.set((report, "conversion"))
+        run_cmd(["echo converted; echo warning >&2"])
+        run_cmd(["exit 2"])
+
+    contextvars.copy_context().run(run)
+    log = (tmp_path / "logs" / "conversion.log").read_text()
+    assert "$ echo converted; echo warning >&2\nconverted\nwarning\n" in log and "$ exit 2" in log
+    first, second = report.commands
+    assert first["stage"] == "conversion" and first["exit_code"] == 0 and second["exit_code"] == 2
+    # the rusage wait4 gave for the command
+    assert first["peak_rss_mb"] > 0
+    assert report.stages["conversion"]["commands"] == 2
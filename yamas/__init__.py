@@ -1,16 +1,28 @@
 import argparse
 import json
+import os
 import pkg_resources
-from .dataset_downloading import download
-from .dataset_downloading import continue_from
-from .dataset_downloading import continue_from_fastq
-from .export_data import export
 from .prerun_configs import set_environment
-from .dataset_downloading import download_qiita
-from .dataset_downloading import download_fastq
+from .accession_store import default_store_path
+from .resources import configure_memory
+from .runinfo_cache import CACHE_DIR_NAME
+from .taxonomy_cache import configure_taxonomy_cache
 
 
 def main():
+    # the pipelines import qiime2, imported here so that the yamas modules that don't need it (profile_merge,
+    # quality_profile, ...) can be imported without it
+    from .dataset_downloading import download
+    from .dataset_downloading import continue_from
+    from .dataset_downloading import continue_from_fastq
+    from .export_data import export
+    from .dataset_downloading import download_qiita
+    from .dataset_downloading import download_fastq
+    from .dataset_downloading import store_gc
+    from .dataset_downloading import resume
+    from .dataset_downloading import update
+    from .dataset_downloading import quality_profile
+
     # Initialize the argument parser with a description.
     parser = argparse.ArgumentParser(description='YMS package')
     
@@ -25,6 +37,13 @@ def main():
 
     parser.add_argument('--continue_from', nargs=3, metavar=('DATASET_ID','PATH', 'DATA_TYPE'), help='Continue processing from a specific path with a given data type')
 
+    parser.add_argument('--resume', metavar='PATH',
+                        help='Resume an interrupted --download in PATH, skipping every stage and sample already done')
+
+    parser.add_argument('--update', metavar='PATH',
+                        help='Add the accessions the BioProject (or --acc_list) gained since the project in PATH was '
+                             'downloaded, downloading and profiling only these')
+
     parser.add_argument('--continue_from_fastq', nargs=3, metavar=('DATASET_ID','PATH', 'DATA_TYPE'), help='Continue downloading from a specific path with a given data type')
 
     parser.add_argument('--fastq', nargs=4, metavar=("PREPROCESSED FASTQ PATH", "Barcodes.fastq.gz PATH","METADATA PATH", "DATA_TYPE"), help= "PREPROCESSED FASTQ PATH: the path of sequences.fastq.gz file \n Barcode.fastq.gz PATH: the path of barcodes.fastq.gz file \n METADATA PATH: the path of metadata file \n DATA_TYPE: 16S/18S/Shotgun")
@@ -38,7 +57,11 @@ def main():
 
     # Add an argument for specifying export parameters.
     parser.add_argument('--export', nargs=6, metavar=("origin_dir_path", "data_type", "start", "end", "classifier_file", "threads"),
-                        help="Must provide: origin_dir_path, data_type, start, end, classifier_file, threads")
+                        help="Must provide: origin_dir_path, data_type, start, end, classifier_file, threads. "
+                             "start/end 'auto' picks them from the quality profile of the reads")
+    parser.add_argument('--incremental', action='store_true',
+                        help='Export: only denoise the samples added by --update since the last export, and merge them '
+                             'into its dada2 table')
 
     # Add an argument for specifying the path to a configuration file.
     parser.add_argument('--config', help='Path to config file')
@@ -49,8 +72,66 @@ def main():
     parser.add_argument('--as_single', action='store_true', help='Process the data as single-end reads, instead of paired-end reads.')
    
    # Add arguments for running HUMAnN and specifying the number of threads.
-    parser.add_argument('--threads', type=int, default=8, help='Total threads for internal tools')
-    parser.add_argument('--pathways', choices=['yes', 'no'], default='no', help='Generate HUMAnN pathways tables')
+    parser.add_argument('--threads', type=int, default=8, help='Total threads for internal tools, capped at the available CPUs (or cgroup limit)')
+    parser.add_argument('--pathways', choices=['yes', 'no', 'sam'], default='no',
+                        help="Generate HUMAnN pathways tables. With 'sam', a sample HUMAnN runs on again reuses the "
+                             "ChocoPhlAn alignments of its earlier run instead of repeating the nucleotide search")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of samples processed at the same time. The --threads budget is split between them')
+    parser.add_argument('--stream', nargs='?', type=int, const=4, metavar='MAX_IN_FLIGHT',
+                        help='Run every accession through prefetch, conversion and profiling as soon as it is downloaded, '
+                             'keeping at most MAX_IN_FLIGHT accessions on disk at once (default 4)')
+    parser.add_argument('--download_workers', type=int, default=4,
+                        help='Number of accessions downloaded at the same time (default 4)')
+    parser.add_argument('--entrez_batch_size', type=int, default=200,
+                        help='Number of accessions of --acc_list looked up in a single Entrez query (default 200)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only use the local run info cache, never query Entrez')
+    parser.add_argument('--cache_ttl', type=float, default=30,
+                        help='Days before cached run info is fetched again from Entrez (default 30)')
+    parser.add_argument('--store', nargs='?', const='', metavar='STORE_PATH',
+                        help='Keep downloaded .sra/.fastq files in a store shared by all projects and link them into '
+                             'the project (default location: .yamas_store in the output location)')
+    parser.add_argument('--store_gc', nargs='?', const='', metavar='STORE_PATH',
+                        help='Delete the stored files that no project links to anymore')
+    parser.add_argument('--temp_dir', help='Scratch directory for fasterq-dump temporary files and the alignments '
+                                           '--pathways sam decompresses (preferably a fast local disk)')
+    parser.add_argument('--report', action='store_true',
+                        help='Print the time, CPU, peak memory and I/O of every stage at the end of the run '
+                             '(always recorded in run_report.json of the project)')
+    parser.add_argument('--command_timeout', type=float, metavar='SECONDS',
+                        help='Kill any external tool (prefetch, fasterq-dump, metaphlan, qiime...) running longer than '
+                             'SECONDS, failing its sample or stage instead of hanging')
+    parser.add_argument('--memory', type=float, metavar='GB',
+                        help='Memory the tools of a run may use together (default: the available memory)')
+    parser.add_argument('--quality_profile', metavar='PATH',
+                        help="Write the per-position quality quantiles, read lengths and reads per sample of the fastq "
+                             "files of the project in PATH to its vis/ folder (JSON/CSV)")
+    parser.add_argument('--subsample', type=float, metavar='FRACTION',
+                        help='Profile the qualities of a random FRACTION of the reads only (with --quality_profile)')
+    parser.add_argument('--auto_export', metavar='CLASSIFIER_PATH',
+                        help='16S/18S: once the download is done, go on to --export with trim/trunc picked from the '
+                             'quality profile of the reads, using the classifier in CLASSIFIER_PATH')
+    parser.add_argument('--classify_workers', type=int, default=1,
+                        help='Export: classify the representative sequences in this many chunks at the same time, '
+                             'each classifier starting once its memory is free (default 1)')
+    parser.add_argument('--classify_batch', type=int, metavar='N',
+                        help="Export: reads classify-sklearn classifies per batch (default: classify-sklearn's 'auto')")
+    parser.add_argument('--classifier_service', nargs='?', type=float, const=30, metavar='IDLE_MINUTES',
+                        help='Export: classify through a local service that keeps the classifier loaded for the next '
+                             'exports, and stops after IDLE_MINUTES without requests (default 30)')
+    parser.add_argument('--taxonomy_cache', action='store_true',
+                        help='Export: reuse the taxonomy of sequences already classified with the same classifier, '
+                             'only the new sequences go through classify-sklearn')
+    parser.add_argument('--amplicon_length', type=int, metavar='BP',
+                        help='Length of the amplicon, so the automatic trim/trunc of paired reads keeps the mates '
+                             'overlapping enough to merge')
+    parser.add_argument('--dada2_sweep', nargs='?', type=float, const=0.1, metavar='FRACTION',
+                        help="Export: run DADA2 with every ';' separated trim/trunc candidate (or around the 'auto' "
+                             "one) on FRACTION of the reads (default 0.1), then on all of them with the best")
+    parser.add_argument('--tool_memory', nargs='+', metavar='TOOL=GB', default=[],
+                        help='Expected peak memory of a tool, e.g. humann=40 classify-sklearn=24. Tools without one '
+                             'use the peak measured in previous runs')
     
 
     # Parse the command line arguments.
@@ -71,6 +152,28 @@ def main():
             config = json.load(f)
         specific_location = config.get('specific_location')
 
+    # heavy tools (metaphlan, humann, classify-sklearn...) only start when their memory is free
+    tool_memory = {}
+    for entry in args.tool_memory:
+        tool, _, gb = entry.partition("=")
+        try:
+            tool_memory[tool] = float(gb)
+        except ValueError:
+            parser.error(f"--tool_memory expects TOOL=GB, got '{entry}'")
+    configure_memory(os.path.join(os.path.abspath(specific_location or ""), CACHE_DIR_NAME), memory_gb=args.memory,
+                     tool_memory=tool_memory)
+    if args.taxonomy_cache:
+        configure_taxonomy_cache(os.path.join(os.path.abspath(specific_location or ""), CACHE_DIR_NAME))
+
+    if args.store is not None:
+        args.store = args.store or default_store_path(specific_location)
+
+    if args.store_gc is not None:
+        store_gc(args.store_gc or default_store_path(specific_location))
+
+    if args.quality_profile:
+        quality_profile(args.quality_profile, subsample=args.subsample, workers=args.workers)
+
     if args.export:
         try:
             # Extract export parameters from the command line arguments.
@@ -82,7 +185,10 @@ def main():
             threads = args.export[5]
 
             # Call the export function with the specified parameters.
-            export(origin_dir,data_type,trim, trunc, classifier_file, threads)
+            export(origin_dir,data_type,trim, trunc, classifier_file, threads, summary=args.report, command_timeout=args.command_timeout,
+                   amplicon_length=args.amplicon_length,
+                   dada2_sweep=args.dada2_sweep, classify_workers=args.classify_workers, classify_batch=args.classify_batch,
+                   classifier_service=args.classifier_service, incremental=args.incremental)
         except IndexError:
             # Handle the case where the number of export arguments is insufficient.
             print(f"missing {len(args.export)-1} arguments")
@@ -98,7 +204,32 @@ def main():
             acc_list= args.acc_list[0] if args.acc_list else None
             for dataset_name in args.download:
                 download(dataset_name, data_type, acc_list,args.verbose, specific_location,args.as_single, 
-                         threads=args.threads, pathways=args.pathways)
+                         threads=args.threads, pathways=args.pathways, workers=args.workers,
+                         stream=args.stream is not None, max_in_flight=args.stream or 4,
+                         download_workers=args.download_workers, temp_dir=args.temp_dir,
+                         entrez_batch_size=args.entrez_batch_size, offline=args.offline, cache_ttl=args.cache_ttl,
+                         store=args.store, summary=args.report, command_timeout=args.command_timeout,
+                         auto_export=args.auto_export, amplicon_length=args.amplicon_length,
+                         dada2_sweep=args.dada2_sweep, classify_workers=args.classify_workers, classify_batch=args.classify_batch,
+                         classifier_service=args.classifier_service)
+
+    if args.resume:
+        resume(args.resume, args.verbose, specific_location, threads=args.threads, workers=args.workers,
+               max_in_flight=args.stream or 4, download_workers=args.download_workers, temp_dir=args.temp_dir,
+               store=args.store, summary=args.report, command_timeout=args.command_timeout,
+               auto_export=args.auto_export, amplicon_length=args.amplicon_length,
+               dada2_sweep=args.dada2_sweep, classify_workers=args.classify_workers, classify_batch=args.classify_batch,
+               classifier_service=args.classifier_service)
+
+    if args.update:
+        update(args.update, args.verbose, specific_location, acc_list=args.acc_list[0] if args.acc_list else None,
+               threads=args.threads, workers=args.workers, max_in_flight=args.stream or 4,
+               download_workers=args.download_workers, temp_dir=args.temp_dir,
+               entrez_batch_size=args.entrez_batch_size, offline=args.offline, cache_ttl=args.cache_ttl,
+               store=args.store, summary=args.report, command_timeout=args.command_timeout,
+               auto_export=args.auto_export, amplicon_length=args.amplicon_length,
+               classify_workers=args.classify_workers, classify_batch=args.classify_batch,
+               classifier_service=args.classifier_service)
 
     if args.continue_from_fastq:
         dataset_id= args.continue_from_fastq[0]
@@ -108,7 +239,11 @@ def main():
         print(f"{continue_path}, {data_type}")
         if data_type == '16S' or data_type == '18S' or data_type == 'Shotgun':
             continue_from_fastq(dataset_id,continue_path, data_type, args.verbose, specific_location, 
-                                threads=args.threads, pathways=args.pathways)
+                                threads=args.threads, pathways=args.pathways, workers=args.workers,
+                                temp_dir=args.temp_dir, summary=args.report, command_timeout=args.command_timeout,
+                                auto_export=args.auto_export, amplicon_length=args.amplicon_length,
+                                dada2_sweep=args.dada2_sweep, classify_workers=args.classify_workers, classify_batch=args.classify_batch,
+                                classifier_service=args.classifier_service)
         else:
         # Ensure that a dataset type is specified when downloading datasets.
             raise ValueError("Missing dataset type. Use --type 16S/18S/Shotgun")
@@ -119,7 +254,10 @@ def main():
         data_type = args.continue_from[2]
         if data_type=='16S' or data_type=='18S' or data_type=='Shotgun':
             continue_from(dataset_id,continue_path,data_type, args.verbose, specific_location,
-                          threads=args.threads, pathways=args.pathways)
+                          threads=args.threads, pathways=args.pathways, workers=args.workers, summary=args.report, command_timeout=args.command_timeout,
+                          auto_export=args.auto_export, amplicon_length=args.amplicon_length,
+                          dada2_sweep=args.dada2_sweep, classify_workers=args.classify_workers, classify_batch=args.classify_batch,
+                          classifier_service=args.classifier_service)
  
         else:
             # Ensure that a dataset type is specified when downloading datasets.
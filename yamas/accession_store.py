@@ -0,0 +1,120 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+STORE_DIR_NAME = ".yamas_store"
+
+
+def default_store_path(specific_location: str):
+    return os.path.join(os.path.abspath(specific_location or ""), STORE_DIR_NAME)
+
+
+def link_file(src: str, dst: str):
+    # Hardlink when the project is on the same filesystem as the store, symlink otherwise.
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(src, dst)
+
+
+def is_link_to(link_path: str, src: str):
+    if os.path.islink(link_path):
+        return os.path.realpath(link_path) == os.path.realpath(src)
+    return os.path.exists(link_path) and os.path.exists(src) and os.path.samefile(link_path, src)
+
+
+class AccessionStore:
+    # A store of .sra and .fastq files shared by all projects, addressed by accession (an SRA run
+    # accession always names the same data). Projects get hardlinks/symlinks into the store
+    # instead of their own copies, and every link is recorded as a reference so `gc` can drop
+    # the files no project links to anymore. The accessions of every project are recorded too: a project that
+    # deletes its links once it used them (the .sra and fastq files of a streamed project) still keeps them.
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.root, "store.sqlite"), check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS objects "
+                             "(path TEXT PRIMARY KEY, acc TEXT, kind TEXT, size INTEGER, added_at REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS objects_acc ON objects (acc, kind)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS refs (path TEXT, link_path TEXT, PRIMARY KEY (path, link_path))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS project_refs "
+                             "(project TEXT, acc TEXT, PRIMARY KEY (project, acc))")
+
+    def files(self, acc: str, kind: str):
+        with self._lock:
+            rows = self._db.execute("SELECT path FROM objects WHERE acc = ? AND kind = ? ORDER BY path",
+                                    (acc, kind)).fetchall()
+        return [row[0] for row in rows if os.path.isfile(row[0])]
+
+    def files_dir(self, acc: str, kind: str):
+        return os.path.join(self.root, kind, acc)
+
+    def link(self, acc: str, kind: str, target_dir: str):
+        # Links the stored files of `acc` into target_dir. Returns the linked paths ([] if not stored).
+        refs = []
+        for path in self.files(acc, kind):
+            link_path = os.path.join(os.path.abspath(target_dir), os.path.basename(path))
+            link_file(path, link_path)
+            refs.append((path, link_path))
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO refs (path, link_path) VALUES (?, ?)", refs)
+        return [link_path for _, link_path in refs]
+
+    def add(self, acc: str, kind: str, paths: list):
+        # Moves the given project files into the store and replaces them with links.
+        store_dir = self.files_dir(acc, kind)
+        os.makedirs(store_dir, exist_ok=True)
+        now = time.time()
+        for path in paths:
+            stored = os.path.join(store_dir, os.path.basename(path))
+            shutil.move(path, stored)
+            link_file(stored, path)
+            with self._lock, self._db:
+                self._db.execute("INSERT OR REPLACE INTO objects (path, acc, kind, size, added_at) VALUES (?, ?, ?, ?, ?)",
+                                 (stored, acc, kind, os.path.getsize(stored), now))
+                self._db.execute("INSERT OR IGNORE INTO refs (path, link_path) VALUES (?, ?)",
+                                 (stored, os.path.abspath(path)))
+
+    def add_project(self, project_dir: str, accessions: list):
+        # Records that the project in project_dir uses these accessions, for as long as the project exists.
+        project = os.path.abspath(project_dir)
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO project_refs (project, acc) VALUES (?, ?)",
+                                 [(project, acc) for acc in accessions])
+
+    def gc(self, dry_run: bool = False):
+        # Drops references whose link was deleted (or replaced) and the accessions of projects that were
+        # deleted (no metadata.json left), then deletes the stored files nothing references anymore.
+        # Returns the number of bytes freed.
+        with self._lock:
+            refs = self._db.execute("SELECT path, link_path FROM refs").fetchall()
+            objects = self._db.execute("SELECT path, acc, size FROM objects").fetchall()
+            project_refs = self._db.execute("SELECT project, acc FROM project_refs").fetchall()
+        stale = [(path, link_path) for path, link_path in refs if not is_link_to(link_path, path)]
+        alive = {path for path, link_path in set(refs) - set(stale)}
+        gone = {project for project, _ in project_refs if not os.path.isfile(os.path.join(project, "metadata.json"))}
+        used = {acc for project, acc in project_refs if project not in gone}
+        unused = [(path, size) for path, acc, size in objects if path not in alive and acc not in used]
+        freed = sum(size for _, size in unused)
+        print(f"{len(stale)} stale links, {len(gone)} deleted projects, {len(unused)} unreferenced files "
+              f"({freed / 2 ** 30:.2f} GB){' would be removed' if dry_run else ' removed'}.")
+        if dry_run:
+            return freed
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM refs WHERE path = ? AND link_path = ?", stale)
+            self._db.executemany("DELETE FROM project_refs WHERE project = ?", [(project,) for project in gone])
+            self._db.executemany("DELETE FROM objects WHERE path = ?", [(path,) for path, _ in unused])
+        for path, _ in unused:
+            if os.path.exists(path):
+                os.remove(path)
+            if os.path.isdir(os.path.dirname(path)) and not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+        return freed
@@ -0,0 +1,55 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+CHECKPOINTS_NAME = "checkpoints.json"
+
+
+def fingerprint(paths):
+    # Cheap fingerprint of input files (path, size, mtime); files that no longer exist are left out,
+    # e.g. fastq files deleted once profiled.
+    digest = hashlib.md5()
+    found = False
+    for path in sorted(str(p) for p in paths):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{int(stat.st_mtime)}".encode())
+            found = True
+    return digest.hexdigest() if found else None
+
+
+class Checkpoints:
+    # Records every finished pipeline stage and per-sample step of a project in
+    # <dir_path>/checkpoints.json, together with a fingerprint of its inputs.
+    # A step is skipped on resume when it was recorded, its outputs still exist and its inputs
+    # did not change since.
+
+    def __init__(self, dir_path: str):
+        self.path = os.path.join(str(dir_path), CHECKPOINTS_NAME)
+        self._lock = threading.Lock()
+        self.steps = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.steps = json.load(f)
+
+    def done(self, step: str, inputs=(), outputs=()):
+        entry = self.steps.get(step)
+        if entry is None or not all(os.path.exists(str(output)) for output in outputs):
+            return False
+        current = fingerprint(inputs)
+        return current is None or current == entry["inputs"]
+
+    def mark(self, step: str, inputs=(), **details):
+        with self._lock:
+            self.steps[step] = {"inputs": fingerprint(inputs),
+                                "finished": datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'), **details}
+            with open(self.path, 'w') as f:
+                json.dump(self.steps, f, indent=2)
+
+    def forget(self, step: str):
+        with self._lock:
+            self.steps.pop(step, None)
+            with open(self.path, 'w') as f:
+                json.dump(self.steps, f, indent=2)
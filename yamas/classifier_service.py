@@ -0,0 +1,266 @@
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from . import resources
+from .run_report import record_command
+from .utilities import cancel_scope
+
+# A local process that keeps a classify-sklearn classifier loaded and classifies the representative sequences
+# of successive exports through a Unix socket, one JSON line per request and per answer.
+# It is started on demand by the first export using the classifier and exits once idle for idle_timeout seconds.
+
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+START_TIMEOUT = 60
+# how often a service whose memory is reserved is pinged, to release the memory once it stopped
+SERVICE_CHECK_INTERVAL = 30
+
+
+def service_dir():
+    # The sockets, locks and logs of the user's services: in $XDG_RUNTIME_DIR when there is one, otherwise in a
+    # directory of the temp dir only the user can use. Anyone able to write there could answer in place of a
+    # service, so a directory another user owns or can write to is refused.
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    path = os.path.join(runtime_dir, "yamas") if runtime_dir else os.path.join(tempfile.gettempdir(),
+                                                                                   f"yamas-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must be a directory of user {os.getuid()} only they can access "
+                              f"(mode 700), remove it or fix its permissions")
+    return path
+
+
+def service_socket_path(classifier_path: str):
+    # one service per classifier file, a classifier that changed gets a new service
+    stat = os.stat(classifier_path)
+    digest = hashlib.sha1(f"{os.path.abspath(classifier_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return os.path.join(service_dir(), f"classifier-{digest[:16]}.sock")
+
+
+class ClassifierServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, classifier_path: str):
+        super().__init__(socket_path, ClassifyHandler)
+        self.classifier_path = os.path.abspath(classifier_path)
+        self.classifier = None
+        self.load_error = None
+        self.loaded = threading.Event()
+        self.active = 0
+        self.last_activity = time.time()
+        self.activity = threading.Lock()
+
+    def load(self):
+        # requests that come in while the classifier loads wait for it
+        try:
+            import qiime2 as q2
+            from sklearn.pipeline import Pipeline
+            started = time.time()
+            self.classifier = q2.Artifact.load(self.classifier_path).view(Pipeline)
+            print(f"classifier {self.classifier_path} loaded in {time.time() - started:.0f}s", flush=True)
+        except Exception as e:
+            self.load_error = f"{type(e).__name__}: {e}"
+            print(f"loading {self.classifier_path} failed: {self.load_error}", flush=True)
+        self.loaded.set()
+
+    def classify(self, request: dict):
+        import qiime2 as q2
+        from q2_types.feature_data import DNAFASTAFormat
+        from q2_feature_classifier.classifier import classify_sklearn
+        reads = q2.Artifact.load(request["reads"]).view(DNAFASTAFormat)
+        taxonomy = classify_sklearn(reads, self.classifier, reads_per_batch=request.get("reads_per_batch") or "auto",
+                                    n_jobs=request.get("n_jobs", 1))
+        q2.Artifact.import_data("FeatureData[Taxonomy]", taxonomy).save(request["output"])
+
+    def idle_for(self):
+        with self.activity:
+            return 0 if self.active else time.time() - self.last_activity
+
+
+class ClassifyHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        busy = False
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("op") == "ping":
+                # pings (see watch_service) don't keep the service from stopping once idle
+                answer = {"ok": True, "classifier": server.classifier_path}
+            elif os.path.abspath(request["classifier"]) != server.classifier_path:
+                answer = {"error": f"this service classifies with {server.classifier_path}"}
+            else:
+                with server.activity:
+                    server.active += 1
+                busy = True
+                server.loaded.wait()
+                if server.load_error:
+                    raise RuntimeError(f"the classifier could not be loaded: {server.load_error}")
+                started = time.time()
+                server.classify(request)
+                print(f"classified {request['reads']} in {time.time() - started:.0f}s", flush=True)
+                answer = {"ok": True}
+        except Exception as e:
+            answer = {"error": f"{type(e).__name__}: {e}"}
+            print(f"request failed: {answer['error']}", flush=True)
+        finally:
+            if busy:
+                with server.activity:
+                    server.active -= 1
+                    server.last_activity = time.time()
+        self.wfile.write((json.dumps(answer) + "\n").encode())
+
+
+def serve(classifier_path: str, socket_path: str, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+    # Runs the service until it was idle for idle_timeout seconds (started by start_service, not by hand).
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)  # left behind by a service that died, start_service checked nobody answers on it
+    server = ClassifierServer(socket_path, classifier_path)
+    print(f"classifier service listening on {socket_path}", flush=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.load()
+    try:
+        while server.idle_for() < idle_timeout:
+            time.sleep(min(5, idle_timeout))
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        print(f"classifier service stopped after {idle_timeout:.0f}s idle", flush=True)
+
+
+class AbortRequest:
+    # Added to a CancelScope like a Command: cancelling the scope shuts the connection of a request down,
+    # the caller stops waiting for the answer (the service still finishes that request).
+
+    def __init__(self, client: socket.socket):
+        self.client = client
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def send(socket_path: str, request: dict, timeout: float = None, scope=None):
+    # timeout: seconds to wait for the answer; scope: the CancelScope the request is cancelled with
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        abort = AbortRequest(client)
+        if scope is not None:
+            scope.add(abort)
+        try:
+            client.sendall((json.dumps(request) + "\n").encode())
+            with client.makefile('rb') as answer:
+                line = answer.readline()
+        except socket.timeout:
+            raise RuntimeError(f"the classifier service on {socket_path} did not answer within {timeout}s")
+        finally:
+            if scope is not None:
+                scope.remove(abort)
+    if abort.cancelled:
+        raise RuntimeError(f"the request to the classifier service on {socket_path} was cancelled")
+    if not line:
+        raise ConnectionError(f"the classifier service on {socket_path} closed the connection")
+    return json.loads(line)
+
+
+def start_service(classifier_path: str, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+    # The socket of the service of this classifier, started first when none answers on it.
+    # The lock makes concurrent exports share a single service.
+    socket_path = service_socket_path(classifier_path)
+    os.makedirs(service_dir(), exist_ok=True)
+    with open(socket_path[:-len(".sock")] + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            send(socket_path, {"op": "ping"}, timeout=10)
+            return socket_path
+        except OSError:
+            pass
+        log_path = socket_path[:-len(".sock")] + ".log"
+        print(f"Starting the classifier service of {classifier_path} (log: {log_path})")
+        with open(log_path, 'a') as log:
+            code = "import sys; from yamas.classifier_service import serve; serve(sys.argv[1], sys.argv[2], float(sys.argv[3]))"
+            process = subprocess.Popen([sys.executable, "-c", code, os.path.abspath(classifier_path), socket_path,
+                                        str(idle_timeout)],
+                                       stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        deadline = time.time() + START_TIMEOUT
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"the classifier service exited (code {process.returncode}), see {log_path}")
+            try:
+                send(socket_path, {"op": "ping"}, timeout=10)
+                return socket_path
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"the classifier service did not start within {START_TIMEOUT}s, see {log_path}")
+
+
+# socket path -> (memory gate, GB) reserved for the services this process uses, while they run
+_service_memory = {}
+_service_memory_lock = threading.Lock()
+
+
+def reserve_service_memory(socket_path: str, cancelled: threading.Event = None):
+    # A service keeps its classifier loaded between requests, after a cancelled one and until it was idle for
+    # idle_timeout, so its memory is reserved in the memory gate once, until it stops answering (see watch_service),
+    # and not only during each request.
+    with _service_memory_lock:
+        if socket_path in _service_memory:
+            return
+        gate = resources.memory_gate
+        reserved_gb = gate.admit("classify-sklearn", cancelled)
+        if not reserved_gb:
+            return
+        _service_memory[socket_path] = (gate, reserved_gb)
+    threading.Thread(target=watch_service, args=(socket_path,), daemon=True).start()
+
+
+def watch_service(socket_path: str, interval: float = None):
+    # releases the memory reserved for a service once it stopped
+    while True:
+        time.sleep(interval or SERVICE_CHECK_INTERVAL)
+        try:
+            send(socket_path, {"op": "ping"}, timeout=10)
+        except (OSError, RuntimeError):
+            break
+    with _service_memory_lock:
+        gate, reserved_gb = _service_memory.pop(socket_path)
+    gate.release(reserved_gb)
+
+
+def classify_with_service(reads_path: str, classifier_path: str, output_path: str, n_jobs: int = 1,
+                          reads_per_batch: int = None, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+    # classify-sklearn through the classifier's service, which only loads the classifier the first time.
+    # Like a classify-sklearn command, the request waits for the memory gate (for the service's memory, see
+    # reserve_service_memory), times out after the scope's command timeout and is cancelled with the scope.
+    request = {"op": "classify", "classifier": os.path.abspath(classifier_path), "reads": os.path.abspath(reads_path),
+               "output": os.path.abspath(output_path), "n_jobs": n_jobs, "reads_per_batch": reads_per_batch}
+    scope = cancel_scope.get()
+    timeout = scope.timeout if scope is not None else None
+    reserve_service_memory(service_socket_path(classifier_path), scope.cancelled if scope is not None else None)
+    started = time.time()
+    try:
+        answer = send(start_service(classifier_path, idle_timeout), request, timeout, scope)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # the service stopped, idle, right after answering our ping
+        answer = send(start_service(classifier_path, idle_timeout), request, timeout, scope)
+    record_command(f"classifier service: classify {reads_path}", 0 if answer.get("ok") else 1, time.time() - started)
+    if not answer.get("ok"):
+        raise RuntimeError(f"the classifier service failed to classify {reads_path}: {answer.get('error')}")
+
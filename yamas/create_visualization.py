@@ -4,13 +4,19 @@ import csv
 import os.path
 import pickle
 import datetime
-from tqdm import tqdm
-from metaphlan.utils.merge_metaphlan_tables import merge
-from .utilities import run_cmd, ReadsData, check_conda_qiime2
+from .utilities import run_cmd, run_in_pool, ReadsData, check_conda_qiime2, fastq_sample_index
 import json
 import shutil
 
-from .generate_pathways import run_humann_pipeline
+from .quality_profile import profile_samples, quality_profile_path
+from .profile_merge import merge_profiles_streaming
+from .generate_pathways import humann_sample, join_humann_tables, completed_alignments, HUMANN_TABLES
+from .sra_download import download_accessions, read_run_info
+from .accession_store import AccessionStore
+from .checkpoints import Checkpoints
+from .scheduler import Stage, record_failures, run_stages
+from .run_report import RunReport
+from .resources import tool_threads
 from pathlib import Path
 
 CONDA_PREFIX = os.environ.get("CONDA_PREFIX", None)
@@ -58,15 +64,17 @@ def create_dir(dir_name, specific_location):
     return dir_path
 
 
-def download_data_from_sra(dir_path: str, acc_list: str = ""):
+def download_data_from_sra(dir_path: str, acc_list: str = "", run_info: str = None, workers: int = 4,
+                           store: AccessionStore = None, accessions: list = None):
+    # accessions: only download these accessions of the list (--update)
     # ensure the target “sra” folder exists
     sra_dir = os.path.join(dir_path, 'sra')
     os.makedirs(sra_dir, exist_ok=True)
-    
-    run_cmd(['prefetch',
-             "--option-file", acc_list,
-             "--output-directory", sra_dir,
-             "--max-size", "100G"])
+
+    failures = download_accessions(dir_path, accessions if accessions is not None else read_acc_list(acc_list),
+                                   run_info_path=run_info, workers=workers, store=store)
+    report_failed_samples(failures, os.path.join(dir_path, 'failed_downloads.txt'))
+
     repo_root = Path(os.environ.get("NCBI_VDB_REPOSITORY_ROOT",
                                     Path.home() / "ncbi"))
     src_dir   = repo_root / "public" / "sra"
@@ -78,20 +86,104 @@ def download_data_from_sra(dir_path: str, acc_list: str = ""):
         print(f"moved {sra_file} → {dst_dir/sra_file.name}")
 
 
-def sra_to_fastq(dir_path: str, as_single):
+def read_acc_list(acc_list: str):
+    with open(acc_list) as f:
+        return [acc.strip() for acc in f if acc.strip()]
+
+
+def accession_fastq_files(fastq_path: str, acc: str):
+    return sorted(os.path.join(fastq_path, f) for f in os.listdir(fastq_path)
+                  if f == f"{acc}.fastq" or (f.startswith(f"{acc}_") and f.endswith(".fastq")))
+
+
+def fastq_is_complete(fastq_file: str):
+    # A fastq cut off in the middle of a write does not end with a whole record (@id, seq, +, qual).
+    if not os.path.getsize(fastq_file):
+        return False
+    with open(fastq_file, 'rb') as f:
+        f.seek(max(0, os.path.getsize(fastq_file) - 65536))
+        tail = f.read()
+    if not tail.endswith(b"\n"):
+        return False
+    lines = tail.split(b"\n")[:-1][-4:]
+    return len(lines) == 4 and lines[0].startswith(b"@") and lines[2].startswith(b"+") \
+        and len(lines[1]) == len(lines[3])
+
+
+def fastq_files_complete(fastq_files: list, as_single: bool, layout: str = None):
+    # Whether the conversion of an accession finished: every fastq is whole, and a paired accession has both mates
+    # (an interrupted fasterq-dump may have written _1 and not _2). as_single deletes the _2 mates on purpose.
+    # layout: the accession's LibraryLayout in the run info, without it an _1 mate means a paired accession.
+    if not fastq_files or not all(fastq_is_complete(f) for f in fastq_files):
+        return False
+    has_1 = any(f.endswith("_1.fastq") for f in fastq_files)
+    has_2 = any(f.endswith("_2.fastq") for f in fastq_files)
+    if has_2 and not has_1:
+        return False
+    paired = layout.upper() == "PAIRED" if layout else has_1
+    return has_2 or as_single or not paired
+
+
+def fastq_dump_accession(dir_path: str, sra_path: str, threads: int = None, temp_dir: str = None):
+    # converts a single .sra file and returns the fastq files it produced (one, or the _1/_2 mates)
+    acc = os.path.basename(sra_path).split(".")[0]
+    fastq_path = os.path.join(dir_path, "fastq")
+    command = ["fasterq-dump", "--split-files", sra_path, "-O", fastq_path]
+    if threads:
+        command += ["--threads", str(threads)]
+    if temp_dir:
+        command += ["--temp", temp_dir]
+    exit_code = run_cmd(command)
+    fastq_files = accession_fastq_files(fastq_path, acc)
+    if exit_code != 0 or not fastq_files:
+        raise RuntimeError(f"fasterq-dump failed on {acc} (exit code {exit_code})")
+    return fastq_files
+
+
+def sra_to_fastq(dir_path: str, as_single, threads: int = None, workers: int = 1, temp_dir: str = None,
+                 store: AccessionStore = None, accessions: list = None, run_info: str = None):
+    # accessions: only convert these accessions (--update, the fastq of the others may be deleted once profiled)
+    # run_info: the project's run info, its LibraryLayout tells whether a converted accession misses a mate
     print(f"converting files from .sra to .fastq.")
-    for sra_dir in tqdm(os.listdir(os.path.join(dir_path, "sra")), desc="converted files"):
-        sra_file = os.listdir(os.path.join(dir_path, "sra", sra_dir))[0]
-        sra_path = os.path.join(dir_path, "sra", sra_dir, sra_file)
-        fastq_path = os.path.join(dir_path, "fastq")
-        run_cmd(["fasterq-dump", "--split-files", sra_path, "-O", fastq_path])
+    fastq_path = os.path.join(dir_path, "fastq")
+    sra_paths = {}
+    for sra_dir in sorted(os.listdir(os.path.join(dir_path, "sra"))):
+        if sra_dir.endswith(".sra"):  # moved from the ncbi repository, not inside an accession folder
+            sra_paths[sra_dir.split(".")[0]] = os.path.join(dir_path, "sra", sra_dir)
+            continue
+        sra_files = os.listdir(os.path.join(dir_path, "sra", sra_dir))
+        if sra_files:
+            sra_paths[sra_dir] = os.path.join(dir_path, "sra", sra_dir, sra_files[0])
+    if accessions is not None:
+        sra_paths = {acc: path for acc, path in sra_paths.items() if acc in set(accessions)}
+
+    # the threads budget is split between the conversions running at the same time
+    dump_threads = tool_threads(workers, threads)
+    if temp_dir:
+        os.makedirs(temp_dir, exist_ok=True)
+    run_info_rows = read_run_info(run_info)
+
+    def convert(acc):
+        existing = accession_fastq_files(fastq_path, acc)
+        if fastq_files_complete(existing, as_single, run_info_rows.get(acc, {}).get("LibraryLayout")):
+            return
+        # fasterq-dump won't overwrite the leftovers of an interrupted conversion
+        for fastq in existing:
+            os.remove(fastq)
+        if store is not None and store.link(acc, "fastq", fastq_path):
+            return
+        fastq_files = fastq_dump_accession(dir_path, sra_paths[acc], threads=dump_threads, temp_dir=temp_dir)
+        if store is not None:
+            store.add(acc, "fastq", fastq_files)
+
+    failures = run_in_pool(convert, list(sra_paths), workers=workers, desc="converted files")
+    report_failed_samples(failures, os.path.join(dir_path, 'failed_conversions.txt'))
 
     # identify FASTQ folder
     fastq_dir = os.path.join(dir_path, "fastq")
 
-    # check if reads include fwd and rev
-    fastqs = sorted(os.listdir(os.path.join(dir_path, "fastq")))[:3]
-    if len(set([fastq.split("_")[0] for fastq in fastqs])) == 2:
+    # check if reads include fwd and rev (_1/_2 mates)
+    if any(len(files) == 2 for files in fastq_sample_index(fastq_dir).values()):
         if as_single:
             print('yes- paired reads')
             print(f'the number of _2 reads: {len([f for f in os.listdir(fastq_dir) if "_2.fastq" in f])}')
@@ -108,73 +200,50 @@ def sra_to_fastq(dir_path: str, as_single):
 
 def create_manifest(reads_data: ReadsData):
     base_dir = os.path.abspath(reads_data.dir_path)
-    fastq_path = os.path.join(base_dir, "fastq")
-
-    #not paired reads
-    if not reads_data.rev:
-        files = [
-            os.path.join(fastq_path, f) 
-            for f in os.listdir(fastq_path)
-                 if os.path.isfile(os.path.join(fastq_path, f))
-                 ]
-        names = [os.path.splitext(os.path.basename(f))[0] for f in files]
-        
-        manifest_path = os.path.join(base_dir, 'manifest.tsv')
-        with open(manifest_path, 'w', newline='') as manifest:
-            tsv_writer = csv.writer(manifest, delimiter='\t')
-            tsv_writer.writerow(["SampleID", "absolute-filepath"])
-            for n, f in zip(*(names, files)):
-                abs_fp = os.path.abspath(f)
-                tsv_writer.writerow([n, abs_fp])
-        return
-    #paired-end reads
-    files_fwd = sorted([
-        os.path.join(fastq_path, f)
-        for f in os.listdir(fastq_path)
-        if os.path.isfile(os.path.join(fastq_path, f)) and "_1" in f])
-    files_rev = sorted([
-        os.path.join(fastq_path, f)
-        for f in os.listdir(fastq_path)
-        if os.path.isfile(os.path.join(fastq_path, f)) and "_2" in f])
-    
-    names = sorted([
-        os.path.splitext(os.path.basename(f))[0]
-        for f in os.listdir(os.path.join(base_dir, "sra"))])
-    
+    # the sra folder may already be cleaned up (streaming mode), so the samples are taken from the fastq files
+    samples = fastq_sample_index(os.path.join(base_dir, "fastq"))
     manifest_path = os.path.join(base_dir, 'manifest.tsv')
 
     with open(manifest_path, 'w', newline='') as manifest:
         tsv_writer = csv.writer(manifest, delimiter='\t')
+        #not paired reads
+        if not reads_data.rev:
+            tsv_writer.writerow(["SampleID", "absolute-filepath"])
+            for sample, files in samples.items():
+                tsv_writer.writerow([sample, files[0]])
+            return
+        #paired-end reads
         tsv_writer.writerow([
             "SampleID",
             "forward-absolute-filepath",
             "reverse-absolute-filepath"
         ])
-        for n, ff, fr in zip(names, files_fwd, files_rev):
-            abs_ff = os.path.abspath(ff)
-            abs_fr = os.path.abspath(fr)
-            tsv_writer.writerow([n, abs_ff, abs_fr])
+        for sample, files in samples.items():
+            if len(files) != 2:
+                print(f"{sample} has no reverse reads, it is left out of the paired-end manifest")
+                continue
+            tsv_writer.writerow([sample, *files])
     
     # remove sra folder
     #shutil.rmtree(os.path.join(base_dir, "sra"))
 
 
 
-def qiime_import(reads_data: ReadsData):
+def qiime_import(reads_data: ReadsData, manifest_path: str = None, qza_file_path: str = None):
     qza_path = os.path.join(reads_data.dir_path, "qza")
     paired = reads_data.rev and reads_data.fwd
     if paired: print("Paired reads")
 
-    qza_file_path = os.path.join(qza_path, f"demux-{'paired' if paired else 'single'}-end.qza")
+    qza_file_path = qza_file_path or os.path.join(qza_path, f"demux-{'paired' if paired else 'single'}-end.qza")
     command = [
         "qiime", "tools", "import",
         "--type", f"SampleData[{'PairedEndSequencesWithQuality' if paired else 'SequencesWithQuality'}]",
-        "--input-path", f"{os.path.join(reads_data.dir_path, 'manifest.tsv')}",
+        "--input-path", manifest_path or os.path.join(reads_data.dir_path, 'manifest.tsv'),
         "--input-format", "PairedEndFastqManifestPhred33V2" if paired else "SingleEndFastqManifestPhred33V2",
         "--output-path", qza_file_path,
 
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
     return qza_file_path
 
@@ -187,58 +256,92 @@ def qiime_demux(reads_data: ReadsData, qza_file_path: str, dataset_id):
         "--i-data", qza_file_path,
         "--o-visualization", vis_file_path
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
     return vis_file_path
 
 def get_files_in_directory(directory, extension=""):
-    return [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(extension)]
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(extension))
+
+
+def metaphlan_sample(fastq_files: list, sample_name: str, dir_path: str, nproc: int = None):
+    # Profiles a single sample (one fastq, or the two mates joined by ',') and returns its profile path.
+    nproc = nproc or tool_threads()
+    fastq_path = os.path.join(dir_path, "fastq")
+    profile_file = os.path.join(dir_path, 'qza', f'{sample_name}_profile.txt')
+    if len(fastq_files) == 2:
+        output = os.path.join(fastq_path, f"{sample_name}.bowtie2.bz2")
+        exit_code = run_cmd([f"metaphlan {','.join(fastq_files)} --input_type fastq --bowtie2out {output} --nproc {nproc}"])
+        if exit_code == 0:
+            exit_code = run_cmd([f"metaphlan {output} --input_type bowtie2out --nproc {nproc} > {profile_file}"])
+    else:
+        exit_code = run_cmd([f"metaphlan {fastq_files[0]} --input_type fastq --nproc {nproc} > {profile_file}"])
+
+    if exit_code != 0 or not os.path.exists(profile_file) or not os.path.getsize(profile_file):
+        # don't leave a half written profile behind, merge() would pick it up
+        if os.path.exists(profile_file):
+            os.remove(profile_file)
+        raise RuntimeError(f"metaphlan failed on {sample_name} (exit code {exit_code})")
+    return profile_file
+
+
+def report_failed_samples(failures: dict, report_path: str):
+    # the failures also keep the running stage from being checkpointed (see scheduler.record_failures)
+    if not failures:
+        # a report left by an earlier run whose failed samples were done now
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        return
+    record_failures(failures)
+    print(f"{len(failures)} samples failed, see {report_path}:")
+    with open(report_path, 'w') as report:
+        for sample, error in sorted(failures.items()):
+            print(f"  {sample}: {error}")
+            report.write(f"{sample}\t{error}\n")
 
 
-def metaphlan_extraction(reads_data, dataset_id):
+def metaphlan_extraction(reads_data, dataset_id, threads: int = None, workers: int = 1,
+                         checkpoints: Checkpoints = None, keep_fastq: bool = False):
     paired = reads_data.rev and reads_data.fwd
     fastq_path = os.path.join(reads_data.dir_path, "fastq")
     export_path = os.path.join(reads_data.dir_path, "export")
-    run_cmd([f"mkdir {export_path}"])
-    final_output_path = os.path.join(export_path, f'{dataset_id}_final.txt')
-    run_cmd([f"touch {final_output_path}"])
-    fastq_files = [a for a in os.listdir(fastq_path) if a.split(".")[-1] == "fastq"]
-
-    if paired:
-        print("paired")
-        for i in tqdm(range(0, len(fastq_files), 2)):
-            fastq_name = fastq_files[i].split('_')[0]
-            fastq_1 = os.path.join(fastq_path, fastq_files[i])
-            fastq_2 = os.path.join(fastq_path, fastq_files[i + 1])
-            output = os.path.join(fastq_path, f"{fastq_name}.bowtie2.bz2")
-            command = [f"metaphlan {fastq_1},{fastq_2} --input_type fastq --bowtie2out {output} --nproc 24"]
-            run_cmd(command)
-
-
-            final_output_file = os.path.join(os.path.join(reads_data.dir_path, 'qza'), f'{fastq_name}_profile.txt')
-            command = [f"metaphlan {output} --input_type bowtie2out --nproc 24 > {final_output_file}"]
-            run_cmd(command)
-            # after converting the fastq to bowtie and bowtie to profile we can delete these files
-            #run_cmd([f"rm {fastq_1} {fastq_2} {output}"])
-    else:
-        print("not paired")
-        for fastq in tqdm(fastq_files):
-            output = os.path.join(os.path.join(reads_data.dir_path, 'qza'), f'{fastq}_profile.txt')
-            fastq = os.path.join(fastq_path, fastq)
-            command = [f"metaphlan {fastq} --input_type fastq --nproc 24 > {output}"]
-            run_cmd(command)
-            # after converting the fastq to profile we can delete the fastq files
-            run_cmd([f"rm {fastq}"])
-
-    qza_dir= os.path.join(reads_data.dir_path, 'qza')
+    os.makedirs(export_path, exist_ok=True)
+    # the threads budget is split between the samples running at the same time
+    nproc = tool_threads(workers, threads)
+
+    samples = fastq_sample_index(fastq_path)
+    print("paired" if paired else "not paired")
+
+    def profile(sample_name):
+        profile_file = os.path.join(reads_data.dir_path, 'qza', f'{sample_name}_profile.txt')
+        if checkpoints is not None and checkpoints.done(f"metaphlan:{sample_name}", samples[sample_name], [profile_file]):
+            return
+        metaphlan_sample(samples[sample_name], sample_name, reads_data.dir_path, nproc)
+        if checkpoints is not None:
+            checkpoints.mark(f"metaphlan:{sample_name}", samples[sample_name])
+        if not paired and not keep_fastq:
+            # after converting the fastq to profile we can delete the fastq files (HUMAnN still needs them)
+            for fastq in samples[sample_name]:
+                os.remove(fastq)
+
+    failures = run_in_pool(profile, list(samples), workers=workers, desc="metaphlan samples")
+    report_failed_samples(failures, os.path.join(export_path, f'{dataset_id}_failed_samples.txt'))
+
+    merge_profiles(reads_data.dir_path, dataset_id)
+    
+    # delete the fastq dir, we convert all the fastq to profile
+    #shutil.rmtree(fastq_path)
+
+
+def merge_profiles(dir_path: str, dataset_id: str):
+    final_output_path = os.path.join(dir_path, "export", f'{dataset_id}_final.txt')
+    qza_dir= os.path.join(dir_path, 'qza')
     # Gather all profile files from the directory
     profile_files = get_files_in_directory(qza_dir, extension="_profile.txt")
 
     # Merge the profile files
     with open(final_output_path, 'w') as out:
-        merge(profile_files, out)
-    
-    # delete the fastq dir, we convert all the fastq to profile
-    #shutil.rmtree(fastq_path)
+        merge_profiles_streaming(profile_files, out)
+
 
 def metaphlan_txt_csv(reads_data, dataset_id):
     export_path = os.path.join(reads_data.dir_path, "export")
@@ -266,47 +369,126 @@ def metaphlan_txt_csv(reads_data, dataset_id):
 
     print(f"CSV file '{output_file}' has been created.")
 
-def run_pathways_pipeline(dir_path: Path | str, dataset_id: str, threads: int = 8):
+def run_pathways_pipeline(dir_path: Path | str, dataset_id: str, threads: int = 8, workers: int = 1,
+                          checkpoints: Checkpoints = None, reuse_alignments: bool = False, temp_dir: str = None):
+    # reuse_alignments: a sample HUMAnN runs on again (e.g. its translated search failed or was interrupted)
+    # starts from the nucleotide alignments of its earlier run, kept compressed in
+    # <sample>/<sample>_humann_temp/<sample>_bowtie2_aligned.sam.bz2 once its search finished (see
+    # generate_pathways.compress_alignments), instead of aligning its reads to ChocoPhlAn again.
+    # They are decompressed under temp_dir (default: the sample's directory) for the run only.
     base = Path(dir_path)
     fastq_dir = base / "fastq"
     output_dir  = base / "humann_results"
     # Ensure output directory exists
     output_dir.mkdir(parents=True, exist_ok=True)
-    meta_profile = base / "export" / f"{dataset_id}_final.txt"
-
-#    sam_files = sorted(fastq_dir.glob("*.sam"))
-#    if sam_files:
-#    # run HUMAnN on each .sam file individually
-#        for sam in sam_files:
-#            run_humann_pipeline(
-#                str(sam),
-#                str(output_dir),
-#                str(meta_profile),
-#                threads=threads,
-#                input_format="sam"
-#            )
-#        return
-    
-    # If no SAM files, gather FASTQ files
-    fq_files = sorted(fastq_dir.glob("*.fastq"))
-    if fq_files:
-        # Run HUMAnN on each FASTQ file individually
-        for fq in fq_files:
-            run_humann_pipeline(
-                str(fq),
-                str(output_dir),
-                str(meta_profile),
-                threads=threads,
-                input_format="fastq"
-            )
-        return
-
 
+    # one HUMAnN run per sample, the _1/_2 mates of a paired-end sample go together
+    samples = fastq_sample_index(str(fastq_dir))
+    # the threads budget is split between the samples running at the same time
+    nproc = tool_threads(workers, threads)
+
+    def run(sample):
+        inputs = samples[sample]
+        outputs = [output_dir / sample / f"{sample}_{table}.tsv" for table in HUMANN_TABLES]
+        if checkpoints is not None and checkpoints.done(f"humann:{sample}", inputs, outputs):
+            return
+        # the sample's own MetaPhlAn profile, HUMAnN profiles the sample itself when there is none
+        profile = base / "qza" / f"{sample}_profile.txt"
+        sam_file = completed_alignments(output_dir, sample) if reuse_alignments else None
+        humann_sample(sample, samples[sample], output_dir, profile if profile.exists() else None, threads=nproc,
+                      sam_file=sam_file, scratch_dir=temp_dir, keep_alignments=reuse_alignments)
+        if checkpoints is not None:
+            checkpoints.mark(f"humann:{sample}", inputs)
+
+    failures = run_in_pool(run, list(samples), workers=workers, desc="HUMAnN samples")
+    report_failed_samples(failures, os.path.join(output_dir, "failed_samples.txt"))
+    join_humann_tables(output_dir, base / "export", dataset_id)
+
+
+def print_trim_trunc_note(reads_data: ReadsData, vis_file_path: str):
+    print(f"Visualization file is located in {vis_file_path}\n"
+          f"Please drag this file to https://view.qiime2.org/ and continue.\n")
+    if reads_data.fwd and reads_data.rev:
+        print(f"Note: The data has both forward and reverse reads.\n"
+              f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
+              f"as a tuple of two integers."
+              f"The first place related to the forward read and the second to the reverse.")
+    else:
+        print(f"Note: The data has only a forward read.\n"
+              f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
+              f"exactly one integers value which is related to the forward read.")
+
+
+def analysis_stages(state: dict, dir_path, dataset_id, data_type, threads, workers, pathways,
+                    checkpoints: Checkpoints = None, profiled: bool = False, after: str = "conversion",
+                    temp_dir: str = None):
+    # The stages that follow the fastq conversion: qiime import & demux and the quality profile for 16S/18S,
+    # metaphlan (unless the samples were already profiled while streaming), the csv table and HUMAnN for Shotgun.
+    # state["reads_data"] must be set once the stage named `after` finished.
+    dir_path = str(dir_path)
+    if data_type == '16S' or data_type == '18S':
+        manifest_path = os.path.join(dir_path, 'manifest.tsv')
+        vis_file_path = os.path.join(dir_path, "vis", dataset_id + ".qzv")
+
+        def qza_file_path():
+            paired = state["reads_data"].rev and state["reads_data"].fwd
+            return os.path.join(dir_path, "qza", f"demux-{'paired' if paired else 'single'}-end.qza")
+
+        def demux():
+            state["vis_file_path"] = qiime_demux(state["reads_data"], qza_file_path(), dataset_id)
+
+        state["vis_file_path"] = vis_file_path
+        return [
+            Stage("manifest", lambda: create_manifest(state["reads_data"]), after=(after,),
+                  label="creating manifest", outputs=lambda: [manifest_path]),
+            Stage("qiime_import", lambda: qiime_import(state["reads_data"]), after=("manifest",),
+                  label="'qiime import'", inputs=lambda: [manifest_path], outputs=lambda: [qza_file_path()]),
+            Stage("qiime_demux", demux, after=("qiime_import",), label="'qiime demux'",
+                  inputs=lambda: [qza_file_path()], outputs=lambda: [vis_file_path]),
+            Stage("quality_profile", lambda: profile_samples(dir_path, dataset_id, workers=workers), after=(after,),
+                  label="quality profile", outputs=lambda: [quality_profile_path(dir_path, dataset_id)]),
+        ]
+
+    final_output_path = os.path.join(dir_path, "export", f"{dataset_id}_final.txt")
+    stages = []
+    if not profiled:
+        stages.append(Stage("metaphlan", lambda: metaphlan_extraction(state["reads_data"], dataset_id, threads=threads,
+                                                                      workers=workers, checkpoints=checkpoints,
+                                                                      keep_fastq=pathways in ("yes", "sam")),
+                            after=(after,), label="metaphlan extraction", threads=threads,
+                            outputs=lambda: [final_output_path]))
+    profile_stage = after if profiled else "metaphlan"
+    stages.append(Stage("metaphlan_csv", lambda: metaphlan_txt_csv(state["reads_data"], dataset_id),
+                        after=(profile_stage,), label="converting resualts to CSV",
+                        inputs=lambda: [final_output_path],
+                        outputs=lambda: [os.path.join(dir_path, "export", f"{dataset_id}_final_table.csv")]))
+    if pathways in ("yes", "sam"):  # If pathways is set to "yes"/"sam", run the HUMAnN pipeline
+        stages.append(Stage("pathways", lambda: run_pathways_pipeline(dir_path, dataset_id, threads, workers=workers,
+                                                                      checkpoints=checkpoints,
+                                                                      reuse_alignments=pathways == "sam",
+                                                                      temp_dir=temp_dir),
+                            after=(profile_stage,), label="HUMAnN pathways", threads=threads,
+                            inputs=lambda: [final_output_path]))
+    return stages
+
+
+def finish_16s(state: dict, verbose_print):
+    reads_data = state["reads_data"]
+    pickle.dump(reads_data, open(os.path.join(reads_data.dir_path, "reads_data.pkl"), "wb"))
+    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating visualization\n")
+    print_trim_trunc_note(reads_data, state["vis_file_path"])
+    return reads_data.dir_path
 
 
 # This function is the main function to download the project. It Handles all the download flow for 16S and Shotgun.
 def visualization(acc_list, dataset_id, data_type, verbose_print, specific_location,as_single, 
-                  threads: int = 8, pathways: str = "no"):
+                  threads: int = 8, pathways: str = "no", workers: int = 1,
+                  stream: bool = False, max_in_flight: int = 4, run_info: str = None, download_workers: int = 4,
+                  temp_dir: str = None, store: AccessionStore = None, dir_path: str = None, summary: bool = False,
+                  command_timeout: float = None, new_accessions: list = None):
+    # dir_path: an existing project directory to resume, every stage recorded in its checkpoints is skipped.
+    # new_accessions: the accessions of acc_list added to the project in dir_path since it was downloaded (--update),
+    # only these are downloaded, converted and profiled, and the project wide stages run again over all the samples.
     
     verbose_print("\n")
     verbose_print(datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
@@ -323,168 +505,121 @@ def visualization(acc_list, dataset_id, data_type, verbose_print, specific_locat
     check_input(acc_list)
 
     verbose_print("\n")
-    verbose_print("Creating a new directory for this dataset import:'", dir_name, "'")
-    # Path to working dir:
-    dir_path = create_dir(dir_name, specific_location)
-    verbose_print("Find ALL NEW data in:", dir_path)
+    if dir_path is None:
+        verbose_print("Creating a new directory for this dataset import:'", dir_name, "'")
+        # Path to working dir:
+        dir_path = create_dir(dir_name, specific_location)
+        verbose_print("Find ALL NEW data in:", dir_path)
+    else:
+        verbose_print("Resuming the dataset import in:", dir_path)
     json_file_path = f"{dir_path}/metadata.json"
+    checkpoints = Checkpoints(dir_path)
+    if os.path.isfile(json_file_path):
+        with open(json_file_path) as json_file:
+            data_json = json.load(json_file)
 
-    # This two stages are for all data type. Prefetching the data from the relevant database, and converting it to fatsqs.
-    verbose_print("\n")
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start prefetch (1/6)")
-    download_data_from_sra(dir_path, acc_list)
-
+    # Everything needed to resume this import with --resume
     data_json["dir_path"] = dir_path
     data_json["dataset_id"] = dataset_id
-    with open(json_file_path, "w") as json_file:
-        json.dump(data_json, json_file)
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish prefetch (1/6)")
-
-    verbose_print("\n")
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start conversion (2/6)")
-    reads_data = sra_to_fastq(dir_path, as_single)
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish conversion (2/6)")
-
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start creating metadata.json (3/6)")
-
-    # Store dir_path and reads_data in the data_json dictionary
     data_json["type"] = data_type
-    data_json["read_data_fwd"] = reads_data.fwd
-    data_json["read_data_rev"] = reads_data.rev
-
+    data_json["acc_list"] = os.path.abspath(acc_list)
+    data_json["run_info"] = os.path.abspath(run_info) if run_info else None
+    data_json["as_single"] = as_single
+    data_json["stream"] = stream
+    data_json["pathways"] = pathways
     with open(json_file_path, "w") as json_file:
         json.dump(data_json, json_file)
+    if store is not None:
+        # the project keeps its accessions in the store even once its own links are deleted (e.g. streamed)
+        store.add_project(dir_path, new_accessions or read_acc_list(acc_list))
+
+    state = {}
+
+    def convert():
+        if stream:
+            # Every accession goes through prefetch, conversion and (Shotgun) metaphlan on its own.
+            from .streaming import stream_accessions
+            reads_data = stream_accessions(dir_path, new_accessions or read_acc_list(acc_list), dataset_id, data_type,
+                                           as_single, threads=threads, workers=workers, max_in_flight=max_in_flight,
+                                           keep_fastq=pathways in ("yes", "sam"),
+                                           run_info=run_info, temp_dir=temp_dir,
+                                           store=store, checkpoints=checkpoints)
+        else:
+            reads_data = sra_to_fastq(dir_path, as_single, threads=threads, workers=workers, temp_dir=temp_dir,
+                                      store=store, accessions=new_accessions, run_info=run_info)
+        # Store dir_path and reads_data in the data_json dictionary
+        data_json["read_data_fwd"] = reads_data.fwd
+        data_json["read_data_rev"] = reads_data.rev
+        with open(json_file_path, "w") as json_file:
+            json.dump(data_json, json_file)
+        state["reads_data"] = reads_data
+
+    def load_reads_data():
+        # the conversion was skipped on resume, the reads layout was recorded in metadata.json
+        if "reads_data" not in state:
+            state["reads_data"] = ReadsData(dir_path, fwd=data_json["read_data_fwd"], rev=data_json["read_data_rev"])
 
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating metadata.json (3/6)")
+    # This two stages are for all data type. Prefetching the data from the relevant database, and converting it to fatsqs.
+    stages = []
+    if not stream:
+        stages.append(Stage("prefetch", lambda: download_data_from_sra(dir_path, acc_list, run_info=run_info,
+                                                                       workers=download_workers, store=store,
+                                                                       accessions=new_accessions),
+                            label="prefetch", inputs=lambda: [acc_list]))
+    stages += [
+        Stage("conversion", convert, after=() if stream else ("prefetch",), threads=threads,
+              label="streaming prefetch and conversion" if stream else "conversion"),
+        Stage("metadata", load_reads_data, after=("conversion",), label="creating metadata.json", checkpoint=False),
+    ]
+    stages += analysis_stages(state, dir_path, dataset_id, data_type, threads, workers, pathways, checkpoints,
+                              profiled=stream, after="metadata", temp_dir=temp_dir)
+    if new_accessions:
+        # the per-sample checkpoints (metaphlan:<sample>, humann:<sample>) of the samples already there still hold
+        for stage in stages:
+            checkpoints.forget(stage.name)
+    run_report = RunReport(dir_path, "download")
+    run_stages(stages, log=verbose_print, threads=threads, checkpoints=checkpoints, report=run_report,
+               command_timeout=command_timeout)
+    if summary:
+        print(run_report.summary())
 
     if data_type == '16S' or data_type == '18S':
-
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start creating manifest (4/6)")
-        create_manifest(reads_data)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating manifest (4/6)")
-
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime import' (5/6)")
-        qza_file_path = qiime_import(reads_data)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime import' (5/6)")
-
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime demux' (6/6)")
-        vis_file_path = qiime_demux(reads_data, qza_file_path, dataset_id)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime demux' (6/6)")
-
-        pickle.dump(reads_data, open(os.path.join(reads_data.dir_path, "reads_data.pkl"), "wb"))
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating visualization\n")
-
-        print(f"Visualization file is located in {vis_file_path}\n"
-              f"Please drag this file to https://view.qiime2.org/ and continue.\n")
-        if reads_data.fwd and reads_data.rev:
-            print(f"Note: The data has both forward and reverse reads.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"as a tuple of two integers."
-                  f"The first place related to the forward read and the second to the reverse.")
-        else:
-            print(f"Note: The data has only a forward read.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"exactly one integers value which is related to the forward read.")
-
-        return reads_data.dir_path
-    
-    else:  # shotgun
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start metaphlan extraction (4/6)")
-        metaphlan_extraction(reads_data, dataset_id)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish metaphlan extraction (4/6)")
-
-        verbose_print("\n")
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start converting resualts to CSV (5/6)")
-        metaphlan_txt_csv(reads_data, dataset_id)
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- finish converting resualts to CSV (5/6)")
-
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finished downloading. 6/6 \n")
-        
-        if pathways == "yes":  # If pathways is set to "yes", run the HUMAnN pipeline
-            run_pathways_pipeline(dir_path, dataset_id, threads)
+        return finish_16s(state, verbose_print)
+    verbose_print("\n")
+    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finished downloading.\n")
 
 
 def visualization_continue_fastq(dataset_id, continue_path, data_type, verbose_print, specific_location, 
-                                  threads, pathways):
+                                  threads, pathways, workers: int = 1, temp_dir: str = None, summary: bool = False,
+                                  command_timeout: float = None):
     continue_path = Path(continue_path)
     verbose_print("\n")
     verbose_print('Checking environment...', end=" ")
     check_conda_qiime2()
     verbose_print('Done.')
 
-    verbose_print("\n")
-    data_json = {}
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start conversion (1/5)")
-    reads_data = sra_to_fastq(continue_path, as_single=False)
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish conversion (1/5)")
+    state = {}
 
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start creating metadata.json (2/5)")
+    def convert():
+        state["reads_data"] = sra_to_fastq(continue_path, as_single=False, threads=threads, workers=workers,
+                                           temp_dir=temp_dir)
 
-    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating metadata.json (2/5)")
+    stages = [Stage("conversion", convert, label="conversion", threads=threads)]
+    stages += analysis_stages(state, continue_path, dataset_id, data_type, threads, workers, pathways,
+                              Checkpoints(continue_path), temp_dir=temp_dir)
+    run_report = RunReport(continue_path, "continue_from_fastq")
+    run_stages(stages, log=verbose_print, threads=threads, report=run_report, command_timeout=command_timeout)
+    if summary:
+        print(run_report.summary())
 
     if data_type == '16S' or data_type == '18S':
+        return finish_16s(state, verbose_print)
+    verbose_print("\n")
+    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finished downloading.\n")
 
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start creating manifest (3/5)")
-        create_manifest(reads_data)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating manifest (3/5)")
-        sra_dir = continue_path / "sra"
-        #if sra_dir.exists():          # only delete if it still exists
-            #shutil.rmtree(sra_dir)
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime import' (4/5)")
-        qza_file_path = qiime_import(reads_data)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime import' (4/5)")
-
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime demux' (5/5)")
-        vis_file_path = qiime_demux(reads_data, qza_file_path, dataset_id)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime demux' (5/5)")
-
-        pickle.dump(reads_data, open(os.path.join(reads_data.dir_path, "reads_data.pkl"), "wb"))
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating visualization\n")
-
-        print(f"Visualization file is located in {vis_file_path}\n"
-              f"Please drag this file to https://view.qiime2.org/ and continue.\n")
-        if reads_data.fwd and reads_data.rev:
-            print(f"Note: The data has both forward and reverse reads.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"as a tuple of two integers."
-                  f"The first place related to the forward read and the second to the reverse.")
-        else:
-            print(f"Note: The data has only a forward read.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"exactly one integers value which is related to the forward read.")
-            
-        return reads_data.dir_path
-    
-    else:  # shotgun
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start metaphlan extraction (3/5)")
-        metaphlan_extraction(reads_data, dataset_id)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish metaphlan extraction (3/5)")
-
-        verbose_print("\n")
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start converting resualts to CSV (4/5)")
-        metaphlan_txt_csv(reads_data, dataset_id)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- finish converting resualts to CSV (4/5)")
-
-        if pathways == "yes":  # If pathways is set to "yes", run the HUMAnN pipeline
-            run_pathways_pipeline(continue_path, dataset_id, threads)
-                
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finished downloading. 5/5 \n")
-
-
-def visualization_continue(dataset_id, continue_path, data_type, verbose_print, specific_location, threads, pathways):
+
+def visualization_continue(dataset_id, continue_path, data_type, verbose_print, specific_location, threads, pathways,
+                           workers: int = 1, summary: bool = False, command_timeout: float = None):
     verbose_print("\n")
     verbose_print('Checking environment...', end=" ")
     check_conda_qiime2()
@@ -506,56 +641,17 @@ def visualization_continue(dataset_id, continue_path, data_type, verbose_print,
             f"Error: Metadata file not found at {json_file_path}. Please check the path and try again, or try --download command to start a new download of this data.")
         return
 
-    if data_type == '16S' or data_type == '18S':
-
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start creating manifest (1/3)")
-        create_manifest(reads_data)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating manifest (1/3)")
-        sra_path = os.path.join(continue_path, "sra")
-        #if os.path.isdir(sra_path):
-            #shutil.rmtree(sra_path)        
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime import' (2/3)")
-        qza_file_path = qiime_import(reads_data)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime import' (2/3)")
-
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime demux' (3/3)")
-        vis_file_path = qiime_demux(reads_data, qza_file_path, dataset_id)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime demux' (3/3)")
-
-        pickle.dump(reads_data, open(os.path.join(reads_data.dir_path, "reads_data.pkl"), "wb"))
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating visualization\n")
-
-        print(f"Visualization file is located in {vis_file_path}\n"
-              f"Please drag this file to https://view.qiime2.org/ and continue.\n")
-        if reads_data.fwd and reads_data.rev:
-            print(f"Note: The data has both forward and reverse reads.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"as a tuple of two integers."
-                  f"The first place related to the forward read and the second to the reverse.")
-        else:
-            print(f"Note: The data has only a forward read.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"exactly one integers value which is related to the forward read.")
+    state = {"reads_data": reads_data}
+    # the fastq files are already there, "conversion" only anchors the stages that follow it
+    stages = [Stage("conversion", lambda: None, label="reading metadata.json", checkpoint=False)]
+    stages += analysis_stages(state, continue_path, dataset_id, data_type, threads, workers, pathways,
+                              Checkpoints(continue_path))
+    run_report = RunReport(continue_path, "continue_from")
+    run_stages(stages, log=verbose_print, threads=threads, report=run_report, command_timeout=command_timeout)
+    if summary:
+        print(run_report.summary())
 
-        return reads_data.dir_path
-    else:
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start metaphlan extraction (1/2)")
-        metaphlan_extraction(reads_data, dataset_id)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish metaphlan extraction (1/2)")
-
-        verbose_print("\n")
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start converting resualts to CSV (2/2)")
-        metaphlan_txt_csv(reads_data, dataset_id)
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- finish converting resualts to CSV (2/2)")
-        
-        if pathways == "yes":  # If pathways is set to "yes", run the HUMAnN pipeline
-            run_pathways_pipeline(continue_path, dataset_id, threads)
-            
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finished downloading.\n")
+    if data_type == '16S' or data_type == '18S':
+        return finish_16s(state, verbose_print)
+    verbose_print("\n")
+    verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finished downloading.\n")
@@ -1,27 +1,53 @@
 from .create_visualization import visualization
 from .create_visualization import visualization_continue
 from .create_visualization import visualization_continue_fastq
+from .create_visualization import read_acc_list
 from .qiita_visualization import qiita_visualization
 from .fastq_visualization import fastq_visualization
+from .entrez import EntrezClient, fetch_run_info, parse_runinfo, write_run_info
+from .runinfo_cache import RunInfoCache, default_cache_path
+from .accession_store import AccessionStore
+from .quality_profile import profile_samples, project_dataset_id
+from .export_data import export
 
+import json
 import os
 
 
 # This function downloads the accession list for the specified project (Using the SRA databse, which holds all the necessery metadata.)
-def get_acc_list(bio_project_name, verbose_print):
-    get_run_info_command = f'esearch -db sra -query {bio_project_name} | efetch -format runinfo > {bio_project_name}_run_info.csv'
-    os.system(get_run_info_command)
+def get_acc_list(bio_project_name, verbose_print, cache: RunInfoCache = None, client=None):
+    rows = cache.get_project(bio_project_name) if cache is not None else None
+    if rows is not None:
+        verbose_print(f"using the cached run info of {bio_project_name}")
+        header = list(rows[0].keys())
+    elif cache is not None and cache.offline:
+        raise LookupError(f"The run info of {bio_project_name} is not cached, can't fetch it in offline mode.")
+    else:
+        header, rows = parse_runinfo((client or EntrezClient()).fetch_runinfo(bio_project_name))
+        if not rows:
+            raise LookupError(f"Entrez has no run info for {bio_project_name}")
+        if cache is not None:
+            cache.put_runs(rows, bioproject=bio_project_name)
+    write_run_info(header, rows, f"{bio_project_name}_run_info.csv")
     verbose_print(f"downloaded the run info at {bio_project_name}_run_info.csv")
 
-    get_acc_info_command = f"cat {bio_project_name}_run_info.csv | cut -f 1 -d ',' | grep -e ERR -e SRR > {bio_project_name}_acc_info.txt"
-    os.system(get_acc_info_command)
+    with open(f"{bio_project_name}_acc_info.txt", 'w') as acc_info:
+        for row in rows:
+            if "ERR" in row["Run"] or "SRR" in row["Run"]:
+                acc_info.write(row["Run"] + "\n")
     verbose_print(f"downloaded the accession list at {bio_project_name}_acc_info.txt")
 
     return f"{bio_project_name}_acc_info.txt"
 
 
 def download(dataset_name, data_type, acc_list, verbose, specific_location,as_single, 
-              threads: int = 8, pathways: str = "no"):
+              threads: int = 8, pathways: str = "no", workers: int = 1,
+              stream: bool = False, max_in_flight: int = 4, download_workers: int = 4, temp_dir: str = None,
+              entrez_batch_size: int = 200, offline: bool = False, cache_ttl: float = 30, store: str = None,
+              summary: bool = False, command_timeout: float = None, auto_export: str = None,
+              amplicon_length: int = None, dada2_sweep: float = None,
+              classify_workers: int = 1, classify_batch: int = None,
+              classifier_service: float = None):
     
     verbose_print = print if verbose else lambda *a, **k: None
     as_single= True if as_single else False
@@ -32,43 +58,171 @@ def download(dataset_name, data_type, acc_list, verbose, specific_location,as_si
     # checking if the acc_list is provided
     acc_list_path = acc_list if acc_list else None
 
+    cache = RunInfoCache(default_cache_path(specific_location), ttl_days=cache_ttl, offline=offline)
     if acc_list_path is None:
-        acc_list_path = get_acc_list(dataset_name, verbose_print)
+        acc_list_path = get_acc_list(dataset_name, verbose_print, cache=cache)
+        run_info = f"{dataset_name}_run_info.csv"
     else:
-        acc_list_path=get_project_list(dataset_name,acc_list_path, verbose_print)
-    visualization(acc_list_path, dataset_name, data_type, verbose_print, specific_location,as_single, 
-                   threads=threads, pathways=pathways)
-
-
-def get_project_list(bio_project_name, acc_list_path, verbose_print):
+        acc_list_path=get_project_list(dataset_name,acc_list_path, verbose_print, batch_size=entrez_batch_size,
+                                       cache=cache)
+        run_info = f"{dataset_name}.csv"
+    dir_path = visualization(acc_list_path, dataset_name, data_type, verbose_print, specific_location,as_single, 
+                   threads=threads, pathways=pathways, workers=workers,
+                   stream=stream, max_in_flight=max_in_flight, run_info=run_info,
+                   download_workers=download_workers, temp_dir=temp_dir,
+                   store=AccessionStore(store) if store else None, summary=summary,
+                   command_timeout=command_timeout)
+    export_automatically(dir_path, data_type, auto_export, threads, amplicon_length, summary, command_timeout,
+                         dada2_sweep, classify_workers, classify_batch, classifier_service)
+
+
+def get_project_list(bio_project_name, acc_list_path, verbose_print, client=None, batch_size: int = 200,
+                     workers: int = 3, cache: RunInfoCache = None):
     # if we are given a list of accession numbers, we will use them and produce the run info file of each sample and its metadata
     with open(acc_list_path, 'r') as f:
-        acc_list = f.read().splitlines()
-        get_run_info_command = f'esearch -db sra -query {acc_list[0]} | efetch -format runinfo > {bio_project_name}.csv'
-        os.system(get_run_info_command)
-
-        # Loop through the rest of the accession numbers and append the results
-        for acc in acc_list[1:]:
-            get_run_info_command = f'esearch -db sra -query {acc} | efetch -format runinfo >> {bio_project_name}.csv'
-            os.system(get_run_info_command)
+        acc_list = [acc.strip() for acc in f.read().splitlines() if acc.strip()]
+    cached = cache.get_runs(acc_list) if cache is not None else {}
+    missing = [acc for acc in acc_list if acc not in cached]
+    header, rows = None, []
+    if missing and cache is not None and cache.offline:
+        raise LookupError(f"The run info of {', '.join(missing)} is not cached, can't fetch it in offline mode.")
+    if missing:
+        header, rows = fetch_run_info(missing, client=client, batch_size=batch_size, workers=workers)
+        if cache is not None:
+            cache.put_runs(rows)
+    verbose_print(f"{len(cached)} accessions found in the run info cache, {len(missing)} fetched from Entrez")
+    found = {**cached, **{row["Run"]: row for row in rows}}
+    rows = [found[acc] for acc in dict.fromkeys(acc_list)]
+    header = header or (list(rows[0].keys()) if rows else None)
+    write_run_info(header, rows, f"{bio_project_name}.csv")
     verbose_print(f"downloaded the run info at {bio_project_name}.csv")
     return f"{acc_list_path}"
 
 
-def continue_from(dataset_id,continue_path, data_type, verbose, specific_location, threads, pathways):
+def resume(dir_path, verbose, specific_location, threads: int = 8, workers: int = 1, max_in_flight: int = 4,
+           download_workers: int = 4, temp_dir: str = None, store: str = None, summary: bool = False,
+           command_timeout: float = None, auto_export: str = None, amplicon_length: int = None,
+           dada2_sweep: float = None, classify_workers: int = 1, classify_batch: int = None,
+           classifier_service: float = None):
+    # Picks up an interrupted --download where it stopped, using the settings recorded in its metadata.json
+    verbose_print = print if verbose else lambda *a, **k: None
+    json_file_path = os.path.join(dir_path, "metadata.json")
+    if not os.path.isfile(json_file_path):
+        raise FileNotFoundError(f"No metadata.json in {dir_path}, can't resume it.")
+    with open(json_file_path) as json_file:
+        data_json = json.load(json_file)
+    if "acc_list" not in data_json:
+        raise ValueError(f"{dir_path} was created by an older YaMAS version, use --continue_from/--continue_from_fastq.")
+
+    verbose_print("\n")
+    verbose_print(f"Resuming {data_json['dataset_id']} from {dir_path}.")
+    dir_path = visualization(data_json["acc_list"], data_json["dataset_id"], data_json["type"], verbose_print,
+                             specific_location, data_json["as_single"], threads=threads, pathways=data_json["pathways"],
+                             workers=workers, stream=data_json["stream"], max_in_flight=max_in_flight,
+                             run_info=data_json["run_info"], download_workers=download_workers, temp_dir=temp_dir,
+                             store=AccessionStore(store) if store else None, dir_path=os.path.abspath(dir_path),
+                             summary=summary, command_timeout=command_timeout)
+    export_automatically(dir_path, data_json["type"], auto_export, threads, amplicon_length, summary, command_timeout,
+                         dada2_sweep, classify_workers, classify_batch, classifier_service)
+
+
+def update(dir_path, verbose, specific_location, acc_list: str = None, threads: int = 8, workers: int = 1,
+           max_in_flight: int = 4, download_workers: int = 4, temp_dir: str = None, entrez_batch_size: int = 200,
+           offline: bool = False, cache_ttl: float = 30, store: str = None, summary: bool = False,
+           command_timeout: float = None, auto_export: str = None, amplicon_length: int = None,
+           classify_workers: int = 1, classify_batch: int = None, classifier_service: float = None):
+    # Adds the accessions the BioProject (or the given acc_list) gained since the project in dir_path was downloaded:
+    # only these are downloaded and profiled, then the project wide outputs are rebuilt over all the samples.
+    verbose_print = print if verbose else lambda *a, **k: None
+    json_file_path = os.path.join(dir_path, "metadata.json")
+    if not os.path.isfile(json_file_path):
+        raise FileNotFoundError(f"No metadata.json in {dir_path}, can't update it.")
+    with open(json_file_path) as json_file:
+        data_json = json.load(json_file)
+    if "acc_list" not in data_json:
+        raise ValueError(f"{dir_path} was created by an older YaMAS version, download it again to update it.")
+    dataset_id = data_json["dataset_id"]
+    # read first, the accession list of a BioProject is rewritten by get_acc_list below
+    previous = read_acc_list(data_json["acc_list"])
+
+    verbose_print("\n")
+    verbose_print(f"Updating {dataset_id} in {dir_path}.")
+    if acc_list is None:
+        if not str(data_json.get("run_info")).endswith("_run_info.csv"):
+            raise ValueError(f"{dataset_id} was downloaded from an accession list, give the current one with --acc_list.")
+        # the run info of the BioProject is always fetched again (unless offline), to see its new runs
+        cache = RunInfoCache(default_cache_path(specific_location), ttl_days=0, offline=offline)
+        current = read_acc_list(get_acc_list(dataset_id, verbose_print, cache=cache))
+        run_info = f"{dataset_id}_run_info.csv"
+    else:
+        cache = RunInfoCache(default_cache_path(specific_location), ttl_days=cache_ttl, offline=offline)
+        current = read_acc_list(get_project_list(dataset_id, acc_list, verbose_print, batch_size=entrez_batch_size,
+                                                 cache=cache))
+        run_info = f"{dataset_id}.csv"
+
+    new_accessions = [acc for acc in dict.fromkeys(current) if acc not in set(previous)]
+    if not new_accessions:
+        print(f"{dataset_id} is up to date, no new accessions.")
+        return dir_path
+    print(f"{len(new_accessions)} new accessions: {', '.join(new_accessions)}")
+    # the project keeps the list of all its accessions, for the next --resume/--update
+    acc_list_path = os.path.join(os.path.abspath(dir_path), "acc_list.txt")
+    with open(acc_list_path, 'w') as f:
+        f.writelines(f"{acc}\n" for acc in previous + new_accessions)
+
+    dir_path = visualization(acc_list_path, dataset_id, data_json["type"], verbose_print, specific_location,
+                             data_json["as_single"], threads=threads, pathways=data_json["pathways"], workers=workers,
+                             stream=data_json["stream"], max_in_flight=max_in_flight, run_info=run_info,
+                             download_workers=download_workers, temp_dir=temp_dir,
+                             store=AccessionStore(store) if store else None, dir_path=os.path.abspath(dir_path),
+                             summary=summary, command_timeout=command_timeout, new_accessions=new_accessions)
+    export_automatically(dir_path, data_json["type"], auto_export, threads, amplicon_length, summary, command_timeout,
+                         classify_workers=classify_workers, classify_batch=classify_batch,
+                         classifier_service=classifier_service, incremental=True)
+    return dir_path
+
+
+def continue_from(dataset_id,continue_path, data_type, verbose, specific_location, threads, pathways, workers: int = 1,
+                  summary: bool = False, command_timeout: float = None, auto_export: str = None,
+                  amplicon_length: int = None, dada2_sweep: float = None,
+                  classify_workers: int = 1, classify_batch: int = None,
+                  classifier_service: float = None):
     verbose_print = print if verbose else lambda *a, **k: None
     verbose_print("\n")
     verbose_print(f"Continue downloading from {continue_path}.")
-    visualization_continue(dataset_id,continue_path, data_type, verbose_print, specific_location, threads=threads, pathways=pathways)
+    dir_path = visualization_continue(dataset_id,continue_path, data_type, verbose_print, specific_location, threads=threads, pathways=pathways,
+                                      workers=workers, summary=summary, command_timeout=command_timeout)
+    export_automatically(dir_path, data_type, auto_export, threads, amplicon_length, summary, command_timeout,
+                         dada2_sweep, classify_workers, classify_batch, classifier_service)
 
     
 def continue_from_fastq(dataset_id, continue_path, data_type, verbose, specific_location, 
-                        threads, pathways):
+                        threads, pathways, workers: int = 1, temp_dir: str = None, summary: bool = False,
+                        command_timeout: float = None, auto_export: str = None, amplicon_length: int = None,
+                        dada2_sweep: float = None, classify_workers: int = 1, classify_batch: int = None,
+                        classifier_service: float = None):
     verbose_print = print if verbose else lambda *a, **k: None
     verbose_print("\n")
     verbose_print(f"Continue downloading from {continue_path}.")
-    visualization_continue_fastq(dataset_id,continue_path, data_type, verbose_print, specific_location, 
-                                  threads=threads, pathways=pathways)
+    dir_path = visualization_continue_fastq(dataset_id,continue_path, data_type, verbose_print, specific_location, 
+                                            threads=threads, pathways=pathways, workers=workers, temp_dir=temp_dir,
+                                            summary=summary, command_timeout=command_timeout)
+    export_automatically(dir_path, data_type, auto_export, threads, amplicon_length, summary, command_timeout,
+                         dada2_sweep, classify_workers, classify_batch, classifier_service)
+
+
+def export_automatically(dir_path, data_type, classifier_file_path, threads, amplicon_length: int = None,
+                         summary: bool = False, command_timeout: float = None, dada2_sweep: float = None,
+                         classify_workers: int = 1, classify_batch: int = None,
+                         classifier_service: float = None, incremental: bool = False):
+    # --auto_export: a 16S/18S project goes on to export() with trim/trunc picked from its quality profile,
+    # instead of stopping for the .qzv to be inspected (incremental: after --update, see export).
+    if not classifier_file_path or data_type not in ('16S', '18S') or not dir_path:
+        return
+    export(dir_path, data_type, "auto", "auto", classifier_file_path, threads, summary=summary,
+           command_timeout=command_timeout, amplicon_length=amplicon_length, dada2_sweep=dada2_sweep,
+           classify_workers=classify_workers, classify_batch=classify_batch, classifier_service=classifier_service,
+           incremental=incremental)
 
 
 # This function is used to download the qiita data
@@ -83,4 +237,16 @@ def download_fastq(fastq_path,barcode_path,metadata_path,data_type, verbose):
     verbose_print = print if verbose else lambda *a, **k: None
     verbose_print("\n")
     verbose_print("download starts.")
-    fastq_visualization(fastq_path,barcode_path, metadata_path, data_type, verbose_print)
\ No newline at end of file
+    fastq_visualization(fastq_path,barcode_path, metadata_path, data_type, verbose_print)
+
+
+def store_gc(store_path, dry_run: bool = False):
+    # Removes the stored .sra/.fastq files that no project links to anymore.
+    print(f"Collecting unused files in {store_path}.")
+    AccessionStore(store_path).gc(dry_run=dry_run)
+
+
+def quality_profile(dir_path, subsample: float = None, workers: int = 1):
+    # Quality profile of the fastq files of an existing project, without going through qiime demux summarize.
+    print(f"Profiling the read qualities of {dir_path}.")
+    return profile_samples(dir_path, project_dataset_id(dir_path), subsample=subsample, workers=workers)
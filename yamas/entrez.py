@@ -0,0 +1,79 @@
+import csv
+import io
+import shlex
+
+from .utilities import cmd_output, run_in_pool
+
+# seconds an esearch | efetch query may take before it is killed
+ENTREZ_TIMEOUT = 600
+
+
+class EntrezClient:
+    # Runs run-info queries through the Entrez Direct command line tools (esearch | efetch).
+    # Anything with a fetch_runinfo(query) -> csv text method can be used instead, e.g. a local fake in tests.
+
+    def __init__(self, esearch: str = "esearch", efetch: str = "efetch", timeout: float = ENTREZ_TIMEOUT):
+        self.esearch = esearch
+        self.efetch = efetch
+        self.timeout = timeout
+
+    def fetch_runinfo(self, query: str):
+        # pipefail: a failing esearch fails the query, instead of leaving efetch nothing to fetch
+        pipeline = f"{self.esearch} -db sra -query {shlex.quote(query)} | {self.efetch} -format runinfo"
+        return cmd_output(["bash", "-o", "pipefail", "-c", shlex.quote(pipeline)], timeout=self.timeout)
+
+
+def parse_runinfo(text: str):
+    # efetch may return several csv blocks (each with its own header) and blank lines between them
+    rows, header = [], None
+    for row in csv.reader(io.StringIO(text)):
+        if not row or not any(row):
+            continue
+        if row[0] == "Run":
+            header = row
+        elif header is not None:
+            rows.append(dict(zip(header, row)))
+    return header, rows
+
+
+def fetch_run_info(accessions: list, client=None, batch_size: int = 200, workers: int = 3):
+    # Fetches the run info of all accessions in OR-joined batches, `workers` batches at a time
+    # (NCBI allows ~3 requests/second without an API key).
+    # Returns the csv header and the rows de-duplicated by run accession, in accession list order.
+    # Raises if a batch failed or Entrez has no run info for some of the accessions.
+    client = client or EntrezClient()
+    accessions = list(dict.fromkeys(accessions))
+    batches = [accessions[i:i + batch_size] for i in range(0, len(accessions), batch_size)]
+    results = {}
+
+    def fetch(batch_index):
+        header, rows = parse_runinfo(client.fetch_runinfo(" OR ".join(batches[batch_index])))
+        if header is None:
+            raise RuntimeError("Entrez returned no run info")
+        results[batch_index] = header, rows
+
+    failures = run_in_pool(fetch, list(range(len(batches))), workers=workers, desc="run info batches")
+    for batch_index, error in failures.items():
+        print(f"Could not fetch the run info of {', '.join(batches[batch_index])}: {error}")
+
+    header, rows = None, {}
+    for batch_index in sorted(results):
+        batch_header, batch_rows = results[batch_index]
+        header = header or batch_header
+        for row in batch_rows:
+            rows.setdefault(row["Run"], row)
+    failed = {acc for batch_index in failures for acc in batches[batch_index]}
+    missing = [acc for acc in accessions if acc not in rows and acc not in failed]
+    if missing:
+        print(f"Entrez has no run info for {', '.join(missing)}")
+    if failed or missing:
+        raise RuntimeError(f"The run info of {len(failed) + len(missing)} of {len(accessions)} accessions "
+                           f"could not be fetched")
+    return header, [rows[acc] for acc in accessions]
+
+
+def write_run_info(header: list, rows: list, output_path: str):
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=header or ["Run"], extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
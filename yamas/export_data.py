@@ -2,9 +2,12 @@ from __future__ import annotations
 
 import csv
 import datetime
+import itertools
+import json
 import os
 import pickle
 import re
+import shutil
 
 import pandas as pd
 from biom import Table, load_table
@@ -12,7 +15,15 @@ import qiime2 as q2
 from skbio import TreeNode
 from Bio import Phylo
 
-from .utilities import ReadsData, run_cmd, download_classifier_url, check_conda_qiime2
+from .utilities import ReadsData, run_cmd, run_in_pool, download_classifier_url, check_conda_qiime2
+from .scheduler import Stage, run_stages
+from .run_report import RunReport
+from .resources import tool_threads
+from .quality_profile import recommend_trim_trunc, project_dataset_id
+from .classifier_service import classify_with_service
+from .create_visualization import qiime_import
+from . import taxonomy_cache
+from .taxonomy_cache import sequence_md5
 
 nodes_names = []
 
@@ -42,8 +53,11 @@ def classifier_exists(classifier_path: str):
 
 
 def qiime_dada2(reads_data: ReadsData, input_path: str,
-                left: int | tuple[int, int], right: int | tuple[int, int], threads: int = 12):
+                left: int | tuple[int, int], right: int | tuple[int, int], threads: int = 12,
+                output_dir: str = None, workers: int = 1):
+    # output_dir: where the table/rep-seqs/stats go (default: qza/), workers: dada2 runs sharing the threads
     paired = reads_data.fwd and reads_data.rev
+    qza_dir = output_dir or os.path.join(reads_data.dir_path, "qza")
 
     trim_range = ["--p-trim-left-f", str(left.split(',')[0]), "--p-trim-left-r", str(left.split(',')[1])] if paired \
         else ["--p-trim-left", str(left)]
@@ -54,14 +68,179 @@ def qiime_dada2(reads_data: ReadsData, input_path: str,
                   "qiime", "dada2", "denoise-paired" if paired else "denoise-single",
                   "--i-demultiplexed-seqs", input_path,
               ] + trim_range + trunc_range + [
-                  "--o-table", os.path.join(reads_data.dir_path, "qza", "dada2_table.qza"),
-                  "--p-n-threads", str(threads),
+                  "--o-table", os.path.join(qza_dir, "dada2_table.qza"),
+                  "--p-n-threads", str(tool_threads(workers, threads)),
                   "--p-chimera-method", "consensus",
-                  "--o-representative-sequences", os.path.join(reads_data.dir_path, "qza", "dada2_rep-seqs.qza"),
-                  "--o-denoising-stats", os.path.join(reads_data.dir_path, "qza", "dada2_denoising-stats.qza"),
+                  "--o-representative-sequences", os.path.join(qza_dir, "dada2_rep-seqs.qza"),
+                  "--o-denoising-stats", os.path.join(qza_dir, "dada2_denoising-stats.qza"),
                   "--verbose"
               ]
-    run_cmd(command)
+    run_cmd(command, check=True)
+
+
+DADA2_SAMPLES_NAME = "dada2_samples.json"
+
+
+def manifest_rows(dir_path: str):
+    # (header, rows) of the project's manifest.tsv, the sample ID first in each row
+    manifest_path = os.path.join(dir_path, "manifest.tsv")
+    if not os.path.isfile(manifest_path):
+        return [], []
+    with open(manifest_path, newline='') as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    return rows[0], rows[1:]
+
+
+def record_dada2_samples(reads_data: ReadsData, trim, trunc, samples: list):
+    # the samples in qza/dada2_table.qza and the trim/trunc they were denoised with, for an incremental export
+    with open(os.path.join(reads_data.dir_path, "qza", DADA2_SAMPLES_NAME), 'w') as f:
+        json.dump({"trim": str(trim), "trunc": str(trunc), "samples": samples}, f, indent=2)
+
+
+def dada2_samples(reads_data: ReadsData):
+    qza_dir = os.path.join(reads_data.dir_path, "qza")
+    if not os.path.isfile(os.path.join(qza_dir, DADA2_SAMPLES_NAME)) or \
+            not os.path.isfile(os.path.join(qza_dir, "dada2_table.qza")):
+        return None
+    with open(os.path.join(qza_dir, DADA2_SAMPLES_NAME)) as f:
+        return json.load(f)
+
+
+def dada2_increment(reads_data: ReadsData, threads: int = 12):
+    # Denoises only the samples of the manifest missing from dada2_table.qza, with the trim/trunc the table was made
+    # with, and merges their table and representative sequences into it. DADA2 learns its error model from the new
+    # samples alone, as when the sequencing runs of a project are denoised separately.
+    recorded = dada2_samples(reads_data)
+    header, rows = manifest_rows(reads_data.dir_path)
+    new_rows = [row for row in rows if row[0] not in set(recorded["samples"])]
+    if not new_rows:
+        print("Every sample of the manifest is already in dada2_table.qza.")
+        return
+    print(f"Denoising the {len(new_rows)} new samples with trim {recorded['trim']}, trunc {recorded['trunc']}")
+    qza_dir = os.path.join(reads_data.dir_path, "qza")
+    update_dir = os.path.join(qza_dir, f"dada2_update_{datetime.datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}")
+    os.makedirs(update_dir)
+    manifest_path = os.path.join(update_dir, "manifest.tsv")
+    with open(manifest_path, 'w', newline='') as f:
+        csv.writer(f, delimiter='\t').writerows([header] + new_rows)
+    demux_path = qiime_import(reads_data, manifest_path, os.path.join(update_dir, "demux.qza"))
+    qiime_dada2(reads_data, demux_path, recorded["trim"], recorded["trunc"], threads=threads, output_dir=update_dir)
+    for name, action, inputs, output in (("dada2_table.qza", "merge", "--i-tables", "--o-merged-table"),
+                                         ("dada2_rep-seqs.qza", "merge-seqs", "--i-data", "--o-merged-data")):
+        merged_path = os.path.join(update_dir, f"merged_{name}")
+        run_cmd(["qiime", "feature-table", action, inputs, os.path.join(qza_dir, name), os.path.join(update_dir, name),
+                 output, merged_path], check=True)
+        os.replace(merged_path, os.path.join(qza_dir, name))
+    # the reads are in the project's demux qza already, the update's denoising stats stay in update_dir
+    os.remove(demux_path)
+    record_dada2_samples(reads_data, recorded["trim"], recorded["trunc"],
+                         recorded["samples"] + [row[0] for row in new_rows])
+
+
+# truncations tried around the recommended one when a sweep gets trunc "auto"
+SWEEP_OFFSETS = (0, -10, -20, -30)
+# the sweep keeps the longest truncation among the candidates whose retained fraction is within this of the best
+SWEEP_TOLERANCE = 0.02
+
+
+def shift_trunc(trunc: str, offset: int):
+    return ",".join(str(max(1, int(value) + offset)) for value in str(trunc).split(","))
+
+
+def trunc_length(trunc: str):
+    # the bases a truncation keeps, summed over the mates (0 is no truncation at all)
+    return sum(float("inf") if int(value) == 0 else int(value) for value in str(trunc).split(","))
+
+
+def pick_sweep_candidate(rows: list, tolerance: float = SWEEP_TOLERANCE):
+    # Truncating shorter drops the low quality ends, so it almost always retains a little more of the reads:
+    # picking the most retained would favour the shortest truncation. The longest truncation retaining within
+    # `tolerance` of the best is picked instead (the most retained on a tie), the rule is in the "choice" column.
+    done = [row for row in rows if row["status"] == "done"]
+    top = max(row["retained"] for row in done)
+    close = [row for row in done if top - row["retained"] <= tolerance + 1e-9]
+    best = max(close, key=lambda row: (trunc_length(row["trunc"]), row["retained"]))
+    for row in done:
+        row["choice"] = f"picked: longest truncation retaining within {tolerance:g} of the best ({top:g})" \
+            if row is best else "shorter truncation, within tolerance" if row in close else \
+            f"retained more than {tolerance:g} below the best"
+    return best
+
+
+def denoising_stats(output_dir: str):
+    # totals of the denoising stats of a dada2 run (input, filtered, denoised, merged, non-chimeric reads)
+    stats_dir = os.path.join(output_dir, "denoising-stats")
+    run_cmd(["qiime", "tools", "export", "--input-path", os.path.join(output_dir, "dada2_denoising-stats.qza"),
+             "--output-path", stats_dir], check=True)
+    totals = {}
+    with open(os.path.join(stats_dir, "stats.tsv"), newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            # the second line holds the column types
+            if row.get("sample-id", "").startswith("#"):
+                continue
+            for column in ("input", "filtered", "denoised", "merged", "non-chimeric"):
+                if row.get(column):
+                    totals[column] = totals.get(column, 0) + float(row[column])
+    return totals
+
+
+def dada2_parameter_sweep(reads_data: ReadsData, input_path: str, trims: list, truncs: list, threads: int = 12,
+                fraction: float = 0.1):
+    # Runs dada2 with every trim/trunc candidate on a `fraction` subsample of the reads, the candidates at the
+    # same time within the threads budget, compares their denoising stats in vis/<dataset_id>_dada2_sweep.csv
+    # and returns the trim/trunc picked by pick_sweep_candidate.
+    paired = reads_data.fwd and reads_data.rev
+    sweep_dir = os.path.join(reads_data.dir_path, "qza", "dada2_sweep")
+    os.makedirs(sweep_dir, exist_ok=True)
+    subsample_path = os.path.join(sweep_dir, "demux-subsample.qza")
+    run_cmd(["qiime", "demux", "subsample-paired" if paired else "subsample-single",
+             "--i-sequences", input_path, "--p-fraction", str(fraction),
+             "--o-subsampled-sequences", subsample_path], check=True)
+
+    candidates = list(itertools.product(trims, truncs))
+    workers = min(len(candidates), tool_threads(threads=threads))
+    results = {}
+
+    def run(candidate):
+        trim, trunc = candidate
+        output_dir = os.path.join(sweep_dir, f"trim{trim}_trunc{trunc}".replace(",", "-"))
+        os.makedirs(output_dir, exist_ok=True)
+        qiime_dada2(reads_data, subsample_path, trim, trunc, threads=threads, output_dir=output_dir, workers=workers)
+        results[candidate] = denoising_stats(output_dir)
+
+    failures = run_in_pool(run, candidates, workers=workers, desc="dada2 candidates")
+    if not results:
+        raise RuntimeError(f"dada2 failed with every trim/trunc candidate: {next(iter(failures.values()))}")
+
+    rows = []
+    for trim, trunc in candidates:
+        stats = results.get((trim, trunc))
+        if stats is None:
+            rows.append({"trim": trim, "trunc": trunc, "status": f"failed: {failures[(trim, trunc)]}"})
+            continue
+        reads = stats.get("input") or 1
+        kept = stats.get("merged" if paired else "denoised", 0)
+        rows.append({"trim": trim, "trunc": trunc, "status": "done",
+                     **{column: int(value) for column, value in stats.items()},
+                     "retained": round(stats.get("non-chimeric", 0) / reads, 4),
+                     "merged fraction": round(stats.get("merged", 0) / reads, 4) if paired else "",
+                     "chimeric fraction": round(1 - stats.get("non-chimeric", 0) / kept, 4) if kept else ""})
+    best = pick_sweep_candidate(rows)
+
+    columns = ["trim", "trunc", "status", "input", "filtered", "denoised"] + (["merged"] if paired else []) + \
+              ["non-chimeric", "retained"] + (["merged fraction"] if paired else []) + ["chimeric fraction", "choice"]
+    sweep_csv = os.path.join(reads_data.dir_path, "vis", f"{project_dataset_id(reads_data.dir_path)}_dada2_sweep.csv")
+    os.makedirs(os.path.dirname(sweep_csv), exist_ok=True)
+    with open(sweep_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    for row in rows:
+        print(f"trim {row['trim']}, trunc {row['trunc']}: " +
+              (f"{row['retained']:.1%} of the reads retained" if row["status"] == "done" else row["status"]))
+    print(f"Sweep comparison is located in {sweep_csv}\n"
+          f"Best: trim {best['trim']}, trunc {best['trunc']} ({best['retained']:.1%} of the reads retained)")
+    return best["trim"], best["trunc"]
 
 
 def cluster_features(reads_data: ReadsData):
@@ -74,29 +253,127 @@ def cluster_features(reads_data: ReadsData):
         "--o-clustered-table", qza_path("table-dn-99.qza"),
         "--o-clustered-sequences", qza_path("rep-seqs-dn-99.qza")
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
 
-def assign_taxonomy(reads_data: ReadsData, data_type, classifier_path: str):
+def classify_sklearn(reads_path: str, classifier_path: str, output_path: str, jobs: int,
+                     reads_per_batch: int = None, service_idle: float = None):
+    # service_idle: classify through the classifier service, which keeps the classifier loaded between exports
+    # and stops once idle for service_idle seconds (see classifier_service)
+    if service_idle:
+        classify_with_service(reads_path, classifier_path, output_path, jobs, reads_per_batch, service_idle)
+        return
+    command = [
+        "qiime", "feature-classifier", "classify-sklearn",
+        "--i-reads", reads_path,
+        "--i-classifier", classifier_path,
+        "--p-n-jobs", str(jobs),
+        "--o-classification", output_path
+    ]
+    if reads_per_batch:
+        command += ["--p-reads-per-batch", str(reads_per_batch)]
+    run_cmd(command, check=True)
+
+
+def read_fasta(fasta_path: str):
+    # [(header line, sequence lines)] in the order of the file
+    records = []
+    with open(fasta_path) as f:
+        for line in f:
+            if line.startswith(">"):
+                records.append((line, []))
+            elif records:
+                records[-1][1].append(line)
+    return records
+
+
+def feature_id(header: str):
+    return header[1:].split()[0]
+
+
+def classify_records(records: list, work_dir: str, classifier_path: str, workers: int,
+                     reads_per_batch: int = None, service_idle: float = None):
+    # Splits the (header, sequence lines) records into `workers` chunks, classified at the same time with their
+    # share of the threads (each classifier starts once its memory is free, see resources.MemoryGate).
+    # Returns {feature ID: (taxon, confidence)} in the order of the records, whichever chunk ended first.
+    chunk_size = max(1, -(-len(records) // workers))
+    chunks = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+    jobs = tool_threads(len(chunks))
+
+    def classify(index):
+        chunk_path = lambda suffix: os.path.join(work_dir, f"chunk_{index}{suffix}")
+        with open(chunk_path(".fasta"), 'w') as f:
+            for header, sequence in chunks[index]:
+                f.write(header)
+                f.writelines(sequence)
+        run_cmd(["qiime", "tools", "import", "--type", "FeatureData[Sequence]", "--input-path", chunk_path(".fasta"),
+                 "--output-path", chunk_path(".qza")], check=True)
+        classify_sklearn(chunk_path(".qza"), classifier_path, chunk_path("_taxonomy.qza"), jobs, reads_per_batch,
+                         service_idle)
+        run_cmd(["qiime", "tools", "export", "--input-path", chunk_path("_taxonomy.qza"),
+                 "--output-path", chunk_path("_taxonomy")], check=True)
+
+    failures = run_in_pool(classify, list(range(len(chunks))), workers=len(chunks), desc="classified chunks")
+    if failures:
+        raise RuntimeError(f"classify-sklearn failed on {len(failures)} of {len(chunks)} chunks: "
+                           f"{next(iter(failures.values()))}")
+
+    taxonomy = {}
+    for index in range(len(chunks)):
+        with open(os.path.join(work_dir, f"chunk_{index}_taxonomy", "taxonomy.tsv")) as f:
+            next(f)  # Feature ID, Taxon, Confidence
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                taxonomy[fields[0]] = (fields[1], fields[2] if len(fields) > 2 else "")
+    return taxonomy
+
+
+def assign_taxonomy(reads_data: ReadsData, data_type, classifier_path: str, workers: int = 1,
+                    reads_per_batch: int = None, service_idle: float = None):
+    # workers > 1: the sequences are classified in that many chunks at the same time (see classify_records).
+    # With the taxonomy cache (see taxonomy_cache), only the sequences never classified with this classifier
+    # go through classify-sklearn, and the cached and new taxonomies are imported together.
+    qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
     if data_type == '16S':
-        qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
-        command = [
-            "qiime", "feature-classifier", "classify-sklearn",
-            "--i-reads", qza_path("rep-seqs-dn-99.qza"),
-            "--i-classifier", classifier_path,
-            "--o-classification", qza_path("gg-13-8-99-nb-classified.qza")
-        ]
-        run_cmd(command)
-
-    if data_type == '18S':
-        qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
-        command = [
-            "qiime", "feature-classifier", "classify-sklearn",
-            "--i-reads", qza_path("rep-seqs-dn-99.qza"),
-            "--i-classifier", classifier_path,
-            "--o-classification", qza_path("silva-132-99-nb-classifier.qza")
-        ]
-        run_cmd(command)
+        output_path = qza_path("gg-13-8-99-nb-classified.qza")
+    elif data_type == '18S':
+        output_path = qza_path("silva-132-99-nb-classifier.qza")
+    else:
+        return
+    cache = taxonomy_cache.cache
+    if cache is None and workers == 1:
+        classify_sklearn(qza_path("rep-seqs-dn-99.qza"), classifier_path, output_path, tool_threads(),
+                         reads_per_batch, service_idle)
+        return
+
+    work_dir = qza_path("classify_chunks")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    run_cmd(["qiime", "tools", "export", "--input-path", qza_path("rep-seqs-dn-99.qza"), "--output-path", work_dir],
+            check=True)
+    records = read_fasta(os.path.join(work_dir, "dna-sequences.fasta"))
+    if cache is None:
+        taxonomy = classify_records(records, work_dir, classifier_path, workers, reads_per_batch, service_idle)
+    else:
+        classifier = cache.classifier_digest(classifier_path)
+        sequences = [sequence_md5("".join(sequence)) for _, sequence in records]
+        cached = cache.get(classifier, sequences)
+        unseen = [record for record, sequence in zip(records, sequences) if sequence not in cached]
+        print(f"{len(records) - len(unseen)} of {len(records)} sequences found in the taxonomy cache")
+        new = classify_records(unseen, work_dir, classifier_path, workers, reads_per_batch,
+                               service_idle) if unseen else {}
+        cache.put(classifier, {sequence_md5("".join(sequence)): new[feature_id(header)] for header, sequence in unseen})
+        taxonomy = {feature_id(header): cached.get(sequence) or new[feature_id(header)]
+                    for (header, _), sequence in zip(records, sequences)}
+
+    taxonomy_path = os.path.join(work_dir, "taxonomy.tsv")
+    with open(taxonomy_path, 'w') as f:
+        f.write("Feature ID\tTaxon\tConfidence\n")
+        for feature, (taxon, confidence) in taxonomy.items():
+            f.write(f"{feature}\t{taxon}\t{confidence}\n")
+    run_cmd(["qiime", "tools", "import", "--type", "FeatureData[Taxonomy]", "--input-format", "TSVTaxonomyFormat",
+             "--input-path", taxonomy_path, "--output-path", output_path], check=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
 
 
 def clean_taxonomy1(reads_data: ReadsData, data_type):
@@ -109,7 +386,7 @@ def clean_taxonomy1(reads_data: ReadsData, data_type):
             "--p-exclude", "mitochondria,chloroplast",
             "--o-filtered-table", qza_path("clean_table.qza")
         ]
-        run_cmd(command)
+        run_cmd(command, check=True)
 
     if data_type == '18':
         qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
@@ -120,7 +397,7 @@ def clean_taxonomy1(reads_data: ReadsData, data_type):
             "--p-exclude", "mitochondria,chloroplast",
             "--o-filtered-table", qza_path("clean_table.qza")
         ]
-        run_cmd(command)
+        run_cmd(command, check=True)
 
 
 def clean_taxonomy2(reads_data: ReadsData):
@@ -132,7 +409,7 @@ def clean_taxonomy2(reads_data: ReadsData):
         "--p-min-frequency", "10",
         "--o-filtered-table", qza_path("feature-frequency-filtered-table.qza")
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
 
 def export_otu(reads_data: ReadsData):
@@ -143,7 +420,7 @@ def export_otu(reads_data: ReadsData):
         "--input-path", os.path.join(reads_data.dir_path, "qza", "feature-frequency-filtered-table.qza"),
         "--output-path", os.path.join(reads_data.dir_path, "exports")
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
     # convert
     command = [
@@ -152,7 +429,7 @@ def export_otu(reads_data: ReadsData):
         "-o", output_file,
         "--to-tsv"
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
 
 def export_taxonomy(reads_data: ReadsData, data_type, classifier_file_path):
@@ -164,37 +441,38 @@ def export_taxonomy(reads_data: ReadsData, data_type, classifier_file_path):
             "--input-path", os.path.join(reads_data.dir_path, "qza", "gg-13-8-99-nb-classified.qza"),
             "--output-path", output_file
         ]
-        run_cmd(command)
+        run_cmd(command, check=True)
     if data_type == '18S':
         command = [
             "qiime", "tools", "export",
             "--input-path", os.path.join(reads_data.dir_path, "qza", "silva-132-99-nb-classifier.qza"),
             "--output-path", output_file
         ]
-        run_cmd(command)
+        run_cmd(command, check=True)
 
 
 def export_phylogeny(reads_data: ReadsData):
     # sequence alignment using mafft
     input_file_path = os.path.join(reads_data.dir_path, 'qza', 'rep-seqs-dn-99.qza')
     output_file_path = os.path.join(reads_data.dir_path, 'qza', 'aligned-rep-seqs.qza')
-    command = ["qiime", "alignment", "mafft", "--i-sequences", input_file_path, "--o-alignment", output_file_path]
-    run_cmd(command)
+    command = ["qiime", "alignment", "mafft", "--i-sequences", input_file_path, "--o-alignment", output_file_path,
+               "--p-n-threads", str(tool_threads())]
+    run_cmd(command, check=True)
 
     # Construct a phylogeny using fastree:
     input_file_path = output_file_path
     output_file_path = os.path.join(reads_data.dir_path, 'exports', 'fasttree-tree.qza')
 
     command = ["qiime", "phylogeny", "fasttree", "--i-alignment", input_file_path, "--o-tree", output_file_path,
-               "--verbose"]
-    run_cmd(command)
+               "--p-n-threads", str(tool_threads()), "--verbose"]
+    run_cmd(command, check=True)
 
     # Root the phylogeny:
     input_file_path = output_file_path
     output_file_path = os.path.join(reads_data.dir_path, 'exports', "fasttree-tree-rooted.qza")
 
     command = ["qiime", "phylogeny", "midpoint-root", "--i-tree", input_file_path, "--o-rooted-tree", output_file_path]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
 
 def export_tree(reads_data: ReadsData):
@@ -275,7 +553,18 @@ def append_nodes_names(clade):
             append_nodes_names(sub_clade)
 
 
-def export(output_dir: str, data_type, trim, trunc, classifier_file_path: str, threads: int = 12):
+def export(output_dir: str, data_type, trim, trunc, classifier_file_path: str, threads: int = 12,
+           summary: bool = False, command_timeout: float = None, amplicon_length: int = None,
+           dada2_sweep: float = None, classify_workers: int = 1, classify_batch: int = None,
+           classifier_service: float = None, incremental: bool = False):
+    # trim/trunc "auto": picked from the quality profile of the reads (see quality_profile.recommend_trim_trunc),
+    # amplicon_length makes sure the truncated mates still overlap.
+    # dada2_sweep: first compare the ';' separated trim/trunc candidates (with "auto", the recommended
+    # truncation and shorter ones) on this fraction of the reads, and denoise everything with the best.
+    # classify_workers/classify_batch: classify-sklearn chunks classified at the same time, and its reads-per-batch.
+    # classifier_service: classify through a service keeping the classifier loaded for this many idle minutes.
+    # incremental: only denoise the samples added since the last export (--update), with its trim/trunc, and merge
+    # them into its dada2 table (see dada2_increment). The steps that follow run again over all the features.
     print("\n")
     print(datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
     print(f"### Exporting {data_type} ###")
@@ -287,45 +576,73 @@ def export(output_dir: str, data_type, trim, trunc, classifier_file_path: str, t
     classifier_exists(classifier_file_path)
 
     paired = reads_data.rev and reads_data.fwd
+    recorded = dada2_samples(reads_data) if incremental else None
+    if recorded is None and incremental:
+        print("No earlier dada2 table to add the new samples to, denoising every sample.")
+        incremental = False
+    elif incremental:
+        if trim in ("auto", recorded["trim"]) and trunc in ("auto", recorded["trunc"]):
+            trim, trunc, dada2_sweep = recorded["trim"], recorded["trunc"], None
+        else:
+            print(f"dada2_table.qza was denoised with trim {recorded['trim']}, trunc {recorded['trunc']}, "
+                  f"denoising every sample again with trim {trim}, trunc {trunc}.")
+            incremental = False
+    if trim == "auto" or trunc == "auto":
+        auto_trim, auto_trunc = recommend_trim_trunc(reads_data.dir_path, paired, amplicon_length=amplicon_length)
+        trim = auto_trim if trim == "auto" else trim
+        if trunc == "auto":
+            trunc = ";".join(dict.fromkeys(shift_trunc(auto_trunc, offset) for offset in SWEEP_OFFSETS)) \
+                if dada2_sweep else auto_trunc
+    if not dada2_sweep and (";" in str(trim) or ";" in str(trunc)):
+        raise ValueError("Several trim/trunc candidates are only compared with --dada2_sweep.")
     output_path = os.path.join(reads_data.dir_path, "qza", f"demux-{'paired' if paired else 'single'}-end.qza")
-
-    print("\n")
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start dada2 (1/8)")
-    qiime_dada2(reads_data, output_path, left=trim, right=trunc, threads=threads)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish dada2 (1/8)")
-
-    print("\n")
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start clustering features (2/8)")
-    cluster_features(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish clustering features (2/8)")
-
-    print("\n")
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start assigning taxonomy (3/8)")
-    assign_taxonomy(reads_data, data_type, classifier_file_path)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish assigning taxonomy (3/8)")
-
-    run_cmd(["mkdir", os.path.join(reads_data.dir_path, "exports")])
-
-    print("\n")
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start cleaning taxonomy (4/8)")
-    clean_taxonomy1(reads_data, data_type)
-    clean_taxonomy2(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish cleaning taxonomy (4/8)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start exporting OTU (5/8)")
-    export_otu(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish exporting OTU (5/8)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start exporting taxonomy (6/8)")
-    export_taxonomy(reads_data, data_type, classifier_file_path)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish exporting taxonomy (6/8)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start exporting phylogeny (7/8)")
-    export_phylogeny(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish exporting phylogeny (7/8)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start exporting tree (7/8)")
-    export_tree(reads_data)
-    convert_to_csv(reads_data)
-    export_otu_padding_for_tree(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish exporting tree (7/8)")
+    os.makedirs(os.path.join(reads_data.dir_path, "exports"), exist_ok=True)
+
+    def clean_taxonomy():
+        clean_taxonomy1(reads_data, data_type)
+        clean_taxonomy2(reads_data)
+
+    # The phylogeny (mafft/fasttree) only needs the clustered sequences,
+    # so it runs next to the taxonomy and OTU branch, each with half of the threads.
+    chosen = {"trim": trim, "trunc": trunc}
+
+    def sweep():
+        chosen["trim"], chosen["trunc"] = dada2_parameter_sweep(reads_data, output_path, str(trim).split(";"),
+                                                                str(trunc).split(";"), threads=threads,
+                                                                fraction=dada2_sweep)
+
+    def dada2():
+        if incremental:
+            dada2_increment(reads_data, threads=threads)
+            return
+        qiime_dada2(reads_data, output_path, left=chosen["trim"], right=chosen["trunc"], threads=threads)
+        samples = [row[0] for row in manifest_rows(reads_data.dir_path)[1]]
+        if samples:
+            record_dada2_samples(reads_data, chosen["trim"], chosen["trunc"], samples)
+
+    run_report = RunReport(reads_data.dir_path, "export")
+    sweep_stages = [Stage("dada2_sweep", sweep, label="dada2 parameter sweep", threads=int(threads))] \
+        if dada2_sweep else []
+    run_stages(sweep_stages + [
+        Stage("dada2", dada2, after=("dada2_sweep",) if dada2_sweep else (),
+              label="dada2 (new samples)" if incremental else "dada2", threads=int(threads)),
+        Stage("cluster_features", lambda: cluster_features(reads_data), after=("dada2",),
+              label="clustering features"),
+        Stage("assign_taxonomy", lambda: assign_taxonomy(reads_data, data_type, classifier_file_path,
+                                                         workers=classify_workers, reads_per_batch=classify_batch,
+                                                         service_idle=classifier_service and classifier_service * 60),
+              after=("cluster_features",), label="assigning taxonomy", threads=int(threads) - int(threads) // 2),
+        Stage("clean_taxonomy", clean_taxonomy, after=("assign_taxonomy",), label="cleaning taxonomy"),
+        Stage("export_otu", lambda: export_otu(reads_data), after=("clean_taxonomy",), label="exporting OTU"),
+        Stage("export_taxonomy", lambda: export_taxonomy(reads_data, data_type, classifier_file_path),
+              after=("assign_taxonomy",), label="exporting taxonomy"),
+        Stage("export_phylogeny", lambda: export_phylogeny(reads_data), after=("cluster_features",),
+              label="exporting phylogeny", threads=max(1, int(threads) // 2)),
+        Stage("export_tree", lambda: export_tree(reads_data), after=("export_phylogeny",), label="exporting tree"),
+        Stage("convert_to_csv", lambda: convert_to_csv(reads_data), after=("export_otu", "export_taxonomy"),
+              label="converting to csv"),
+        Stage("otu_padding", lambda: export_otu_padding_for_tree(reads_data), after=("export_tree", "convert_to_csv"),
+              label="padding OTU for tree"),
+    ], threads=int(threads), report=run_report, command_timeout=command_timeout)
+    if summary:
+        print(run_report.summary())
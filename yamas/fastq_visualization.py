@@ -9,6 +9,9 @@ import datetime
 from tqdm import tqdm
 from metaphlan.utils.merge_metaphlan_tables import merge
 from .utilities import run_cmd, ReadsData, check_conda_qiime2
+from .create_visualization import print_trim_trunc_note
+from .scheduler import Stage, run_stages
+from .run_report import RunReport
 import json
 import shutil
 import tarfile
@@ -34,7 +37,7 @@ def qiime_import(dir_path):
         "--output-path", multiplexed_qza_file_path
     ]
 
-    run_cmd(command)
+    run_cmd(command, check=True)
     return multiplexed_qza_file_path
 
 
@@ -52,7 +55,7 @@ def qiime_demux(dir_path, multiplexed_qza_file_path, metadata_path):
         "--p-rev-comp-barcodes",
         "--p-rev-comp-mapping-barcodes"
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
     return demux_qza_file_path
 
 
@@ -64,7 +67,7 @@ def qiime_summarize(dir_path, demux_qza_file_path):
         "--i-data", demux_qza_file_path,
         "--o-visualization", vis_file_path
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
     return vis_file_path
 
 
@@ -77,7 +80,7 @@ def get_reads_data(dir_path, demux_qza_file_path):
         "--input-path", demux_qza_file_path,
         "--output-path", output_dir_path
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
     os.chdir(output_dir_path)
     subdirectories = [d for d in os.listdir() if os.path.isdir(d)]
@@ -127,43 +130,22 @@ def fastq_visualization(fastq_path, barcode_path, metadata_path, data_type, verb
 
     if data_type == '16S' or data_type == '18S':
 
-        verbose_print("\n")
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'Import the multiplexed sequences' (1/4)")
-        multiplexed_qza_file_path = qiime_import(dir_path)
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'Import the multiplexed sequences' (1/4)")
-        verbose_print("\n")
-
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'Demultiplex the reads' (2/4)")
-        demux_qza_file_path = qiime_demux(dir_path, multiplexed_qza_file_path, metadata_path)
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'Demultiplex the reads' (2/4)")
-        verbose_print("\n")
-
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'Summarize demultiplexed and trimmed reads' (3/3)")
-        vis_file_path = qiime_summarize(dir_path, demux_qza_file_path)
-        verbose_print(
-            f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'Summarize demultiplexed and trimmed reads' (3/3)")
+        state = {}
+        run_stages([
+            Stage("qiime_import", lambda: state.update(multiplexed=qiime_import(dir_path)),
+                  label="'Import the multiplexed sequences'"),
+            Stage("qiime_demux", lambda: state.update(demux=qiime_demux(dir_path, state["multiplexed"], metadata_path)),
+                  after=("qiime_import",), label="'Demultiplex the reads'"),
+            Stage("summarize", lambda: state.update(vis=qiime_summarize(dir_path, state["demux"])),
+                  after=("qiime_demux",), label="'Summarize demultiplexed and trimmed reads'"),
+        ], log=verbose_print, report=RunReport(dir_path, "fastq"))
 
         # getting values about fwd and rev
-        reads_data = get_reads_data(dir_path, demux_qza_file_path)
+        reads_data = get_reads_data(dir_path, state["demux"])
         verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating visualization\n")
 
         pickle.dump(reads_data, open(os.path.join(reads_data.dir_path, "reads_data.pkl"), "wb"))
-
-        print(f"Visualization file is located in {vis_file_path}\n"
-              f"Please drag this file to https://view.qiime2.org/ and continue.\n")
-        if reads_data.fwd and reads_data.rev:
-            print(f"Note: The data has both forward and reverse reads.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"as a tuple of two integers."
-                  f"The first place related to the forward read and the second to the reverse.")
-        else:
-            print(f"Note: The data has only a forward read.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"exactly one integers value which is related to the forward read.")
+        print_trim_trunc_note(reads_data, state["vis"])
 
         return reads_data.dir_path
 
@@ -1,24 +1,72 @@
 import os
+import shutil
+import tempfile
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 from typing import Union, List, Optional
 from .utilities import run_cmd
 
+# the per-sample tables HUMAnN writes, joined into project-level tables
+HUMANN_TABLES = ("genefamilies", "pathabundance", "pathcoverage")
+# HUMAnN reports the reads left unaligned once its bowtie2 search against ChocoPhlAn finished
+NUCLEOTIDE_SEARCH_DONE = "after nucleotide alignment"
+
+
+def bzip2_command(threads: int = 1, decompress: bool = True) -> str:
+    """
+    lbzip2/pbzip2 (de)compress on several threads when installed, bzip2 otherwise.
+    """
+    mode = "-dc" if decompress else "-zc"
+    if shutil.which("lbzip2"):
+        return f"lbzip2 {mode} -n {threads}"
+    if shutil.which("pbzip2"):
+        return f"pbzip2 {mode} -p{threads}"
+    return f"bzip2 {mode}"
+
+
+@contextmanager
+def decompressed_sam(sam_bz2: Union[str, Path], scratch_dir: Union[str, Path], threads: int = 1):
+    """
+    Decompress a .sam.bz2 into a private directory under scratch_dir and yield the .sam path.
+    The directory is removed once the block is done, whether HUMAnN succeeded or not.
+    """
+    Path(scratch_dir).mkdir(parents=True, exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(prefix="humann_sam_", dir=scratch_dir))
+    try:
+        sam_path = work_dir / Path(sam_bz2).name[:-len(".bz2")]
+        print(f"[HUMAnN] Decompressing {Path(sam_bz2).name} to {sam_path}")
+        run_cmd([f"{bzip2_command(threads)} {sam_bz2} > {sam_path}"], check=True)
+        yield sam_path
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
 
 def run_humann_pipeline(
     input_file: Union[str, Path],
     output_dir: Union[str, Path],
-    meta_profile: Union[str, Path],
+    meta_profile: Optional[Union[str, Path]],
     threads: int = 8,
     chocophlan_db: Optional[Union[str, Path]] = None,
     uniref_db: Optional[Union[str, Path]] = None,
     utility_db: Optional[Union[str, Path]] = None,
     resume: bool = False,
-    input_format: str = "fastq"
+    input_format: str = "fastq",
+    output_basename: Optional[str] = None,
+    scratch_dir: Optional[Union[str, Path]] = None
 ) -> List[Path]:
     """
     Run the HUMAnN pipeline from the middle, using existing MetaPhlAn and Bowtie outputs.
-    Supports FASTQ inputs or compressed SAM (.sam.bz2) with bypass of Bowtie2 steps.
+    Supports FASTQ inputs or HUMAnN's own nucleotide alignments (SAM, or .sam.bz2) in place of its
+    Bowtie2 search against ChocoPhlAn. A .sam.bz2 is decompressed under scratch_dir (default: the output dir)
+    only for the run.
     """
+    with ExitStack() as cleanup:
+        return _run_humann_pipeline(input_file, output_dir, meta_profile, threads, chocophlan_db, uniref_db,
+                                    utility_db, resume, input_format, output_basename, scratch_dir, cleanup)
+
+
+def _run_humann_pipeline(input_file, output_dir, meta_profile, threads, chocophlan_db, uniref_db, utility_db,
+                         resume, input_format, output_basename, scratch_dir, cleanup: ExitStack) -> List[Path]:
     input_path = Path(input_file)
     out_dir = Path(output_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -31,9 +79,10 @@ def run_humann_pipeline(
         "humann",
         f"--output {out_dir}",
         f"--threads {threads}",
-        f"--taxonomic-profile {meta_profile}",
         f"--input-format {input_format}"
     ]
+    if meta_profile:
+        cmd_parts.append(f"--taxonomic-profile {meta_profile}")
 
     # Adjust input and bypass flags
     if input_format == "fastq":
@@ -41,20 +90,22 @@ def run_humann_pipeline(
         cmd_parts.append(f"--input {input_path}")
     
     elif input_format == "sam":
-        # only treat true .sam.bz2, else fallback to fastq
+        # HUMAnN skips its nucleotide alignment for a SAM input and runs the translated search on the
+        # reads the SAM has as unaligned, so no --bypass-nucleotide-search (it would drop the alignments).
+        # The SAM must be aligned against ChocoPhlAn, e.g. <basename>_bowtie2_aligned.sam of an earlier
+        # HUMAnN run, not MetaPhlAn's alignments against its marker database.
         if input_path.name.endswith(".sam.bz2"):
-            sam_path = input_path.with_suffix("").with_suffix(".sam")
-            if not sam_path.exists():
-                print(f"[HUMAnN] Decompressing {input_path.name} to {sam_path.name}")
-                run_cmd([f"bzip2 -dc {input_path} > {sam_path}"])
-                print(f"[HUMAnN] Decompression complete: {sam_path.name}")
+            sam_path = cleanup.enter_context(decompressed_sam(input_path, scratch_dir or out_dir, threads))
+            print(f"[HUMAnN] Decompression complete: {sam_path.name}")
             cmd_parts.append(f"--input {sam_path}")
-            cmd_parts.extend(["--bypass-nucleotide-index", "--bypass-prescreen", "--bypass-nucleotide-search"])
-            print(f"[HUMAnN] Prepared SAM bypass on: {sam_path.name}")
+            print(f"[HUMAnN] Prepared SAM input: {sam_path.name}")
+        elif input_path.name.endswith(".sam"):
+            cmd_parts.append(f"--input {input_path}")
+            print(f"[HUMAnN] Prepared SAM input: {input_path.name}")
         else:
             # fallback to fastq branch
-            input_format = "fastq"
             cmd_parts[cmd_parts.index(f"--input-format {input_format}")] = f"--input-format fastq"
+            input_format = "fastq"
             cmd_parts.append(f"--input {input_path}")
     else:
         print(f"[HUMAnN] Using other input: {input_path.name}")
@@ -69,6 +120,8 @@ def run_humann_pipeline(
         cmd_parts.append(f"--utility-map {utility_db}")
     if resume:
         cmd_parts.append("--resume")
+    if output_basename:
+        cmd_parts.append(f"--output-basename {output_basename}")
 
     # Prepare log redirection
     log_file = out_dir / "humann.log"
@@ -76,10 +129,127 @@ def run_humann_pipeline(
     print(f"[HUMAnN] Running command: {full_cmd}")
 
     # Execute via run_cmd
-    run_cmd([full_cmd])
+    run_cmd([full_cmd], check=True)
     print(f"[HUMAnN] Finished command for {input_path.name}")
 
     # Return and report pathways output files
     outputs = sorted(out_dir.glob("*_pathabundance.tsv"))
     print(f"[HUMAnN] Found {len(outputs)} pathway files: {[p.name for p in outputs]}")
     return outputs
+
+
+def concatenate_mates(fastq_files: List[Union[str, Path]], output_path: Union[str, Path]) -> Path:
+    """
+    HUMAnN takes a single input file and does not use the pairing, so the mates of a
+    paired-end sample are profiled together as one set of reads.
+    """
+    with open(output_path, "wb") as out:
+        for fastq in fastq_files:
+            with open(fastq, "rb") as f:
+                shutil.copyfileobj(f, out, 16 * 2 ** 20)
+    return Path(output_path)
+
+
+def humann_alignments(output_dir: Union[str, Path], sample: str) -> Path:
+    """
+    The ChocoPhlAn alignments HUMAnN keeps in the temp directory of a sample.
+    """
+    return Path(output_dir) / sample / f"{sample}_humann_temp" / f"{sample}_bowtie2_aligned.sam"
+
+
+def compress_alignments(output_dir: Union[str, Path], sample: str, threads: int = 1) -> Optional[Path]:
+    """
+    Keep the sample's alignments compressed (<sam>.bz2) for its later runs, once its humann.log shows the nucleotide
+    search finished: HUMAnN writes the SAM straight from bowtie2, so an interrupted search leaves a truncated one.
+    The SAM itself is removed either way, only a .bz2 written whole is reused (see completed_alignments).
+    """
+    sam_file = humann_alignments(output_dir, sample)
+    if not sam_file.exists():
+        return None
+    log_file = Path(output_dir) / sample / "humann.log"
+    finished = False
+    if log_file.exists():
+        with open(log_file, errors="replace") as log:
+            finished = any(NUCLEOTIDE_SEARCH_DONE in line for line in log)
+    kept = Path(f"{sam_file}.bz2")
+    partial = Path(f"{kept}.partial")
+    try:
+        if finished:
+            run_cmd([f"{bzip2_command(threads, decompress=False)} {sam_file} > {partial}"], check=True)
+            os.replace(partial, kept)
+        else:
+            print(f"[HUMAnN] The nucleotide search of {sample} did not finish, its alignments are not kept")
+    except RuntimeError as e:
+        print(f"[HUMAnN] Could not keep the alignments of {sample}: {e}")
+        finished = False
+    finally:
+        partial.unlink(missing_ok=True)
+        sam_file.unlink()
+    return kept if finished else None
+
+
+def completed_alignments(output_dir: Union[str, Path], sample: str) -> Optional[Path]:
+    """
+    The alignments of an earlier HUMAnN run of the sample whose nucleotide search finished (see compress_alignments).
+    """
+    kept = Path(f"{humann_alignments(output_dir, sample)}.bz2")
+    return kept if kept.exists() else None
+
+
+def humann_sample(
+    sample: str,
+    fastq_files: List[Union[str, Path]],
+    output_dir: Union[str, Path],
+    meta_profile: Optional[Union[str, Path]],
+    threads: int = 8,
+    sam_file: Optional[Union[str, Path]] = None,
+    scratch_dir: Optional[Union[str, Path]] = None,
+    keep_alignments: bool = False
+) -> List[Path]:
+    """
+    Run HUMAnN on one sample in its own directory (<output_dir>/<sample>, with its own humann.log).
+    With sam_file (the ChocoPhlAn alignments of an earlier HUMAnN run of the sample, a .sam.bz2 is decompressed
+    under scratch_dir) the nucleotide search is not run again, otherwise the mates of a paired-end sample are
+    concatenated into a temporary file first, and with keep_alignments the alignments are kept for later runs.
+    """
+    sample_dir = Path(output_dir) / sample
+    sample_dir.mkdir(parents=True, exist_ok=True)
+    if sam_file:
+        input_file, input_format = Path(sam_file), "sam"
+    elif len(fastq_files) > 1:
+        input_file, input_format = concatenate_mates(fastq_files, sample_dir / f"{sample}.fastq"), "fastq"
+    else:
+        input_file, input_format = Path(fastq_files[0]), "fastq"
+    try:
+        run_humann_pipeline(str(input_file), str(sample_dir), meta_profile, threads=threads,
+                            input_format=input_format, output_basename=sample, scratch_dir=scratch_dir)
+    finally:
+        if not sam_file and len(fastq_files) > 1 and input_file.exists():
+            input_file.unlink()
+        if keep_alignments and not sam_file:
+            # also when the translated search failed, a rerun can start from the alignments
+            compress_alignments(output_dir, sample, threads)
+
+    outputs = [sample_dir / f"{sample}_{table}.tsv" for table in HUMANN_TABLES]
+    missing = [p.name for p in outputs if not p.exists()]
+    if missing:
+        raise RuntimeError(f"HUMAnN did not write {', '.join(missing)}, see {sample_dir / 'humann.log'}")
+    return outputs
+
+
+def join_humann_tables(output_dir: Union[str, Path], export_dir: Union[str, Path], dataset_id: str) -> List[Path]:
+    """
+    Join the per-sample genefamilies/pathabundance/pathcoverage tables of every sample
+    directory into <export_dir>/<dataset_id>_<table>.tsv.
+    """
+    Path(export_dir).mkdir(parents=True, exist_ok=True)
+    joined = []
+    for table in HUMANN_TABLES:
+        if not list(Path(output_dir).glob(f"*/*_{table}.tsv")):
+            continue
+        output_file = Path(export_dir) / f"{dataset_id}_{table}.tsv"
+        run_cmd(["humann_join_tables", "--input", str(output_dir), "--output", str(output_file),
+                 "--file_name", table, "--search-subdirectories"], check=True)
+        print(f"[HUMAnN] Joined {table} tables into {output_file}")
+        joined.append(output_file)
+    return joined
@@ -0,0 +1,114 @@
+import csv
+import inspect
+import os
+from array import array
+from itertools import takewhile
+
+import numpy as np
+import pandas as pd
+from metaphlan.utils.merge_metaphlan_tables import merge
+
+# values formatted at once while writing the merged table (rows per block = CHUNK_CELLS / samples)
+CHUNK_CELLS = 1 << 20
+
+
+class UnsupportedProfile(Exception):
+    # a profile the streaming merge can't reproduce merge()'s output for, merge() is used instead
+    pass
+
+
+def metaphlan_merge(profile_files: list, out):
+    # MetaPhlAn's own merge, which also takes gtdb since MetaPhlAn 4.1
+    if "gtdb" in inspect.signature(merge).parameters:
+        merge(profile_files, out, False)
+    else:
+        merge(profile_files, out)
+
+
+def profile_headers(path: str):
+    with open(path) as f:
+        return [line.strip() for line in takewhile(lambda line: line.startswith('#'), f)]
+
+
+def read_abundances(path: str, headers: list):
+    # the relative abundances of a profile, parsed exactly like merge() parses them
+    names = headers[-1].split('#')[1].strip().split('\t')
+    abundances = pd.read_csv(path, sep='\t', skiprows=len(headers), names=names, usecols=[0, 2],
+                             index_col=0)['relative_abundance']
+    # numbers for clade names (no clade names at all), missing or repeated clades: merge()'s table depends on
+    # how pandas aligns them
+    if abundances.dtype.kind not in "fiu" or abundances.index.inferred_type != "string" \
+            or abundances.index.hasnans or abundances.index.has_duplicates:
+        raise UnsupportedProfile(path)
+    return abundances
+
+
+def merge_profiles_streaming(profile_files: list, out, chunk_cells: int = CHUNK_CELLS):
+    # Writes the same table as metaphlan's merge(), byte for byte, without building the dense clades x samples
+    # table in memory. The clade index is built once, in the order pandas aligns the profiles in (first
+    # appearance), while each profile is read and only adds its own (clade, abundance) pairs as a sparse column.
+    # The rows are then sorted like merge() sorts them and written a block of rows at a time.
+    # Profiles the streaming merge can't reproduce exactly go through merge() itself.
+    if not profile_files:
+        raise ValueError("No profiles to merge")
+    version = None
+    clades = {}  # clade -> row, in order of first appearance
+    rows, columns, values = array('q'), array('q'), array('d')
+    samples, kinds, index_names = [], [], set()
+    try:
+        for path in profile_files:
+            headers = profile_headers(path)
+            if not headers:
+                print(f"merge_metaphlan_tables: file {path} has no headers with metaphlan version or is improperly "
+                      f"formatted.")
+                return
+            if version is not None and headers[0].split('\t')[0] != version:
+                print('merge_metaphlan_tables: profiles from different versions of MetaPhlAn, please profile your '
+                      'samples using the same MetaPhlAn version.\n')
+                return
+            version = headers[0].split('\t')[0]
+            abundances = read_abundances(path, headers)
+            column = len(samples)
+            samples.append(os.path.splitext(os.path.basename(path))[0].replace('_profile', ''))
+            kinds.append(abundances.dtype.kind)
+            index_names.add(abundances.index.name)
+            rows.extend([clades.setdefault(clade, len(clades)) for clade in abundances.index.tolist()])
+            columns.extend([column] * len(abundances))
+            values.frombytes(np.nan_to_num(abundances.to_numpy(dtype=np.float64), nan=0.0).tobytes())
+    except UnsupportedProfile as e:
+        print(f"{e} can't be merged as a stream, merging the profiles with MetaPhlAn's merge")
+        metaphlan_merge(profile_files, out)
+        return
+
+    # merge() sorts the rows by taxonomic level with sort_index(key=...), a quicksort that leaves
+    # the rows alone when they are already in order
+    levels = np.fromiter((clade.count('|') + 1 for clade in clades), dtype=np.int64, count=len(clades))
+    order = np.arange(len(clades)) if np.all(levels[1:] >= levels[:-1]) else np.argsort(levels, kind='quicksort')
+    position = np.empty(len(clades), dtype=np.int64)
+    position[order] = np.arange(len(clades))
+    positions = position[np.frombuffer(rows, dtype=np.int64)]
+    by_row = np.argsort(positions, kind='stable')
+    positions = positions[by_row]
+    columns = np.frombuffer(columns, dtype=np.int64)[by_row]
+    values = np.frombuffer(values, dtype=np.float64)[by_row]
+    labels = np.array(list(clades), dtype=object)[order]
+    # integer columns stay integers in merge()'s table unless a clade is missing from them (filled with 0.0)
+    counts = np.bincount(columns, minlength=len(samples))
+    int_columns = np.array([kind in "iu" for kind in kinds]) & (counts == len(clades))
+
+    out.write(version + '\n')
+    writer = csv.writer(out, delimiter='\t', lineterminator=os.linesep)
+    writer.writerow([index_names.pop() if len(index_names) == 1 else "", *samples])
+    step = max(1, chunk_cells // max(1, len(samples)))
+    for start in range(0, len(clades), step):
+        stop = min(len(clades), start + step)
+        first, last = np.searchsorted(positions, [start, stop])
+        # pandas' to_csv formats the floats with astype(str) as well, only the abundances present in the
+        # profiles are formatted, the clades missing from a profile all share the same "0.0"
+        entries = values[first:last].astype(str)
+        in_int_column = int_columns[columns[first:last]]
+        if in_int_column.any():
+            entries[in_int_column] = values[first:last][in_int_column].astype(np.int64).astype(str)
+        text = np.full((stop - start, len(samples)), "0.0", dtype=object)
+        text[positions[first:last] - start, columns[first:last]] = entries
+        writer.writerows([label, *row] for label, row in zip(labels[start:stop], text.tolist()))
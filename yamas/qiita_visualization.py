@@ -6,46 +6,34 @@ import gzip
 import os.path
 import pickle
 import datetime
-from tqdm import tqdm
-from metaphlan.utils.merge_metaphlan_tables import merge
-from .utilities import run_cmd, ReadsData, check_conda_qiime2
+from .utilities import run_cmd, run_in_pool, ReadsData, check_conda_qiime2, fastq_sample_index
+from .create_visualization import metaphlan_sample, report_failed_samples, print_trim_trunc_note
+from .profile_merge import merge_profiles_streaming
+from .scheduler import Stage, run_stages
+from .resources import tool_threads
+from .run_report import RunReport
 import json
 import shutil
 import tarfile
 import os
 import yaml
 
-def metaphlan_extraction(reads_data):
+def metaphlan_extraction(reads_data, threads: int = None, workers: int = 1):
     paired = reads_data.rev and reads_data.fwd
     fastq_path = os.path.join(reads_data.dir_path, "fastq")
     export_path = os.path.join(reads_data.dir_path, "export")
-    run_cmd([f"mkdir {export_path}"])
+    os.makedirs(export_path, exist_ok=True)
     final_output_path = os.path.join(export_path, 'final.txt')
-    run_cmd([f"touch {final_output_path}"])
-    fastq_files = [a for a in os.listdir(fastq_path) if a.split(".")[-1] == "fastq"]
-    args = []
-    if paired:
-        print("paired")
-        for i in tqdm(range(0,len(fastq_files),2)):
-            fastq_name = fastq_files[i].split('_')[0]
-            fastq_1 = os.path.join(fastq_path, fastq_files[i])
-            fastq_2 = os.path.join(fastq_path, fastq_files[i+1])
-            output = os.path.join(fastq_path,f"{fastq_name}.bowtie2.bz2")
-            command = [f"metaphlan {fastq_1},{fastq_2} --input_type fastq --bowtie2out {output} --nproc 24"]
-            run_cmd(command)
-            final_output_file = os.path.join(os.path.join(reads_data.dir_path, 'qza'), f'{fastq_name}_profile.txt')
-            command = [f"metaphlan {output} --input_type bowtie2out --nproc 24 > {final_output_file}"]
-            run_cmd(command)
-            args.append(final_output_file)
-    else:
-        print("not paired")
-        for fastq in tqdm(fastq_files):
-            output = os.path.join(os.path.join(reads_data.dir_path, 'qza'), f'{fastq}_profile.txt')
-            fastq = os.path.join(fastq_path,fastq)
-            command = [f"metaphlan {fastq} --input_type fastq --nproc 24 > {output}"]
-            run_cmd(command)
-            args.append(output)
-    merge(args, open(final_output_path, 'w'), gtdb=False)
+    nproc = tool_threads(workers, threads)
+    samples = fastq_sample_index(fastq_path)
+    print("paired" if paired else "not paired")
+    args = {}
+    def profile(sample_name):
+        args[sample_name] = metaphlan_sample(samples[sample_name], sample_name, reads_data.dir_path, nproc)
+    failures = run_in_pool(profile, list(samples), workers=workers, desc="metaphlan samples")
+    report_failed_samples(failures, os.path.join(export_path, 'failed_samples.txt'))
+    with open(final_output_path, 'w') as out:
+        merge_profiles_streaming([args[sample_name] for sample_name in samples if sample_name in args], out)
 
 def metaphlan_txt_csv(reads_data, dataset_id):
     export_path = os.path.join(reads_data.dir_path, "export")
@@ -84,7 +72,7 @@ def qiime_import(dir_path,fastq_path):
         "--input-path", fastq_path,
         "--output-path", multiplexed_qza_file_path,
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
     return multiplexed_qza_file_path
 
 
@@ -104,7 +92,7 @@ def qiime_demux(dir_path,multiplexed_qza_file_path, metadata_path):
         "--o-untrimmed-sequences", untrim_qza_file_path,
         "--verbose"
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
     return demux_qza_file_path
 
 def check_metadata(metadata_path):
@@ -128,7 +116,7 @@ def trim_single(dir_path,demux_qza_file_path):
         "--o-trimmed-sequences", trimmed_seqs_file_path,
         "--verbose"
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
     return trimmed_seqs_file_path
 def qiime_summarize(dir_path,trimmed_seqs_file_path):
     #Summarize demultiplexed and trimmed reads
@@ -140,7 +128,7 @@ def qiime_summarize(dir_path,trimmed_seqs_file_path):
         "--i-data", trimmed_seqs_file_path,
         "--o-visualization", vis_file_path
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
     return vis_file_path
 
 
@@ -154,7 +142,7 @@ def get_reads_data(dir_path,demux_qza_file_path):
         "--input-path", demux_qza_file_path,
         "--output-path", output_dir_path
     ]
-    run_cmd(command)
+    run_cmd(command, check=True)
 
     os.chdir(output_dir_path)
     subdirectories = [d for d in os.listdir() if os.path.isdir(d)]
@@ -208,43 +196,24 @@ def qiita_visualization(fastq_path,metadata_path,data_type, verbose_print):
 
     if data_type == '16S' or data_type == '18S':
 
-        verbose_print("\n")
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'Import the multiplexed sequences' (1/4)")
-        multiplexed_qza_file_path= qiime_import(dir_path,fastq_path)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'Import the multiplexed sequences' (1/4)")
-        verbose_print("\n")
-
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'Demultiplex the reads' (2/4)")
-        demux_qza_file_path=qiime_demux(dir_path, multiplexed_qza_file_path,metadata_path)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'Demultiplex the reads' (2/4)")
-        verbose_print("\n")
-
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'Trim adapters from demultiplexed reads' (3/4)")
-        trimmed_seqs_file_path=trim_single(dir_path,demux_qza_file_path)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'rim adapters from demultiplexed reads' (3/4)")
-        verbose_print("\n")
-
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'Summarize demultiplexed and trimmed reads' (4/4)")
-        vis_file_path= qiime_summarize(dir_path,trimmed_seqs_file_path)
-        verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'Summarize demultiplexed and trimmed reads' (4/4)")
+        state = {}
+        run_stages([
+            Stage("qiime_import", lambda: state.update(multiplexed=qiime_import(dir_path, fastq_path)),
+                  label="'Import the multiplexed sequences'"),
+            Stage("qiime_demux", lambda: state.update(demux=qiime_demux(dir_path, state["multiplexed"], metadata_path)),
+                  after=("qiime_import",), label="'Demultiplex the reads'"),
+            Stage("trim", lambda: state.update(trimmed=trim_single(dir_path, state["demux"])),
+                  after=("qiime_demux",), label="'Trim adapters from demultiplexed reads'"),
+            Stage("summarize", lambda: state.update(vis=qiime_summarize(dir_path, state["trimmed"])),
+                  after=("trim",), label="'Summarize demultiplexed and trimmed reads'"),
+        ], log=verbose_print, report=RunReport(dir_path, "qiita"))
 
         #getting values about fwd and rev
-        reads_data= get_reads_data(dir_path,demux_qza_file_path)
+        reads_data= get_reads_data(dir_path, state["demux"])
         verbose_print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating visualization\n")
 
         pickle.dump(reads_data, open(os.path.join(reads_data.dir_path, "reads_data.pkl"), "wb"))
-
-        print(f"Visualization file is located in {vis_file_path}\n"
-              f"Please drag this file to https://view.qiime2.org/ and continue.\n")
-        if reads_data.fwd and reads_data.rev:
-            print(f"Note: The data has both forward and reverse reads.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"as a tuple of two integers."
-                  f"The first place related to the forward read and the second to the reverse.")
-        else:
-            print(f"Note: The data has only a forward read.\n"
-                  f"Therefore, you must give the parameters 'trim' and 'trunc' of export() "
-                  f"exactly one integers value which is related to the forward read.")
+        print_trim_trunc_note(reads_data, state["vis"])
 
         return reads_data.dir_path
 
@@ -0,0 +1,257 @@
+import csv
+import gzip
+import json
+import os
+
+import numpy as np
+
+from .utilities import fastq_sample_index, run_in_pool
+
+# The quantiles of the per-position quality plot of 'qiime demux summarize' (its box whiskers at 2%/98% and 9%/91%)
+QUANTILES = (0.02, 0.09, 0.25, 0.5, 0.75, 0.91, 0.98)
+MAX_QUALITY = 93  # Phred+33 scores run from '!' (0) to '~' (93)
+CHUNK_BYTES = 16 * 2 ** 20
+
+
+def quality_profile_path(dir_path: str, dataset_id: str):
+    return os.path.join(dir_path, "vis", f"{dataset_id}_quality.json")
+
+
+class QualityProfile:
+    # Per-position histogram of the quality scores and the length distribution of a set of reads.
+    # Histograms add up, so the profiles of the chunks/files of a direction are merged without keeping any read,
+    # and the quantiles they give are exact.
+
+    def __init__(self):
+        self.reads = 0
+        self.profiled_reads = 0
+        self.qualities = np.zeros((0, MAX_QUALITY + 1), dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.int64)
+
+    def _grow(self, length: int):
+        if length > len(self.qualities):
+            self.qualities = np.vstack([self.qualities,
+                                        np.zeros((length - len(self.qualities), MAX_QUALITY + 1), dtype=np.int64)])
+        if length + 1 > len(self.lengths):
+            self.lengths = np.concatenate([self.lengths, np.zeros(length + 1 - len(self.lengths), dtype=np.int64)])
+
+    def add_qualities(self, qualities: list):
+        # qualities: the quality lines (bytes) of a batch of reads
+        if not qualities:
+            return
+        lengths = np.fromiter(map(len, qualities), dtype=np.int64, count=len(qualities))
+        scores = np.frombuffer(b"".join(qualities), dtype=np.uint8).astype(np.int64) - 33
+        np.clip(scores, 0, MAX_QUALITY, out=scores)
+        # position of every score within its read
+        starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.arange(len(scores), dtype=np.int64) - starts
+        longest = int(lengths.max())
+        self._grow(longest)
+        self.qualities[:longest] += np.bincount(positions * (MAX_QUALITY + 1) + scores,
+                                                minlength=longest * (MAX_QUALITY + 1)).reshape(longest, -1)
+        self.lengths[:longest + 1] += np.bincount(lengths, minlength=longest + 1)
+        self.profiled_reads += len(qualities)
+
+    def merge(self, other: "QualityProfile"):
+        self._grow(len(other.qualities))
+        self.qualities[:len(other.qualities)] += other.qualities
+        self.lengths[:len(other.lengths)] += other.lengths
+        self.reads += other.reads
+        self.profiled_reads += other.profiled_reads
+        return self
+
+    def counts(self):
+        # number of reads long enough to have each position
+        return self.qualities.sum(axis=1)
+
+    def quantiles(self, quantiles=QUANTILES):
+        # positions x quantiles, from the cumulative histogram of every position
+        cumulative = self.qualities.cumsum(axis=1)
+        targets = np.maximum(np.ceil(np.outer(cumulative[:, -1], quantiles)), 1)
+        return np.stack([(cumulative < targets[:, [i]]).sum(axis=1) for i in range(len(quantiles))], axis=1)
+
+    def means(self):
+        counts = self.counts()
+        return self.qualities @ np.arange(MAX_QUALITY + 1) / np.maximum(counts, 1)
+
+    def as_dict(self):
+        return {"reads": self.reads, "profiled_reads": self.profiled_reads,
+                "count": self.counts().tolist(),
+                "mean": np.round(self.means(), 2).tolist(),
+                "quantiles": {f"{q:.0%}": column.tolist() for q, column in zip(QUANTILES, self.quantiles().T)},
+                "lengths": {str(length): int(count) for length, count in enumerate(self.lengths) if count}}
+
+
+def open_fastq(path: str):
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, 'rb') if gzipped else open(path, 'rb')
+
+
+def fastq_quality_chunks(path: str, chunk_bytes: int = CHUNK_BYTES):
+    # Yields the quality lines of the whole records of every chunk of a (gzipped) fastq,
+    # the records cut by the end of a chunk are completed by the next one.
+    carry = b""
+    with open_fastq(path) as f:
+        while True:
+            block = f.read(chunk_bytes)
+            lines = (carry + block).split(b"\n")
+            if block:
+                # the last line may be cut, and the last record may miss its last lines
+                whole = (len(lines) - 1) // 4 * 4
+                carry = b"\n".join(lines[whole:])
+            else:
+                lines = [line for line in lines if line]
+                whole = len(lines) // 4 * 4
+            qualities = lines[3:whole:4]
+            if qualities and qualities[0].endswith(b"\r"):
+                qualities = [quality.rstrip(b"\r") for quality in qualities]
+            yield qualities
+            if not block:
+                return
+
+
+def profile_fastq(path: str, subsample: float = None, seed: int = 0, chunk_bytes: int = CHUNK_BYTES):
+    # Profiles a fastq, or a random `subsample` fraction of its reads. Reads are always all counted.
+    rng = np.random.default_rng(seed)
+    profile = QualityProfile()
+    for qualities in fastq_quality_chunks(path, chunk_bytes):
+        profile.reads += len(qualities)
+        if subsample is not None and subsample < 1:
+            keep = np.flatnonzero(rng.random(len(qualities)) < subsample)
+            qualities = [qualities[i] for i in keep]
+        profile.add_qualities(qualities)
+    return profile
+
+
+def write_quality_csv(profile: QualityProfile, csv_path: str):
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["position", "count", "mean"] + [f"{q:.0%}" for q in QUANTILES])
+        for position, (count, mean, quantiles) in enumerate(zip(profile.counts(), profile.means(),
+                                                                profile.quantiles())):
+            writer.writerow([position + 1, int(count), round(float(mean), 2)] + quantiles.tolist())
+
+
+def profile_samples(dir_path: str, dataset_id: str, subsample: float = None, workers: int = 1, seed: int = 0):
+    # Quality profile of the forward (mate 1 / single) and reverse (mate 2) reads of every sample of fastq/,
+    # written to vis/<dataset_id>_quality.json, vis/<dataset_id>_quality_<direction>.csv (per position)
+    # and vis/<dataset_id>_reads_per_sample.csv. Returns the json path.
+    samples = fastq_sample_index(os.path.join(dir_path, "fastq"))
+    files = {(sample, direction): path for sample, paths in samples.items()
+             for direction, path in zip(("forward", "reverse"), paths)}
+    profiles = {}
+
+    def profile(key):
+        profiles[key] = profile_fastq(files[key], subsample=subsample, seed=seed)
+
+    failures = run_in_pool(profile, list(files), workers=workers, desc="quality profiles")
+    if failures:
+        raise RuntimeError(f"quality profile failed on {', '.join(sample for sample, _ in failures)}: "
+                           f"{next(iter(failures.values()))}")
+
+    directions = {}
+    for (sample, direction), sample_profile in sorted(profiles.items()):
+        directions.setdefault(direction, QualityProfile()).merge(sample_profile)
+
+    vis_path = os.path.join(dir_path, "vis")
+    os.makedirs(vis_path, exist_ok=True)
+    for direction, direction_profile in directions.items():
+        write_quality_csv(direction_profile, os.path.join(vis_path, f"{dataset_id}_quality_{direction}.csv"))
+    with open(os.path.join(vis_path, f"{dataset_id}_reads_per_sample.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["sample"] + list(directions))
+        for sample in samples:
+            writer.writerow([sample] + [profiles[(sample, direction)].reads if (sample, direction) in profiles else 0
+                                        for direction in directions])
+
+    json_path = quality_profile_path(dir_path, dataset_id)
+    with open(json_path, 'w') as f:
+        json.dump({"dataset_id": dataset_id, "subsample": subsample,
+                   "samples": {sample: {direction: profiles[(sample, direction)].reads
+                                        for direction in directions if (sample, direction) in profiles}
+                               for sample in samples},
+                   "directions": {direction: direction_profile.as_dict()
+                                  for direction, direction_profile in directions.items()}}, f)
+    print(f"Quality profile of {len(samples)} samples is located in {json_path}")
+    return json_path
+
+
+def project_dataset_id(dir_path: str):
+    # the dataset id recorded in the project's metadata.json, else the name of its directory
+    json_file_path = os.path.join(dir_path, "metadata.json")
+    if os.path.isfile(json_file_path):
+        with open(json_file_path) as json_file:
+            dataset_id = json.load(json_file).get("dataset_id")
+        if dataset_id:
+            return dataset_id
+    return os.path.basename(os.path.normpath(dir_path))
+
+
+def recommend_direction(direction: dict, min_median: int = 25, max_trim: int = 20, min_kept: float = 0.9,
+                        window: int = 5):
+    # trim-left: the leading positions whose median quality is below min_median (at most max_trim).
+    # trunc: where the median quality drops below min_median for `window` positions in a row, and no further
+    # than the length min_kept of the reads reach (DADA2 drops the reads shorter than the truncation).
+    medians = np.array(direction["quantiles"]["50%"])
+    counts = np.array(direction["count"])
+    if not len(medians):
+        raise ValueError("no reads to recommend trim/trunc from")
+    trim = 0
+    while trim < min(max_trim, len(medians) - 1) and medians[trim] < min_median:
+        trim += 1
+    low = np.convolve(medians[trim:] < min_median, np.ones(window, dtype=int), mode="valid") == window
+    trunc = trim + int(np.argmax(low)) if low.any() else len(medians)
+    longest = int(np.flatnonzero(counts >= min_kept * counts[0])[-1]) + 1
+    return {"trim": trim, "trunc": max(min(trunc, longest), trim + 1), "max_trunc": longest}
+
+
+def fit_overlap(forward: dict, reverse: dict, amplicon_length: int, min_overlap: int = 20):
+    # The mates only merge when they overlap: trunc-f + trunc-r >= amplicon length + min_overlap.
+    # Lengthens both truncations (up to what the reads reach) until they do, returns the overlap left.
+    need = amplicon_length + min_overlap - forward["trunc"] - reverse["trunc"]
+    for first, second in ((forward, reverse), (reverse, forward)):
+        if need <= 0:
+            break
+        share = min(-(-need // 2), first["max_trunc"] - first["trunc"])
+        first["trunc"] += share
+        need -= share
+        share = min(need, second["max_trunc"] - second["trunc"])
+        second["trunc"] += max(share, 0)
+        need -= max(share, 0)
+    return forward["trunc"] + reverse["trunc"] - amplicon_length
+
+
+def recommend_trim_trunc(dir_path: str, paired: bool, amplicon_length: int = None, min_median: int = 25,
+                         workers: int = 1):
+    # trim/trunc for export() ("f,r" when paired) from the project's quality profile (profiled now when missing),
+    # recorded with how they were picked in vis/<dataset_id>_trim_trunc.json.
+    dataset_id = project_dataset_id(dir_path)
+    json_path = quality_profile_path(dir_path, dataset_id)
+    if not os.path.isfile(json_path):
+        profile_samples(dir_path, dataset_id, workers=workers)
+    with open(json_path) as f:
+        directions = json.load(f)["directions"]
+
+    names = ("forward", "reverse") if paired else ("forward",)
+    missing = [name for name in names if name not in directions]
+    if missing:
+        raise ValueError(f"The quality profile {json_path} has no {' or '.join(missing)} reads.")
+    picks = {name: recommend_direction(directions[name], min_median=min_median) for name in names}
+    recommendation = {"min_median": min_median, "amplicon_length": amplicon_length, "directions": picks}
+    if paired and amplicon_length:
+        overlap = fit_overlap(picks["forward"], picks["reverse"], amplicon_length)
+        recommendation["overlap"] = overlap
+        if overlap < 12:
+            print(f"Warning: with the reads truncated at {picks['forward']['trunc']}/{picks['reverse']['trunc']} "
+                  f"the mates overlap by {overlap} bases only, DADA2 needs 12 to merge them. "
+                  f"Consider --as_single.")
+    elif paired:
+        print("Note: no amplicon length given, the overlap of the truncated mates is not checked.")
+
+    recommendation["trim"] = ",".join(str(picks[name]["trim"]) for name in names)
+    recommendation["trunc"] = ",".join(str(picks[name]["trunc"]) for name in names)
+    with open(os.path.join(dir_path, "vis", f"{dataset_id}_trim_trunc.json"), 'w') as f:
+        json.dump(recommendation, f, indent=2)
+    print(f"Recommended trim: {recommendation['trim']}, trunc: {recommendation['trunc']}")
+    return recommendation["trim"], recommendation["trunc"]
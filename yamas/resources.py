@@ -0,0 +1,177 @@
+import contextvars
+import fcntl
+import json
+import os
+import threading
+
+# threads the scheduler granted to the stage the current thread works for (see run_stages)
+granted_threads = contextvars.ContextVar("granted_threads", default=None)
+
+
+def cgroup_cpu_limit():
+    # CPUs allowed by the cgroup quota (containers, slurm jobs...), None when there is no quota
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(quota) // int(period))
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, quota // period)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus():
+    # the CPUs this process may run on, limited by its cgroup quota
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    return min(cpus, limit) if limit else cpus
+
+
+def thread_budget(requested: int = None):
+    # The threads a run may use: the user's --threads, capped at the available CPUs.
+    cpus = available_cpus()
+    return max(1, min(int(requested), cpus)) if requested else cpus
+
+
+def tool_threads(workers: int = 1, threads: int = None):
+    # The threads of a single tool invocation: the threads granted to the current stage (`threads`, or
+    # the whole machine, outside of a stage) split between the `workers` invocations running at once.
+    total = granted_threads.get() or (thread_budget(threads) if threads else available_cpus())
+    return max(1, int(total) // max(1, workers))
+
+
+MEMORY_HISTORY_NAME = "tool_memory.json"
+
+# Expected peak memory (GB) of the tools known to need a lot of it, until runs on this machine measured them.
+DEFAULT_TOOL_MEMORY_GB = {"metaphlan": 16, "humann": 32, "classify-sklearn": 32}
+
+
+def tool_name(command: str):
+    # "metaphlan ..." -> metaphlan, "qiime feature-classifier classify-sklearn ..." -> classify-sklearn
+    words = command.split()
+    if not words:
+        return ""
+    name = os.path.basename(words[0])
+    if name == "qiime" and len(words) >= 3:
+        return words[2]
+    return name
+
+
+def available_memory_gb():
+    # MemAvailable, limited by what is left of the cgroup memory limit
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) / 2 ** 20
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        with open("/sys/fs/cgroup/memory.current") as f:
+            current = int(f.read())
+        if limit != "max":
+            left = (int(limit) - current) / 2 ** 30
+            available = min(available, left) if available is not None else left
+    except (OSError, ValueError):
+        pass
+    return available
+
+
+class MemoryGate:
+    # Admits a tool invocation only when its expected peak memory fits next to the memory reserved by the
+    # ones already running, otherwise it waits for them to finish. The expected peak of a tool is its
+    # configured value, else the largest peak RSS measured in recent runs (+20%), else its default.
+    # A single invocation is always admitted when nothing else runs.
+
+    def __init__(self, memory_gb: float = None, tool_memory: dict = None, history_path: str = None):
+        self.memory_gb = memory_gb
+        self.tool_memory = tool_memory or {}
+        self.history_path = history_path
+        self.history = {}
+        if history_path and os.path.isfile(history_path):
+            with open(history_path) as f:
+                self.history = json.load(f)
+        self.reserved = 0.0
+        self._budget = None
+        self._changed = threading.Condition()
+
+    def budget(self):
+        # the --memory cap, else the memory available when the first tool was admitted
+        if self._budget is None:
+            self._budget = self.memory_gb or available_memory_gb() or float("inf")
+        return self._budget
+
+    def expected_gb(self, tool: str):
+        if tool in self.tool_memory:
+            return float(self.tool_memory[tool])
+        if self.history.get(tool):
+            return round(max(self.history[tool]) * 1.2, 1)
+        return DEFAULT_TOOL_MEMORY_GB.get(tool, 0)
+
+    def admit(self, tool: str, cancelled: threading.Event = None):
+        # Blocks until the tool fits, returns the GB reserved for it (release them once it finished).
+        need = self.expected_gb(tool)
+        if not need:
+            return 0
+        with self._changed:
+            if self.reserved and self.reserved + need > self.budget():
+                print(f"{tool} waits for memory: needs ~{need:g} GB, {self.reserved:g} GB reserved (budget {self.budget():.0f} GB)")
+            while self.reserved and self.reserved + need > self.budget():
+                if cancelled is not None and cancelled.is_set():
+                    return 0
+                self._changed.wait(timeout=5)
+            self.reserved += need
+        return need
+
+    def release(self, reserved: float):
+        if reserved:
+            with self._changed:
+                self.reserved -= reserved
+                self._changed.notify_all()
+
+    def record(self, tool: str, peak_gb: float):
+        # Keeps the last 20 peaks of the tools with a memory requirement (configured or default) in the history
+        # file shared by the runs on this machine. The peak of a command includes the RSS of the python process
+        # it was forked from, meaningless for small tools (rm, bash...), which are left out.
+        if not self.history_path or tool not in self.tool_memory and tool not in DEFAULT_TOOL_MEMORY_GB:
+            return
+        with self._changed:
+            os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+            # other runs may have recorded peaks since, the file is merged under a lock rather than overwritten
+            with open(os.open(self.history_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    history = json.loads(f.read() or "{}")
+                except ValueError:
+                    history = {}
+                history[tool] = (history.get(tool, []) + [round(peak_gb, 2)])[-20:]
+                f.seek(0)
+                f.truncate()
+                json.dump(history, f, indent=2)
+            self.history = history
+
+
+memory_gate = MemoryGate()
+
+
+def configure_memory(history_dir: str = None, memory_gb: float = None, tool_memory: dict = None):
+    # Replaces the process wide memory gate (from the --memory/--tool_memory flags).
+    global memory_gate
+    history_path = os.path.join(history_dir, MEMORY_HISTORY_NAME) if history_dir else None
+    memory_gate = MemoryGate(memory_gb, tool_memory, history_path)
+    return memory_gate
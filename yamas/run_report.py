@@ -0,0 +1,129 @@
+import contextvars
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+
+REPORT_NAME = "run_report.json"
+
+# (report, stage name) of the stage the current thread works for, so run_cmd can charge its commands to it.
+# Threads started inside a stage must run in a copy of the stage's context (see run_in_pool).
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+def usage_entry(wall: float, usage=None):
+    # wall time, user/sys CPU, peak RSS and block I/O of a resource.getrusage()/os.wait4() result.
+    # The peak RSS of a command is at least the size of the python process that forked it.
+    entry = {"wall_s": round(wall, 3), "user_s": 0.0, "sys_s": 0.0, "peak_rss_mb": 0.0, "read_mb": 0.0,
+             "written_mb": 0.0}
+    if usage is not None:
+        entry.update(user_s=round(usage.ru_utime, 3), sys_s=round(usage.ru_stime, 3),
+                     peak_rss_mb=round(usage.ru_maxrss / 1024, 1),
+                     read_mb=round(usage.ru_inblock * 512 / 2 ** 20, 1),
+                     written_mb=round(usage.ru_oublock * 512 / 2 ** 20, 1))
+    return entry
+
+
+def thread_usage():
+    # CPU of the calling thread only (Linux); None where RUSAGE_THREAD is not available
+    if hasattr(resource, "RUSAGE_THREAD"):
+        return resource.getrusage(resource.RUSAGE_THREAD)
+    return None
+
+
+def record_command(command: str, exit_code: int, wall: float, usage=None):
+    stage = current_stage.get()
+    if stage is not None:
+        report, stage_name = stage
+        report.add_command(stage_name, command, exit_code, wall, usage)
+
+
+def stage_log_path():
+    # <project>/logs/<stage>.log of the stage the current thread works for, None outside of a stage
+    stage = current_stage.get()
+    if stage is None:
+        return None
+    report, stage_name = stage
+    return os.path.join(os.path.dirname(report.path), "logs", f"{stage_name}.log")
+
+
+class RunReport:
+    # Wall time, CPU, peak RSS and block I/O of every stage of a run, and of every command the stages ran.
+    # Each run is appended to <dir_path>/run_report.json, so a project keeps the report of every
+    # download/continue/export run made in it.
+
+    def __init__(self, dir_path: str, flow: str):
+        self.path = os.path.join(str(dir_path), REPORT_NAME)
+        self.flow = flow
+        self.started = time.time()
+        self.stages = {}
+        self.commands = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def start_stage(self, name: str, label: str):
+        with self._lock:
+            self.stages[name] = {"name": name, "label": label, "status": "running",
+                                 "started": datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+                                 **usage_entry(0), "commands": 0}
+
+    def finish_stage(self, name: str, status: str, wall: float, before=None, after=None):
+        # before/after: the stage thread's own rusage, for the work done in python
+        with self._lock:
+            stage = self.stages[name]
+            stage["status"] = status
+            stage["wall_s"] = round(wall, 3)
+            if before is not None and after is not None:
+                stage["user_s"] = round(stage["user_s"] + after.ru_utime - before.ru_utime, 3)
+                stage["sys_s"] = round(stage["sys_s"] + after.ru_stime - before.ru_stime, 3)
+
+    def add_command(self, stage_name: str, command: str, exit_code: int, wall: float, usage=None):
+        entry = {"stage": stage_name, "command": command, "exit_code": exit_code, **usage_entry(wall, usage)}
+        with self._lock:
+            self.commands.append(entry)
+            stage = self.stages.get(stage_name)
+            if stage is None:
+                return
+            stage["commands"] += 1
+            for key in ("user_s", "sys_s", "read_mb", "written_mb"):
+                stage[key] = round(stage[key] + entry[key], 3)
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], entry["peak_rss_mb"])
+
+    def as_dict(self):
+        with self._lock:
+            return {"flow": self.flow,
+                    "started": datetime.datetime.fromtimestamp(self.started).strftime('%d/%m/%Y %H:%M:%S'),
+                    "started_at": self.started,
+                    "wall_s": round(time.time() - self.started, 3),
+                    "python_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                    "stages": list(self.stages.values()),
+                    "commands": list(self.commands)}
+
+    def write(self):
+        # Written after every stage, so a run that gets killed still leaves its report behind.
+        with self._write_lock:
+            runs = []
+            if os.path.isfile(self.path):
+                with open(self.path) as f:
+                    runs = json.load(f).get("runs", [])
+            runs = [run for run in runs if run.get("started_at") != self.started] + [self.as_dict()]
+            with open(self.path, 'w') as f:
+                json.dump({"runs": runs}, f, indent=2)
+
+    def summary(self):
+        rows = [("stage", "status", "wall", "user", "sys", "peak RSS", "read", "written")]
+        for stage in self.as_dict()["stages"]:
+            rows.append((stage["label"] or stage["name"], stage["status"], format_seconds(stage["wall_s"]),
+                         format_seconds(stage["user_s"]), format_seconds(stage["sys_s"]),
+                         f"{stage['peak_rss_mb']:.0f} MB", f"{stage['read_mb']:.0f} MB",
+                         f"{stage['written_mb']:.0f} MB"))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows]
+        lines.insert(1, "  ".join("-" * width for width in widths))
+        return "\n".join(lines)
+
+
+def format_seconds(seconds: float):
+    return str(datetime.timedelta(seconds=int(seconds)))
@@ -0,0 +1,79 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR_NAME = ".yamas_cache"
+
+
+def default_cache_path(specific_location: str):
+    return os.path.join(os.path.abspath(specific_location or ""), CACHE_DIR_NAME, "run_info.sqlite")
+
+
+class RunInfoCache:
+    # On-disk cache of SRA run-info rows, keyed by run accession and by BioProject.
+    # Entries older than ttl_days are treated as missing, unless offline=True, in which case
+    # anything cached is used and nothing is ever refreshed.
+
+    def __init__(self, path: str, ttl_days: float = 30, offline: bool = False):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl_days * 24 * 3600
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS runs "
+                             "(run TEXT PRIMARY KEY, bioproject TEXT, row TEXT, fetched_at REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS runs_bioproject ON runs (bioproject)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS projects (bioproject TEXT PRIMARY KEY, fetched_at REAL)")
+            # the runs of every project fetched as a whole, under the id it was fetched with
+            self._db.execute("CREATE TABLE IF NOT EXISTS project_runs "
+                             "(bioproject TEXT, run TEXT, position INTEGER, PRIMARY KEY (bioproject, run))")
+
+    def _fresh(self, fetched_at: float):
+        return self.offline or time.time() - fetched_at < self.ttl
+
+    def get_runs(self, accessions: list):
+        # Returns {run accession: row} for the accessions that are cached and fresh.
+        found = {}
+        with self._lock:
+            for acc in accessions:
+                entry = self._db.execute("SELECT row, fetched_at FROM runs WHERE run = ?", (acc,)).fetchone()
+                if entry and self._fresh(entry[1]):
+                    found[acc] = json.loads(entry[0])
+        return found
+
+    def get_project(self, bioproject: str):
+        # Returns the cached rows of a whole BioProject (in Entrez order), or None if it was never fetched or is stale.
+        with self._lock:
+            entry = self._db.execute("SELECT fetched_at FROM projects WHERE bioproject = ?", (bioproject,)).fetchone()
+            if not entry or not self._fresh(entry[0]):
+                return None
+            rows = self._db.execute("SELECT runs.row FROM project_runs JOIN runs ON runs.run = project_runs.run "
+                                    "WHERE project_runs.bioproject = ? ORDER BY project_runs.position",
+                                    (bioproject,)).fetchall()
+        # no rows: cached before the project_runs table, fetched again
+        return [json.loads(row[0]) for row in rows] or None
+
+    def put_runs(self, rows: list, bioproject: str = None):
+        # bioproject: the rows are the whole project, fetched with this id. An empty project is never cached.
+        if bioproject is not None and not rows:
+            raise ValueError(f"No run info to cache for {bioproject}")
+        now = time.time()
+        with self._lock, self._db:
+            # a run fetched again (as part of a project or on its own) keeps the project it was first cached under
+            self._db.executemany(
+                "INSERT INTO runs (run, bioproject, row, fetched_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (run) DO UPDATE SET row = excluded.row, fetched_at = excluded.fetched_at",
+                [(row["Run"], bioproject or row.get("BioProject"), json.dumps(row), now) for row in rows])
+            if bioproject is not None:
+                self._db.execute("DELETE FROM project_runs WHERE bioproject = ?", (bioproject,))
+                self._db.executemany("INSERT OR IGNORE INTO project_runs (bioproject, run, position) VALUES (?, ?, ?)",
+                                     [(bioproject, row["Run"], i) for i, row in enumerate(rows)])
+                self._db.execute("INSERT OR REPLACE INTO projects (bioproject, fetched_at) VALUES (?, ?)",
+                                 (bioproject, now))
+
+    def close(self):
+        self._db.close()
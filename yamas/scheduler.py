@@ -0,0 +1,157 @@
+import contextvars
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+from .resources import granted_threads, thread_budget
+from .run_report import RunReport, current_stage, thread_usage
+from .utilities import CancelScope, cancel_scope
+
+
+@dataclass
+class Stage:
+    # A pipeline stage: `func` runs once every stage named in `after` finished.
+    # threads/memory_gb is what the stage needs from the run's budget while it runs.
+    # With checkpoints, a stage whose checkpoint (inputs/outputs) is still valid is skipped.
+    name: str
+    func: Callable
+    after: tuple = ()
+    label: str = ""
+    threads: int = 1
+    memory_gb: float = 0
+    inputs: Callable = None
+    outputs: Callable = None
+    checkpoint: bool = True
+    deps: set = field(default_factory=set, init=False)
+
+
+# the items (accessions, samples) the running stage could not process, see record_failures
+stage_failures = contextvars.ContextVar("stage_failures", default=None)
+
+
+def record_failures(failures: dict):
+    # A stage whose items partly failed still finishes, so that the next stages go on with the other items,
+    # but it isn't checkpointed (nor the stages after it): a resume runs it again and it retries the failed items.
+    items = stage_failures.get()
+    if items is not None:
+        items.update(failures)
+
+
+def now():
+    return datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+
+
+def run_stages(stages: list, log=print, threads: int = None, memory_gb: float = None, checkpoints=None,
+               report: RunReport = None, command_timeout: float = None):
+    # Runs the stages as a dependency graph: every stage starts as soon as the stages it depends on
+    # finished and its threads/memory fit in what is left of the budget, so independent stages run
+    # at the same time. A stage asking for more than the whole budget gets the whole budget.
+    # The threads budget is capped at the CPUs of the machine (or its cgroup), and the threads a stage got
+    # are what its tools split between them (see resources.tool_threads).
+    # The first failing stage stops scheduling new stages, and its error is raised once the
+    # running ones finish.
+    # A stage that recorded failed items (record_failures) finishes as "incomplete" and isn't checkpointed.
+    # With a report, the time, CPU, peak memory and I/O of every stage (and the commands it ran) is recorded.
+    # A failure (or Ctrl+C) kills the commands the other running stages started, and every command
+    # running longer than command_timeout seconds is killed.
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        stage.deps = set(stage.after) & names
+        missing = set(stage.after) - names
+        if missing:
+            raise ValueError(f"stage {stage.name} depends on unknown stages {missing}")
+    total = len(stages)
+    position = {stage.name: i + 1 for i, stage in enumerate(stages)}
+    threads_budget = thread_budget(threads)
+    if threads and threads_budget < int(threads):
+        log(f"{threads} threads requested but only {threads_budget} CPUs are available, using {threads_budget}.")
+    memory_budget = memory_gb if memory_gb is not None else float("inf")
+
+    pending = list(stages)
+    finished = set()
+    incomplete = set()
+    running = {}
+    errors = []
+    used = {"threads": 0, "memory_gb": 0}
+    changed = threading.Condition()
+    scope = CancelScope(timeout=command_timeout)
+
+    def needs(stage):
+        return min(stage.threads, threads_budget), min(stage.memory_gb, memory_budget)
+
+    def fits(stage):
+        stage_threads, stage_memory = needs(stage)
+        if not running:
+            return True
+        return used["threads"] + stage_threads <= threads_budget and used["memory_gb"] + stage_memory <= memory_budget
+
+    def run(stage):
+        label = f"{stage.label or stage.name} ({position[stage.name]}/{total})"
+        start, usage, status = time.time(), thread_usage(), "failed"
+        failures = {}
+        stage_failures.set(failures)
+        cancel_scope.set(scope)
+        granted_threads.set(needs(stage)[0])
+        if report is not None:
+            report.start_stage(stage.name, stage.label)
+            current_stage.set((report, stage.name))
+        try:
+            inputs = stage.inputs() if stage.inputs else ()
+            outputs = stage.outputs() if stage.outputs else ()
+            if checkpoints is not None and stage.checkpoint and checkpoints.done(stage.name, inputs, outputs):
+                log(f"{now()} -- Skipping {label}, already done")
+                status = "skipped"
+            else:
+                log("\n")
+                log(f"{now()} -- Start {label}")
+                stage.func()
+                if failures or stage.deps & incomplete:
+                    # the stages after an incomplete one only had part of their items
+                    with changed:
+                        incomplete.add(stage.name)
+                    log(f"{now()} -- Finish {label}, incomplete ({len(failures)} failed), not checkpointed")
+                    status = "incomplete"
+                else:
+                    if checkpoints is not None and stage.checkpoint:
+                        checkpoints.mark(stage.name, inputs)
+                    log(f"{now()} -- Finish {label}")
+                    status = "done"
+        except BaseException as e:
+            errors.append(e)
+            scope.cancel()
+        finally:
+            if report is not None:
+                report.finish_stage(stage.name, status, time.time() - start, usage, thread_usage())
+                report.write()
+            with changed:
+                stage_threads, stage_memory = needs(stage)
+                used["threads"] -= stage_threads
+                used["memory_gb"] -= stage_memory
+                running.pop(stage.name)
+                finished.add(stage.name)
+                changed.notify_all()
+
+    with ThreadPoolExecutor(max_workers=max(1, total)) as pool, changed:
+        try:
+            while pending or running:
+                if not errors:
+                    for stage in [stage for stage in pending if stage.deps <= finished]:
+                        if fits(stage):
+                            stage_threads, stage_memory = needs(stage)
+                            used["threads"] += stage_threads
+                            used["memory_gb"] += stage_memory
+                            pending.remove(stage)
+                            running[stage.name] = pool.submit(contextvars.copy_context().run, run, stage)
+                    if pending and not running:
+                        raise ValueError(f"stages {[stage.name for stage in pending]} depend on each other")
+                elif not running:
+                    break
+                changed.wait()
+        except BaseException:
+            scope.cancel()
+            raise
+    if errors:
+        raise errors[0]
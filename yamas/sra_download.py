@@ -0,0 +1,131 @@
+import csv
+import json
+import os
+import shutil
+import threading
+import time
+
+from .utilities import run_cmd, run_in_pool
+
+LEDGER_NAME = "download_status.json"
+
+
+def prefetch_accession(dir_path: str, acc: str, prefetch: str = "prefetch"):
+    # downloads a single accession into sra/<acc>/ and returns the path of its .sra file
+    sra_dir = os.path.join(dir_path, 'sra')
+    exit_code = run_cmd([prefetch, acc,
+                         "--output-directory", sra_dir,
+                         "--max-size", "100G"])
+    sra_path = find_sra_file(dir_path, acc)
+    if exit_code != 0 or sra_path is None:
+        raise RuntimeError(f"prefetch failed on {acc} (exit code {exit_code})")
+    return sra_path
+
+
+def find_sra_file(dir_path: str, acc: str):
+    acc_dir = os.path.join(dir_path, 'sra', acc)
+    if not os.path.isdir(acc_dir):
+        return None
+    sra_files = [f for f in os.listdir(acc_dir) if f.endswith((".sra", ".sralite"))]
+    return os.path.join(acc_dir, sra_files[0]) if sra_files else None
+
+
+def read_run_info(run_info_path: str):
+    # Returns {accession: run-info row}. The csv may hold several concatenated efetch outputs,
+    # so repeated header lines are skipped.
+    if not run_info_path or not os.path.isfile(run_info_path):
+        return {}
+    with open(run_info_path, newline='') as f:
+        return {row["Run"]: row for row in csv.DictReader(f) if row.get("Run") and row["Run"] != "Run"}
+
+
+# how far the size of a download may be from the run info's size_MB: a rounding step (size_MB is a whole number
+# of MB) plus a margin, since the size SRA reports isn't always of the exact file prefetch downloads
+SIZE_TOLERANCE_MB = 1
+SIZE_TOLERANCE = 0.05
+
+
+def verify_sra(sra_path: str, run_info_row: dict, vdb_validate: str = "vdb-validate"):
+    # Checks the downloaded file: its size against the run info's size_MB (a truncated download),
+    # then its content with vdb-validate (the checksums inside the .sra), when sra-tools has it.
+    expected_mb = (run_info_row or {}).get("size_MB")
+    if expected_mb and expected_mb.isdigit() and not sra_path.endswith(".sralite"):
+        size_mb = os.path.getsize(sra_path) / 2 ** 20
+        if abs(size_mb - int(expected_mb)) > SIZE_TOLERANCE_MB + int(expected_mb) * SIZE_TOLERANCE:
+            raise ValueError(f"{os.path.basename(sra_path)}: size {size_mb:.0f}MB, run info says {expected_mb}MB")
+    if shutil.which(vdb_validate):
+        exit_code = run_cmd([vdb_validate, sra_path])
+        if exit_code != 0:
+            raise ValueError(f"{os.path.basename(sra_path)}: vdb-validate failed (exit code {exit_code})")
+
+
+class DownloadLedger:
+    # Per-accession download status, kept in <dir_path>/download_status.json so a rerun only
+    # fetches what is still missing.
+
+    def __init__(self, dir_path: str):
+        self.path = os.path.join(dir_path, LEDGER_NAME)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def is_done(self, acc: str):
+        entry = self.entries.get(acc, {})
+        return entry.get("status") == "done" and os.path.isfile(entry.get("path", ""))
+
+    def update(self, acc: str, **entry):
+        with self._lock:
+            self.entries[acc] = {**self.entries.get(acc, {}), **entry}
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+
+
+def fetch_accession(dir_path: str, acc: str, run_info_row: dict = None, ledger: DownloadLedger = None,
+                    retries: int = 3, backoff: float = 10, prefetch: str = "prefetch", store=None):
+    # prefetch + verification of a single accession, retried with exponential backoff.
+    # With an AccessionStore, accessions another project already downloaded are linked instead.
+    if ledger is not None and ledger.is_done(acc):
+        return ledger.entries[acc]["path"]
+    linked = store.link(acc, "sra", os.path.join(dir_path, 'sra', acc)) if store is not None else []
+    if linked:
+        if ledger is not None:
+            ledger.update(acc, status="done", attempts=0, path=linked[0], error=None)
+        return linked[0]
+    for attempt in range(1, retries + 1):
+        try:
+            sra_path = prefetch_accession(dir_path, acc, prefetch)
+            verify_sra(sra_path, run_info_row)
+        except (RuntimeError, ValueError) as e:
+            if ledger is not None:
+                ledger.update(acc, status="failed", attempts=attempt, error=str(e))
+            # a partial or corrupt download must not be picked up by the next attempt or by sra_to_fastq
+            shutil.rmtree(os.path.join(dir_path, 'sra', acc), ignore_errors=True)
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** (attempt - 1))
+        else:
+            if store is not None:
+                store.add(acc, "sra", [sra_path])
+            if ledger is not None:
+                ledger.update(acc, status="done", attempts=attempt, path=sra_path, error=None)
+            return sra_path
+
+
+def download_accessions(dir_path: str, accessions: list, run_info_path: str = None, workers: int = 4,
+                        retries: int = 3, backoff: float = 10, prefetch: str = "prefetch", store=None):
+    # Runs `workers` prefetch processes at once over the accession list. Returns {accession: error}
+    # for the accessions that still failed after all retries.
+    # Note: prefetch has no rate limit option, the number of workers is what caps the bandwidth used.
+    os.makedirs(os.path.join(dir_path, 'sra'), exist_ok=True)
+    run_info = read_run_info(run_info_path)
+    ledger = DownloadLedger(dir_path)
+    missing = [acc for acc in accessions if not ledger.is_done(acc)]
+    if len(missing) < len(accessions):
+        print(f"{len(accessions) - len(missing)} accessions already downloaded, skipping them.")
+
+    def fetch(acc):
+        fetch_accession(dir_path, acc, run_info.get(acc), ledger, retries, backoff, prefetch, store)
+
+    return run_in_pool(fetch, missing, workers=workers, desc="downloaded accessions")
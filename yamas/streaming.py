@@ -0,0 +1,149 @@
+import contextvars
+import os
+import queue
+import shutil
+import threading
+
+from tqdm import tqdm
+
+from .create_visualization import fastq_dump_accession, metaphlan_sample, report_failed_samples, merge_profiles, \
+    accession_fastq_files, fastq_files_complete
+from .sra_download import DownloadLedger, fetch_accession, read_run_info
+from .utilities import ReadsData
+from .resources import tool_threads
+
+# Marks the end of the accession stream in the stage queues.
+_DONE = None
+
+
+def stream_accessions(dir_path: str, accessions: list, dataset_id: str, data_type: str, as_single: bool,
+                      threads: int = 8, workers: int = 1, max_in_flight: int = 4, keep_fastq: bool = False,
+                      run_info: str = None, temp_dir: str = None, store=None, checkpoints=None):
+    # Runs every accession through prefetch -> fasterq-dump -> (Shotgun) metaphlan as soon as it lands,
+    # instead of finishing each stage for the whole project before starting the next one.
+    # At most `max_in_flight` accessions hold intermediate files on disk at the same time:
+    # the .sra is deleted once converted, and for Shotgun the fastq files are deleted once profiled
+    # (unless keep_fastq, e.g. when HUMAnN still needs them). The files of an accession that failed are
+    # deleted with its slot, a resume converts it again.
+    shotgun = data_type not in ('16S', '18S')
+    in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+    to_convert = queue.Queue(maxsize=max(1, max_in_flight))
+    to_profile = queue.Queue(maxsize=max(1, max_in_flight))
+    nproc = tool_threads(workers, threads)
+    ledger = DownloadLedger(dir_path)
+    run_info_rows = read_run_info(run_info)
+    failures = {}
+    paired = []
+    progress = tqdm(total=len(accessions), desc="streamed accessions")
+
+    def finish(acc, error=None):
+        if error is not None:
+            failures[acc] = error
+        progress.update(1)
+        in_flight.release()
+
+    def already_done(acc):
+        # resuming: the accession went through every stage before the interruption
+        if shotgun:
+            profile_file = os.path.join(dir_path, 'qza', f'{acc}_profile.txt')
+            if checkpoints is None or not checkpoints.done(f"metaphlan:{acc}", outputs=[profile_file]):
+                return False
+            if checkpoints.steps[f"metaphlan:{acc}"].get("paired"):
+                paired.append(acc)
+            return True
+        fastq_files = accession_fastq_files(os.path.join(dir_path, "fastq"), acc)
+        if not fastq_files_complete(fastq_files, as_single, run_info_rows.get(acc, {}).get("LibraryLayout")):
+            return False
+        if len(fastq_files) == 2 or as_single and ledger.entries.get(acc, {}).get("paired"):
+            paired.append(acc)
+        return True
+
+    # Every item's whole body is in its try, so finish() runs for it whatever fails, and the _DONE markers are
+    # sent even if a thread stops early: an item that doesn't finish would hold its in_flight slot and the
+    # threads waiting on the queues would wait forever.
+    def download():
+        try:
+            for acc in accessions:
+                in_flight.acquire()
+                try:
+                    if already_done(acc):
+                        finish(acc)
+                        continue
+                    item = (acc, fetch_accession(dir_path, acc, run_info_rows.get(acc), ledger, store=store))
+                except Exception as e:
+                    finish(acc, e)
+                    continue
+                to_convert.put(item)
+        finally:
+            to_convert.put(_DONE)
+
+    def convert():
+        try:
+            while (item := to_convert.get()) is not _DONE:
+                acc, sra_path = item
+                try:
+                    # fasterq-dump won't overwrite the leftovers of an interrupted conversion
+                    for fastq in accession_fastq_files(os.path.join(dir_path, "fastq"), acc):
+                        os.remove(fastq)
+                    fastq_files = store.link(acc, "fastq", os.path.join(dir_path, "fastq")) if store is not None else []
+                    if not fastq_files:
+                        fastq_files = fastq_dump_accession(dir_path, sra_path, threads=nproc, temp_dir=temp_dir)
+                        if store is not None:
+                            store.add(acc, "fastq", fastq_files)
+                    if len(fastq_files) == 2:
+                        paired.append(acc)
+                        ledger.update(acc, paired=True)
+                        if as_single:
+                            os.remove(fastq_files.pop())
+                except Exception as e:
+                    for fastq in accession_fastq_files(os.path.join(dir_path, "fastq"), acc):
+                        os.remove(fastq)
+                    finish(acc, e)
+                    continue
+                finally:
+                    shutil.rmtree(os.path.dirname(sra_path), ignore_errors=True)
+                if shotgun:
+                    to_profile.put((acc, fastq_files))
+                else:
+                    finish(acc)
+        finally:
+            if shotgun:
+                for _ in range(max(1, workers)):
+                    to_profile.put(_DONE)
+
+    def profile():
+        while (item := to_profile.get()) is not _DONE:
+            acc, fastq_files = item
+            try:
+                metaphlan_sample(fastq_files, acc, dir_path, nproc)
+                if checkpoints is not None:
+                    checkpoints.mark(f"metaphlan:{acc}", fastq_files, paired=acc in paired)
+                if not keep_fastq:
+                    for fastq in fastq_files:
+                        os.remove(fastq)
+            except Exception as e:
+                for fastq in fastq_files:
+                    if os.path.exists(fastq):
+                        os.remove(fastq)
+                finish(acc, e)
+                continue
+            finish(acc)
+
+    # the threads run in copies of this context, so their commands are charged to the calling stage
+    stages = [threading.Thread(target=contextvars.copy_context().run, args=(download,)),
+              threading.Thread(target=contextvars.copy_context().run, args=(convert,))]
+    stages += [threading.Thread(target=contextvars.copy_context().run, args=(profile,))
+               for _ in range(max(1, workers) if shotgun else 0)]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    progress.close()
+
+    export_path = os.path.join(dir_path, "export")
+    os.makedirs(export_path, exist_ok=True)
+    report_failed_samples(failures, os.path.join(export_path, f'{dataset_id}_failed_samples.txt'))
+    if shotgun:
+        merge_profiles(dir_path, dataset_id)
+
+    return ReadsData(dir_path, fwd=True, rev=bool(paired) and not as_single)
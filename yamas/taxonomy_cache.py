@@ -0,0 +1,81 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+TAXONOMY_CACHE_NAME = "taxonomy.sqlite"
+
+
+def sequence_md5(sequence: str):
+    # the feature ID DADA2 gives a sequence, computed again so it doesn't depend on how the features were named
+    # (or on how the fasta wraps the sequence)
+    return hashlib.md5("".join(sequence.split()).upper().encode()).hexdigest()
+
+
+class TaxonomyCache:
+    # On-disk cache of classify-sklearn results, keyed by sequence MD5 and classifier digest, so sequences that
+    # were already classified with the same classifier (by any project) aren't classified again.
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS taxonomy "
+                             "(sequence TEXT, classifier TEXT, taxon TEXT, confidence TEXT, classified_at REAL, "
+                             "PRIMARY KEY (sequence, classifier))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS classifiers "
+                             "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+
+    def classifier_digest(self, classifier_path: str):
+        # SHA-256 of the classifier file, hashed again only when its size or modification time changed
+        path = os.path.abspath(classifier_path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._db.execute("SELECT size, mtime_ns, digest FROM classifiers WHERE path = ?",
+                                     (path,)).fetchone()
+        if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO classifiers (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+                             (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def get(self, classifier: str, sequences: list):
+        # Returns {sequence MD5: (taxon, confidence)} for the sequences classified before with this classifier.
+        found = {}
+        with self._lock:
+            for sequence in set(sequences):
+                entry = self._db.execute("SELECT taxon, confidence FROM taxonomy WHERE sequence = ? AND classifier = ?",
+                                         (sequence, classifier)).fetchone()
+                if entry:
+                    found[sequence] = entry
+        return found
+
+    def put(self, classifier: str, results: dict):
+        # results: {sequence MD5: (taxon, confidence)}
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO taxonomy (sequence, classifier, taxon, confidence, classified_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(sequence, classifier, taxon, confidence, now) for sequence, (taxon, confidence) in results.items()])
+
+    def close(self):
+        self._db.close()
+
+
+cache = None
+
+
+def configure_taxonomy_cache(cache_dir: str = None):
+    # Replaces the process wide taxonomy cache (None turns it off, it is on with --taxonomy_cache).
+    global cache
+    cache = TaxonomyCache(os.path.join(cache_dir, TAXONOMY_CACHE_NAME)) if cache_dir else None
+    return cache
@@ -1,7 +1,19 @@
+import contextvars
 import os
+import re
+import signal
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 
+from tqdm import tqdm
+
+from . import resources
+from .resources import tool_name
+from .run_report import record_command, stage_log_path
+
 
 @dataclass(frozen=True)
 class ReadsData:
@@ -9,13 +21,202 @@ class ReadsData:
     fwd: bool = True
     rev: bool = False
 
-def run_cmd(command: list):
-    os.system(" ".join(command))
+
+# <sample>.fastq, or <sample>_1.fastq / <sample>_2.fastq for the mates of a paired-end sample
+FASTQ_NAME = re.compile(r"^(?P<sample>.+?)(?:_(?P<mate>[12]))?\.fastq$")
+
+
+def fastq_sample_index(fastq_dir: str):
+    # sample -> its fastq files (the single fastq, or mate 1 then mate 2), from a sorted scan of fastq_dir.
+    # Every per-sample stage (metaphlan, HUMAnN, the manifest) works from it, so the mates always go together
+    # and the samples come in the same order whatever order the file system lists them in.
+    # When a sample has mates, the unpaired reads fasterq-dump writes next to them (<sample>.fastq) are left out.
+    mates, singles = {}, {}
+    for name in sorted(os.listdir(fastq_dir)) if os.path.isdir(fastq_dir) else []:
+        match = FASTQ_NAME.match(name)
+        if match is None or not os.path.isfile(os.path.join(fastq_dir, name)):
+            continue
+        files = mates if match["mate"] else singles
+        files.setdefault(match["sample"], []).append(os.path.join(fastq_dir, name))
+    return {sample: mates.get(sample) or singles[sample] for sample in sorted(set(mates) | set(singles))}
+
+
+class CommandError(RuntimeError):
+    def __init__(self, result: "CommandResult"):
+        self.result = result
+        reason = f"timed out after {result.timeout}s" if result.timed_out else \
+            "was cancelled" if result.cancelled else f"failed (exit code {result.exit_code})"
+        message = f"'{result.command}' {reason}"
+        if result.log_path:
+            message += f", see {result.log_path}"
+        super().__init__(message)
+
+
+@dataclass
+class CommandResult:
+    command: str
+    exit_code: int
+    stdout: str = None
+    log_path: str = None
+    timeout: float = None
+    timed_out: bool = False
+    cancelled: bool = False
+
+
+class CancelScope:
+    # The commands started under a scope (see cancel_scope); cancel() kills the running ones and makes
+    # the ones started afterwards fail at once. `timeout` is the default timeout of its commands.
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+        self.cancelled = threading.Event()
+        self.commands = set()
+        self._lock = threading.Lock()
+
+    def add(self, command: "Command"):
+        with self._lock:
+            self.commands.add(command)
+        if self.cancelled.is_set():
+            command.cancel()
+
+    def remove(self, command: "Command"):
+        with self._lock:
+            self.commands.discard(command)
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            commands = list(self.commands)
+        for command in commands:
+            command.cancel()
+
+
+cancel_scope = contextvars.ContextVar("cancel_scope", default=None)
+
+
+class Command:
+    # A shell command running in the background, in its own process group so that a timeout or a
+    # cancel kills everything it started. Its output goes to log_path (appended), to the log of the
+    # current stage when there is one, or to the terminal; with capture=True stdout is kept instead.
+    # It starts once the memory gate admitted it (see resources.MemoryGate).
+
+    def __init__(self, command: list, timeout: float = None, log_path: str = None, capture: bool = False):
+        self.command = " ".join(command)
+        self.scope = cancel_scope.get()
+        self.timeout = timeout if timeout is not None else self.scope.timeout if self.scope else None
+        self.log_path = log_path or stage_log_path()
+        self.capture = capture
+        self.timed_out = False
+        self.cancelled = False
+        self.tool = tool_name(self.command)
+        self.gate = resources.memory_gate
+        self.reserved_gb = self.gate.admit(self.tool, self.scope.cancelled if self.scope else None)
+        self.start = time.time()
+        self._result = None
+        self._wait_lock = threading.Lock()
+        log = None
+        if self.log_path:
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            log = open(self.log_path, 'a')
+            log.write(f"\n[{time.strftime('%d/%m/%Y %H:%M:%S')}] $ {self.command}\n")
+            log.flush()
+        self.process = subprocess.Popen(self.command, shell=True, start_new_session=True,
+                                        stdout=subprocess.PIPE if capture else log,
+                                        stderr=subprocess.STDOUT if log and not capture else log,
+                                        text=capture)
+        if log:
+            log.close()
+        self._timer = None
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        if self.scope is not None:
+            self.scope.add(self)
+
+    def _kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _expire(self):
+        self.timed_out = True
+        self._kill()
+
+    def cancel(self):
+        if self._result is None:
+            self.cancelled = True
+            self._kill()
+
+    def wait(self, check: bool = False):
+        # wait4 gives the rusage (CPU, peak RSS, block I/O) of the command, recorded in the run report
+        with self._wait_lock:
+            if self._result is None:
+                try:
+                    stdout = self.process.stdout.read() if self.capture else None
+                    _, status, usage = os.wait4(self.process.pid, 0)
+                except KeyboardInterrupt:
+                    # the command runs in its own session, out of reach of Ctrl+C, so it's stopped along
+                    self.cancel()
+                    raise
+                self.process.returncode = os.waitstatus_to_exitcode(status)
+                if self.capture:
+                    self.process.stdout.close()
+                if self._timer is not None:
+                    self._timer.cancel()
+                if self.scope is not None:
+                    self.scope.remove(self)
+                self.gate.release(self.reserved_gb)
+                if self.process.returncode == 0:
+                    self.gate.record(self.tool, usage.ru_maxrss / 2 ** 20)
+                record_command(self.command, self.process.returncode, time.time() - self.start, usage)
+                self._result = CommandResult(self.command, self.process.returncode, stdout, self.log_path,
+                                             self.timeout, self.timed_out, self.cancelled)
+        if check and self._result.exit_code != 0:
+            raise CommandError(self._result)
+        return self._result
+
+
+def start_cmd(command: list, timeout: float = None, log_path: str = None, capture: bool = False):
+    return Command(command, timeout=timeout, log_path=log_path, capture=capture)
+
+
+def run_cmd(command: list, timeout: float = None, log_path: str = None, check: bool = False):
+    # Runs the command and returns its exit code (non-zero on timeout/cancel); with check=True a failure
+    # raises CommandError instead.
+    return start_cmd(command, timeout=timeout, log_path=log_path).wait(check=check).exit_code
+
+
+def cmd_output(command: list, timeout: float = None):
+    # Returns the stdout of the command, raises CommandError if it fails.
+    return start_cmd(command, timeout=timeout, capture=True).wait(check=True).stdout
+
+
+def run_in_pool(func, items: list, workers: int = 1, desc: str = ""):
+    # Runs func(item) for every item with up to `workers` items at once.
+    # A failing item does not stop the others; returns {item: exception} for the items that failed.
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # every item runs in a copy of the caller's context, so its commands are charged to the caller's stage
+        futures = {pool.submit(contextvars.copy_context().run, func, item): item for item in items}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            try:
+                future.result()
+            except Exception as e:
+                failures[futures[future]] = e
+    return failures
 
 
 def qiime2_version():
-    o, e = run_cmd(["conda", "env", "list"])
-    qiime_version = ""
+    # the active environment is the one YaMAS runs in, conda env list only when it isn't a qiime2 one
+    qiime_version = os.path.basename(os.environ.get("CONDA_PREFIX", ""))
+    if qiime_version.startswith("qiime2-"):
+        return qiime_version
+    try:
+        o = cmd_output(["conda", "env", "list"])
+    except (CommandError, OSError):
+        return ""
     for env_1 in o.split("\n"):
         for env_2 in env_1.split("/"):
             if "qiime2" in env_2 and " " not in env_2: